@@ -7,8 +7,14 @@ EXTRAS_REQUIRES = dict(
         'bottle>=0.10.9',
         'paste>=1.7.5.1',
         ],
+    gevent=[
+        'gevent>=0.13.7',
+        ],
+    msgpack=[
+        'msgpack-python>=0.1.13',
+        ],
     mongo=[
-        'pymongo>=2.2',
+        'pymongo>=2.7',
         ],
     util=[
         'python-dateutil>=2.1',
@@ -1,28 +1,160 @@
+import os
+import sys
+import math
+import signal
+import calendar
+import gzip
+import base64
 import hashlib
 import json
 import logging
+import time
+import zlib
+import bson
 import bottle
 import pymongo
 import functools
+import threading
 
+from urllib import quote
+from email.utils import formatdate
 from paste import httpserver
 from paste.translogger import TransLogger
-from datetime import datetime
-from collections import OrderedDict, defaultdict
+from paste.response import header_value, remove_header
+from datetime import datetime, timedelta
+from collections import OrderedDict
 
 from ubernear import util
+from ubernear import metrics
+from ubernear.event_results import (
+    get_status,
+    event_coord_key,
+    search_tokens,
+    live_query_parts,
+    changed_query_part,
+    coord_sort,
+    summary_fields,
+    details_fields,
+    tile_fields,
+    quadkey_zoom,
+    tile_quadkey,
+    group_by_coord,
+    group_by_tile,
+    compact_results,
+    iter_json_pieces,
+    iter_chunks,
+    )
+from ubernear.event_location import (
+    generation_id,
+    earth_radius,
+    )
+from ubernear.util import mongo
+from ubernear.util.cache import LRUCache
+from ubernear.util.ratelimit import TokenBuckets, MongoTokenBuckets
 
 log = logging.getLogger(__name__)
 
-facebook_events_url = 'http://facebook.com/events'
 api_version = '0.1'
+msgpack_type = 'application/x-msgpack'
 
-class DefaultOrderedDict(defaultdict, OrderedDict):
-    def __init__(self, default_factory):
-        defaultdict.__init__(self, default_factory)
-        OrderedDict.__init__(self)
+# In meters
+default_near_radius = 1000
+max_near_radius = 50000
+# In coordinate groups
+default_near_limit = 20
+max_near_limit = 100
+# Upper bound on the events geoNear returns for a single request
+near_max_events = 1000
+# In events
+default_page_limit = 500
+max_page_limit = 5000
+default_search_limit = 50
+max_search_limit = 500
+# Upper bound on the events ranked for a single search
+search_max_events = 1000
+# Tiles are clustered in this many more zoom levels, i.e.,
+# 2**tile_cluster_depth clusters per side
+tile_cluster_depth = 3
+tile_top_events = 3
+
+# Tells a key cache miss apart from a cached invalid key
+_not_cached = object()
+
+# Rate limited requests get a 429, which bottle does not know by
+# name (RFC 6585)
+bottle.HTTP_CODES[429] = 'Too Many Requests'
+bottle._HTTP_STATUS_LINES[429] = '429 Too Many Requests'
+
+class _LoggedBody(object):
+    """
+    Counts the bytes of a response body as it is sent and calls
+    on_close with the count once the server closes it.
+    """
+    def __init__(
+        self,
+        app_iter,
+        on_close,
+        ):
+        self._app_iter = app_iter
+        self._on_close = on_close
+        self._size = 0
+
+    def __iter__(self):
+        for chunk in self._app_iter:
+            self._size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self._app_iter, 'close'):
+                self._app_iter.close()
+        finally:
+            self._on_close(self._size)
 
 class APILogger(TransLogger):
+    """
+    Logs each request once its response has been sent, together
+    with the time spent in each phase of the request and the
+    number of documents the database returned for it, and records
+    them in metrics.registry.
+    """
+    def __call__(self, environ, start_response):
+        start = time.localtime()
+        req_uri = quote(
+            environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+            )
+        if environ.get('QUERY_STRING'):
+            req_uri += '?' + environ['QUERY_STRING']
+        method = environ['REQUEST_METHOD']
+
+        request_metrics = metrics.start_request()
+        environ['ubernear.metrics'] = request_metrics
+        response = {}
+        def logged_start_response(status, headers, exc_info=None):
+            response['status'] = status
+            return start_response(status, headers, exc_info)
+
+        def on_close(size):
+            metrics.end_request()
+            total = request_metrics.total()
+            status = response.get('status', '500 Internal Server Error')
+            environ['ubernear.metrics_total'] = total
+            self.write_log(environ, method, req_uri, start, status, size)
+            metrics.registry.observe(
+                request_metrics,
+                total=total,
+                status=status.split(' ', 1)[0],
+                size=size,
+                )
+
+        try:
+            app_iter = self.application(environ, logged_start_response)
+        except:
+            metrics.end_request()
+            raise
+
+        return _LoggedBody(app_iter, on_close=on_close)
+
     def write_log(
         self,
         environ,
@@ -48,35 +180,277 @@ class APILogger(TransLogger):
             referer=referer,
             user_agent=user_agent,
             )
+        request_metrics = environ.get('ubernear.metrics')
+        if request_metrics is not None:
+            fields = request_metrics.fields(
+                total=environ.get('ubernear.metrics_total'),
+                )
+            msg = ' '.join([msg] + fields)
         log.info(msg)
 
+class GzipMiddleware(object):
+    """
+    Like paste.gzipper.middleware but the response is compressed
+    as it is produced instead of being buffered first so that
+    streamed responses stay streamed. Responses which already
+    have a content encoding are passed through.
+    """
+    def __init__(
+        self,
+        application,
+        compress_level=6,
+        ):
+        self._application = application
+        self._compress_level = compress_level
+
+    def _compress(self, app_iter):
+        compressor = zlib.compressobj(
+            self._compress_level,
+            zlib.DEFLATED,
+            # Write a gzip header and trailer
+            16 + zlib.MAX_WBITS,
+            )
+        try:
+            for chunk in app_iter:
+                with metrics.timing('gzip'):
+                    data = compressor.compress(chunk)
+                    data += compressor.flush(zlib.Z_SYNC_FLUSH)
+                if data:
+                    yield data
+            with metrics.timing('gzip'):
+                data = compressor.flush()
+            yield data
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def __call__(self, environ, start_response):
+        if 'gzip' not in environ.get('HTTP_ACCEPT_ENCODING', ''):
+            return self._application(environ, start_response)
+
+        compress = []
+        def gzip_start_response(status, headers, exc_info=None):
+            content_type = header_value(headers, 'content-type')
+            content_encoding = header_value(headers, 'content-encoding')
+            if (
+                content_type
+                and
+                (content_type.startswith('text/')
+                 or
+                 content_type.startswith('application/')
+                 )
+                and
+                'zip' not in content_type
+                and not
+                content_encoding
+                and not
+                status.startswith(('204', '304'))
+                ):
+                compress.append(True)
+                remove_header(headers, 'content-length')
+                headers.append(('Content-Encoding', 'gzip'))
+                headers.append(('Vary', 'Accept-Encoding'))
+
+            return start_response(status, headers, exc_info)
+
+        app_iter = self._application(environ, gzip_start_response)
+        if compress:
+            return self._compress(app_iter)
+
+        return app_iter
+
+class CachedBody(object):
+    """
+    A response body together with its gzip-compressed version,
+    which is only computed the first time it is needed.
+    """
+    def __init__(
+        self,
+        body,
+        compress_level=6,
+        ):
+        self.body = body
+        self._compress_level = compress_level
+        self._gzipped = None
+        self._lock = threading.Lock()
+
+    @metrics.timed('gzip')
+    def gzipped(self):
+        with self._lock:
+            if self._gzipped is None:
+                compressor = zlib.compressobj(
+                    self._compress_level,
+                    zlib.DEFLATED,
+                    # Write a gzip header and trailer
+                    16 + zlib.MAX_WBITS,
+                    )
+                self._gzipped = (
+                    compressor.compress(self.body) + compressor.flush()
+                    )
+
+            return self._gzipped
+
 class APIServer(bottle.ServerAdapter):
+    """
+    Serves with paste's HTTP server. A pool of threads
+    handles requests unless workers is more than one, in which
+    case that many processes share the listening socket and
+    each handles requests with a thread per request.
+
+    on_worker_start and on_worker_exit are called in every
+    process that handles requests when it starts and exits.
+    """
     def run(self, handler):
         handler = APILogger(handler)
-        httpserver.serve(
+        options = dict(self.options)
+        workers = options.pop('workers', 1)
+        threads = options.pop('threads', 10)
+        keep_alive = options.pop('keep_alive', False)
+        on_worker_start = options.pop('on_worker_start', None)
+        on_worker_exit = options.pop('on_worker_exit', None)
+
+        # paste closes the connection after responses without
+        # a Content-Length so HTTP/1.1 is safe for streams
+        if keep_alive:
+            options['protocol_version'] = 'HTTP/1.1'
+
+        # Threads do not survive a fork so processes cannot
+        # share a thread pool created before forking
+        server = httpserver.serve(
             handler,
             host=self.host,
             port=str(self.port),
-            **self.options
+            use_threadpool=workers == 1,
+            threadpool_workers=threads,
+            start_loop=False,
+            **options
             )
 
-class APIHTTPError(bottle.HTTPError):
-    def __repr__(self):
-        return self.output
+        if workers == 1:
+            _serve_worker(
+                server,
+                on_worker_start=on_worker_start,
+                on_worker_exit=on_worker_exit,
+                )
+            return
+
+        _prefork(
+            server,
+            workers=workers,
+            on_worker_start=on_worker_start,
+            on_worker_exit=on_worker_exit,
+            )
+
+class GeventAPIServer(bottle.ServerAdapter):
+    """
+    Serves with gevent's WSGI server, handling at most
+    concurrency connections at a time. The gevent package is
+    required and the standard library should be monkey patched
+    before any connections are made.
+    """
+    def run(self, handler):
+        from gevent import pywsgi, pool
+
+        handler = APILogger(handler)
+        options = dict(self.options)
+        concurrency = options.pop('concurrency', 1000)
+        on_worker_start = options.pop('on_worker_start', None)
+        on_worker_exit = options.pop('on_worker_exit', None)
+
+        server = pywsgi.WSGIServer(
+            (self.host, int(self.port)),
+            handler,
+            spawn=pool.Pool(concurrency),
+            # APILogger logs requests
+            log=None,
+            **options
+            )
+        _serve_worker(
+            server,
+            on_worker_start=on_worker_start,
+            on_worker_exit=on_worker_exit,
+            )
+
+def _serve_worker(
+    server,
+    on_worker_start=None,
+    on_worker_exit=None,
+    ):
+    if on_worker_start is not None:
+        on_worker_start()
+    try:
+        server.serve_forever()
+    finally:
+        if on_worker_exit is not None:
+            on_worker_exit()
 
-def get_status(
-    code=200,
-    message='OK',
+def _exit(signum, frame):
+    sys.exit(0)
+
+def _prefork(
+    server,
+    workers,
+    on_worker_start=None,
+    on_worker_exit=None,
     ):
-    status = OrderedDict([
-            ('code', code),
-            ('message', message)
-            ])
-    res = OrderedDict([
-            ('status', status),
-            ])
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                _serve_worker(
+                    server,
+                    on_worker_start=on_worker_start,
+                    on_worker_exit=on_worker_exit,
+                    )
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            except Exception:
+                log.exception('Worker failed')
+                status = 1
+            # Never return to the parent's code
+            os._exit(status)
+
+        log.info(
+            'Started worker {pid}'.format(
+                pid=pid,
+                )
+            )
+        children.add(pid)
 
-    return res
+    signal.signal(signal.SIGTERM, _exit)
+    children = set()
+    try:
+        for i in xrange(workers):
+            spawn()
+        while True:
+            (pid, status) = os.wait()
+            children.discard(pid)
+            log.warn(
+                'Worker {pid} exited with status {status}. '
+                'Restarting...'.format(
+                    pid=pid,
+                    status=status,
+                    )
+                )
+            # Don't fork continuously if workers fail on start
+            time.sleep(1)
+            spawn()
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+class APIHTTPError(bottle.HTTPError):
+    def __repr__(self):
+        return self.output
 
 def _error(error):
     bottle.response.content_type = 'application/json'
@@ -101,7 +475,16 @@ def error_404(error):
 
     return _error(error)
 
-def send_error(code, message):
+def _opaque_tag(etag):
+    if etag.startswith('W/'):
+        return etag[2:]
+    return etag
+
+def send_error(
+    code,
+    message,
+    headers=None,
+    ):
     status = get_status(
         code=code,
         message=message,
@@ -111,8 +494,35 @@ def send_error(code, message):
     raise APIHTTPError(
         code=code,
         output=status,
+        header=headers,
         )
 
+def encode_cursor(event):
+    """
+    Return a token that resumes a paged request for all events
+    after event.
+    """
+    start_time = event['facebook']['start_time']
+    parts = [
+        list(start_time.timetuple()[:6]) + [start_time.microsecond],
+        event['_id'],
+        ]
+
+    return base64.urlsafe_b64encode(json.dumps(parts))
+
+def decode_cursor(cursor):
+    """
+    Return the start time and id of the event a token from
+    encode_cursor was made from.
+    """
+    try:
+        (start_time, _id) = json.loads(base64.urlsafe_b64decode(cursor))
+        start_time = datetime(*start_time)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+    return start_time, _id
+
 def check_version(fn):
     @functools.wraps(fn)
     def wrapper(*args, **kwargs):
@@ -130,9 +540,158 @@ class EventAPI01(object):
         self,
         keys_coll,
         events_coll,
+        meta_coll=None,
+        expired_coll=None,
+        cache_size=None,
+        cache_ttl=None,
+        generation_interval=5,
+        stream=False,
+        stream_chunk_size=64*1024,
+        snapshot_path=None,
+        snapshot_max_age=30*60,
+        key_cache_size=None,
+        key_cache_ttl=None,
+        key_flush_interval=None,
+        rate_limit=None,
+        rate_burst=None,
+        rate_limit_coll=None,
+        msgpack=False,
+        expose_metrics=False,
+        changes_margin=60,
+        _time=None,
+        ):
+        """
+        Responses are cached in memory when cache_size is given.
+        Cached responses expire after cache_ttl seconds or as soon
+        as the events generation in meta_coll changes. The
+        generation is read at most every generation_interval
+        seconds.
+
+        When stream is True the full dump is encoded and sent
+        in chunks while the events are read from the database.
+
+        When snapshot_path is given, unfiltered requests for all
+        events are answered with the gzip-compressed snapshot
+        event-location writes there, as long as it was written
+        today and less than snapshot_max_age seconds ago.
+
+        API keys are cached in memory for key_cache_ttl seconds
+        when key_cache_size is given. Hosts without a valid key
+        are cached too. When key_flush_interval is given, key
+        usage is counted in memory and written to keys_coll by
+        flush_key_usage, which start_key_flusher calls every
+        key_flush_interval seconds.
+
+        Each host can make rate_limit requests per second and
+        bursts of up to rate_burst requests, unless its key in
+        keys_coll has its own rate_limit and rate_burst. Other
+        requests get a 429 before any events are read. Hosts are
+        not limited when neither gives a rate_limit. The token
+        buckets are kept in memory, or in rate_limit_coll, when
+        given, so that every process shares them.
+
+        When meta_coll is given, responses for all events and for
+        a single coordinate have an ETag and a Last-Modified
+        header. The ETag changes with the events generation and,
+        for the responses which leave out the events that ended
+        before today, with the day. Requests with a matching
+        If-None-Match get a 304. Responses for events happening
+        now change whenever one starts or ends so they have
+        neither header.
+
+        Requests for changes list the ids of the events moved to
+        expired_coll, when given, since the requested time. The
+        next since they return is changes_margin seconds before
+        the request so that changes stamped just before they were
+        written, or by a host whose clock is behind, are sent
+        again instead of missed.
+
+        When msgpack is True, requests which accept msgpack_type
+        get responses with events encoded with MessagePack, in the
+        form compact_results returns, instead of JSON. The msgpack
+        package is required. Snapshots and streams are JSON only.
+
+        When expose_metrics is True, /metrics returns the
+        histograms of metrics.registry in Prometheus' text format.
+        """
+        if _time is None:
+            _time = time.time
+
+        self._generation_interval = generation_interval
+        self._stream = stream
+        self._stream_chunk_size = stream_chunk_size
+        self._snapshot_path = snapshot_path
+        self._snapshot_max_age = snapshot_max_age
+        self._msgpack = msgpack
+        self._expose_metrics = expose_metrics
+        self._changes_margin = changes_margin
+        self._time = _time
+
+        # Responses depend on the Accept header only when they can
+        # be encoded with MessagePack
+        self._vary = 'Accept-Encoding'
+        if msgpack:
+            self._vary = 'Accept, Accept-Encoding'
+
+        self._cache = None
+        if cache_size is not None:
+            self._cache = LRUCache(
+                size=cache_size,
+                ttl=cache_ttl,
+                _time=_time,
+                )
+        self._generation = None
+        self._generation_modified = None
+        self._generation_checked = None
+
+        self._key_cache = None
+        if key_cache_size is not None:
+            self._key_cache = LRUCache(
+                size=key_cache_size,
+                ttl=key_cache_ttl,
+                _time=_time,
+                )
+        self._key_flush_interval = key_flush_interval
+        self._key_usage = OrderedDict()
+        self._key_usage_lock = threading.Lock()
+
+        self._rate_limit = rate_limit
+        self._rate_burst = rate_burst
+        self._rate_buckets = TokenBuckets(
+            size=key_cache_size or 1024,
+            _time=_time,
+            )
+
+        self.set_collections(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            meta_coll=meta_coll,
+            expired_coll=expired_coll,
+            rate_limit_coll=rate_limit_coll,
+            )
+
+    def set_collections(
+        self,
+        keys_coll,
+        events_coll,
+        meta_coll=None,
+        expired_coll=None,
+        rate_limit_coll=None,
         ):
+        """
+        Use these collections from now on. PyMongo connections
+        cannot be shared across a fork so each worker of a prefork
+        server sets collections from its own connection.
+        """
         self._keys_coll = keys_coll
         self._events_coll = events_coll
+        self._meta_coll = meta_coll
+        self._expired_coll = expired_coll
+        if rate_limit_coll is not None:
+            self._rate_buckets = MongoTokenBuckets(
+                collection=rate_limit_coll,
+                _time=self._time,
+                )
 
     def apply(self, callback, context):
         """
@@ -147,6 +706,7 @@ class EventAPI01(object):
             return callback(*args, **kwargs)
         return wrapper
 
+    @metrics.timed('key')
     def _check_and_get_key(
         self,
         _request=None,
@@ -163,33 +723,86 @@ class EventAPI01(object):
                 message='You must specify an API key',
                 )
 
-        message = 'Invalid API key'
         host = _request.environ.get('REMOTE_ADDR')
-        db_key = self._keys_coll.find_one(host)
-        if db_key is None:
+        if self._key_cache is None:
+            (expected, limit) = self._expected_key(host)
+        else:
+            cached = self._key_cache.get(host, _not_cached)
+            if cached is _not_cached:
+                cached = self._expected_key(host)
+                self._key_cache.set(host, cached)
+            (expected, limit) = cached
+
+        if expected is None or key != expected:
             send_error(
                 code=400,
-                message=message,
+                message='Invalid API key',
                 )
 
+        if limit is not None:
+            self._check_rate_limit(host, limit)
+
+        return host
+
+    def _expected_key(
+        self,
+        host,
+        ):
+        """
+        The key host must use, or None if host does not have
+        a usable key, and its rate limit as (rate, burst), or
+        None if it is not limited.
+        """
+        db_key = self._keys_coll.find_one(host)
+        if db_key is None:
+            return (None, None)
+
         if db_key['disabled'] is True:
-            send_error(
-                code=400,
-                message=message,
-                )
+            return (None, None)
 
         _hash = hashlib.sha256()
         _hash.update(host)
         _hash.update(db_key['secret'])
-        _hash = _hash.hexdigest()
 
-        if key != _hash:
-            send_error(
-                code=400,
-                message=message,
+        rate = db_key.get('rate_limit', self._rate_limit)
+        if rate is None:
+            return (_hash.hexdigest(), None)
+        burst = db_key.get('rate_burst', self._rate_burst)
+        if burst is None:
+            burst = max(rate, 1)
+
+        return (_hash.hexdigest(), (rate, burst))
+
+    def _check_rate_limit(
+        self,
+        host,
+        limit,
+        ):
+        (rate, burst) = limit
+        try:
+            wait = self._rate_buckets.take(
+                key=host,
+                rate=rate,
+                burst=burst,
+                )
+        except pymongo.errors.PyMongoError, e:
+            # Better to serve too many requests than none
+            log.error(
+                'Could not check the rate limit of {host}: {error}'.format(
+                    host=host,
+                    error=str(e),
+                    )
                 )
+            return
 
-        return host
+        if wait > 0:
+            send_error(
+                code=429,
+                message='Rate limit exceeded',
+                headers=OrderedDict([
+                        ('Retry-After', str(int(math.ceil(wait)))),
+                        ]),
+                )
 
     def _check_and_get_until(
         self,
@@ -219,163 +832,1119 @@ class EventAPI01(object):
 
         return None
 
-    def _update_key(
+    def _check_and_get_time_filters(
         self,
-        key,
         now,
+        _request=None,
         ):
-        self._keys_coll.update(
-            OrderedDict([
-                    ('_id', key),
-                    ]),
-            OrderedDict([
-                    ('$set', OrderedDict([
-                                ('last_used', now),
-                                ])
-                     ),
-                    ('$inc', OrderedDict([
-                                ('times_used', 1),
-                                ])
-                     ),
-                    ]),
-            )
+        """
+        Return the query parts for the from, max_duration and
+        happening_now parameters given in the request.
+        """
+        if _request is None:
+            _request = bottle.request
 
-    def _get_results_by_coord(
+        query = _request.query
+        parts = []
+
+        # Events which have not ended by then
+        _from = getattr(query, 'from')
+        if _from != '':
+            try:
+                _from = util.utc_from_iso8601(_from)
+                _from = util.utc_to_local(_from, naive=True)
+            except ValueError:
+                send_error(
+                    code=400,
+                    message='Invalid from parameter value',
+                    )
+            parts.append(
+                OrderedDict([
+                        ('facebook.end_time', OrderedDict([
+                                    ('$gt', _from),
+                                    ]),
+                         ),
+                        ])
+                )
+
+        max_duration = query.max_duration
+        if max_duration != '':
+            try:
+                max_duration = int(max_duration)
+            except ValueError:
+                max_duration = None
+            if max_duration is None or max_duration <= 0:
+                send_error(
+                    code=400,
+                    message='Invalid max_duration parameter value',
+                    )
+            parts.append(
+                OrderedDict([
+                        ('ubernear.duration_seconds', OrderedDict([
+                                    ('$lte', max_duration),
+                                    ]),
+                         ),
+                        ])
+                )
+
+        happening_now = query.happening_now
+        if happening_now not in ['', 'true', 'false']:
+            send_error(
+                code=400,
+                message='Invalid happening_now parameter value',
+                )
+        if happening_now == 'true':
+            parts.append(
+                OrderedDict([
+                        ('facebook.start_time', OrderedDict([
+                                    ('$lte', now),
+                                    ]),
+                         ),
+                        ])
+                )
+            parts.append(
+                OrderedDict([
+                        ('facebook.end_time', OrderedDict([
+                                    ('$gt', now),
+                                    ]),
+                         ),
+                        ])
+                )
+
+        return parts
+
+    def _get_generation(self):
+        if self._meta_coll is None:
+            return None
+
+        now = self._time()
+        if (
+            self._generation_checked is None
+            or
+            now - self._generation_checked >= self._generation_interval
+            ):
+            (self._generation, self._generation_modified) = (
+                mongo.get_generation_info(
+                    self._meta_coll,
+                    name=generation_id,
+                    )
+                )
+            self._generation_checked = now
+
+        return self._generation
+
+    def _check_not_modified(
         self,
-        events,
-        now,
-        details=False,
+        fmt='json',
+        today=None,
+        _request=None,
+        _response=None,
         ):
-        grouped = DefaultOrderedDict(list)
-        places = OrderedDict()
-        event_count = 0
-        for event in events:
-            facebook = event['facebook']
-            if facebook['end_time'] < now:
-                continue
-
-            place = event['match']['place']
-            place_id = event['match']['ubernear']['place_id']
-            name = place['name']
-
-            # Events could have the same _id but different
-            # names since the name stored was the one given
-            # by facebook
-            api_place_id = hashlib.md5()
-            api_place_id.update(place_id)
-            api_place_id.update(name.encode('utf-8'))
-            api_place_id = api_place_id.hexdigest()
-            places[api_place_id] = place
-
-            link = '{facebook_events_url}/{_id}'.format(
-                facebook_events_url=facebook_events_url,
-                _id=facebook['id'],
-                )
-
-            api_event = OrderedDict([
-                    ('id', facebook['id']),
-                    ])
-            if details is True:
-                api_event['event_link'] = link
-                api_event['name'] = facebook['name']
-                api_event['start_time'] = facebook['start_time']
-                api_event['end_time'] = facebook['end_time']
-                api_event['place_id'] = api_place_id
-
-                description = facebook.get('description', None)
-                if description:
-                    api_event['description'] = description
-
-            loc = event['match']['ubernear']['location']
-            (lng, lat) = loc
-            # Does not lose precision
-            lat = json.dumps(lat)
-            lng = json.dumps(lng)
-
-            api_loc = '{lat},{lng}'.format(lat=lat, lng=lng)
-            grouped[api_loc].append(api_event)
-            event_count += 1
-
-        status = get_status()
-        count = OrderedDict([
-                ('events', event_count),
-                ('places', len(places)),
-                ('coordinates', len(grouped.keys())),
-                ])
-        data = OrderedDict([
-                ('events', grouped),
-                ])
-        if details is True:
-            data['places'] = places
+        """
+        Set the ETag and Last-Modified headers and return whether
+        the client already has the response in the given format.
+        Responses for the events which have not ended by today
+        also change with the day.
+        """
+        if _request is None:
+            _request = bottle.request
+        if _response is None:
+            _response = bottle.response
 
-        status['count'] = count
-        status['data'] = data
+        generation = self._get_generation()
+        if generation is None:
+            return False
+        if _request.query.happening_now == 'true':
+            return False
 
-        results = json.dumps(
-            status,
-            default=datetime.isoformat,
-            )
+        etag = '{generation}'.format(generation=generation)
+        last_modified = None
+        if today is not None:
+            etag = '{etag}-{today}'.format(
+                etag=etag,
+                today=today.strftime('%Y%m%d'),
+                )
+            # Events are in local time
+            last_modified = time.mktime(today.timetuple())
+        if fmt != 'json':
+            etag = '{etag}-{fmt}'.format(
+                etag=etag,
+                fmt=fmt,
+                )
+        # Weak since GzipMiddleware compresses the same response
+        # into different bytes
+        etag = 'W/"{etag}"'.format(etag=etag)
+        if self._generation_modified is not None:
+            modified = calendar.timegm(
+                self._generation_modified.utctimetuple(),
+                )
+            if last_modified is None or modified > last_modified:
+                last_modified = modified
+        _response.set_header('ETag', etag)
+        if last_modified is not None:
+            _response.set_header(
+                'Last-Modified',
+                formatdate(last_modified, usegmt=True),
+                )
 
-        return results
+        if_none_match = _request.environ.get('HTTP_IF_NONE_MATCH', '')
+        # If-None-Match uses the weak comparison
+        etags = [
+            _opaque_tag(tag.strip())
+            for tag in if_none_match.split(',')
+            ]
+        if _opaque_tag(etag) in etags or '*' in etags:
+            _response.status = 304
+            return True
 
-    def _all(
+        return False
+
+    def _check_and_get_format(
         self,
-        _datetime=None,
         _request=None,
+        _response=None,
         ):
-        if _datetime is None:
-            _datetime = datetime
+        if not self._msgpack:
+            return 'json'
 
-        key = self._check_and_get_key(_request=_request)
-        # TODO. Use Los Angeles local time until the timezone
-        # is included in each event's data
-        now = _datetime.now()
+        if _request is None:
+            _request = bottle.request
+        if _response is None:
+            _response = bottle.response
 
-        # Allow mongodb to cache requests for today
-        today = now.replace(hour=0,minute=0,second=0,microsecond=0)
+        _response.set_header('Vary', 'Accept')
+        accept = _request.environ.get('HTTP_ACCEPT', '')
+        if msgpack_type in accept:
+            _response.content_type = msgpack_type
+            return 'msgpack'
 
-        match = OrderedDict([
-                ('match', OrderedDict([
-                            ('$exists', True),
-                            ]),
-                 ),
-                ])
-        end_time = OrderedDict([
-                ('facebook.end_time', OrderedDict([
-                            ('$gt', today),
-                            ]),
-                 ),
-                ])
-        and_parts = [match, end_time]
+        return 'json'
 
-        start_time = self._check_and_get_until(_request=_request)
-        if start_time is not None:
-            and_parts.append(start_time)
+    @metrics.timed('encode')
+    def _dumps(
+        self,
+        status,
+        fmt='json',
+        ):
+        count = status.get('count')
+        if count is not None:
+            metrics.add_count('events', count['events'])
 
-        events = self._events_coll.find(
-            OrderedDict([
-                    ('$and', and_parts)
-                    ]),
-            sort=[('facebook.start_time', pymongo.ASCENDING)],
-            )
+        if fmt == 'msgpack':
+            import msgpack
+            return msgpack.packb(compact_results(status))
 
-        results = self._get_results_by_coord(
-            events=events,
-            now=now,
+        return json.dumps(
+            status,
+            default=datetime.isoformat,
             )
-        self._update_key(
+
+    def _check_and_get_since(
+        self,
+        _request=None,
+        ):
+        if _request is None:
+            _request = bottle.request
+
+        since = _request.query.since
+        try:
+            since = util.utc_from_iso8601(since, naive=True)
+        except ValueError:
+            send_error(
+                code=400,
+                message='Invalid since parameter value',
+                )
+
+        return since
+
+    def _check_and_get_page(
+        self,
+        _request=None,
+        ):
+        """
+        Return the page size and the start time and id of the
+        event the page starts after, if any. The page size is None
+        if the request is not paged.
+        """
+        if _request is None:
+            _request = bottle.request
+
+        query = _request.query
+        limit = query.limit
+        cursor = query.cursor
+        if limit == '' and cursor == '':
+            return None, None
+
+        if limit == '':
+            limit = default_page_limit
+        else:
+            try:
+                limit = int(limit)
+            except ValueError:
+                limit = None
+            if limit is None or limit <= 0 or limit > max_page_limit:
+                send_error(
+                    code=400,
+                    message='Invalid limit parameter value',
+                    )
+
+        after = None
+        if cursor != '':
+            try:
+                after = decode_cursor(str(cursor))
+            except ValueError:
+                send_error(
+                    code=400,
+                    message='Invalid cursor parameter value',
+                    )
+
+        return limit, after
+
+    def _check_and_get_near_options(
+        self,
+        _request=None,
+        ):
+        if _request is None:
+            _request = bottle.request
+
+        query = _request.query
+        radius = query.radius
+        if radius == '':
+            radius = default_near_radius
+        else:
+            try:
+                radius = float(radius)
+            except ValueError:
+                radius = None
+            if radius is None or radius <= 0 or radius > max_near_radius:
+                send_error(
+                    code=400,
+                    message='Invalid radius parameter value',
+                    )
+
+        limit = query.limit
+        if limit == '':
+            limit = default_near_limit
+        else:
+            try:
+                limit = int(limit)
+            except ValueError:
+                limit = None
+            if limit is None or limit <= 0 or limit > max_near_limit:
+                send_error(
+                    code=400,
+                    message='Invalid limit parameter value',
+                    )
+
+        return radius, limit
+
+    def _check_and_get_search_options(
+        self,
+        _request=None,
+        ):
+        if _request is None:
+            _request = bottle.request
+
+        query = _request.query
+        tokens = search_tokens(query.q)
+        if not tokens:
+            send_error(
+                code=400,
+                message='Invalid q parameter value',
+                )
+
+        limit = query.limit
+        if limit == '':
+            limit = default_search_limit
+        else:
+            try:
+                limit = int(limit)
+            except ValueError:
+                limit = None
+            if limit is None or limit <= 0 or limit > max_search_limit:
+                send_error(
+                    code=400,
+                    message='Invalid limit parameter value',
+                    )
+
+        return tokens, limit
+
+    @metrics.timed('update_key')
+    def _update_key(
+        self,
+        key,
+        now,
+        ):
+        if self._key_flush_interval is not None:
+            with self._key_usage_lock:
+                (times_used, last_used) = self._key_usage.get(key, (0, now))
+                self._key_usage[key] = (times_used + 1, max(last_used, now))
+            return
+
+        # Requests do not wait for the write
+        self._save_key_usage(
+            key=key,
+            times_used=1,
+            last_used=now,
+            safe=False,
+            )
+
+    def _save_key_usage(
+        self,
+        key,
+        times_used,
+        last_used,
+        safe,
+        ):
+        self._keys_coll.update(
+            OrderedDict([
+                    ('_id', key),
+                    ]),
+            OrderedDict([
+                    ('$set', OrderedDict([
+                                ('last_used', last_used),
+                                ])
+                     ),
+                    ('$inc', OrderedDict([
+                                ('times_used', times_used),
+                                ])
+                     ),
+                    ]),
+            safe=safe,
+            )
+
+    def flush_key_usage(self):
+        with self._key_usage_lock:
+            usage = self._key_usage
+            self._key_usage = OrderedDict()
+
+        for key, (times_used, last_used) in usage.iteritems():
+            try:
+                # Only acknowledged writes raise when they fail
+                self._save_key_usage(
+                    key=key,
+                    times_used=times_used,
+                    last_used=last_used,
+                    safe=True,
+                    )
+            except pymongo.errors.PyMongoError, e:
+                log.error(
+                    'Could not save usage of key {key}: {error}'.format(
+                        key=key,
+                        error=str(e),
+                        )
+                    )
+                # Keep the usage for the next flush
+                with self._key_usage_lock:
+                    (times, last) = self._key_usage.get(key, (0, last_used))
+                    self._key_usage[key] = (
+                        times + times_used,
+                        max(last, last_used),
+                        )
+
+    def start_key_flusher(self):
+        def flusher():
+            while True:
+                time.sleep(self._key_flush_interval)
+                try:
+                    self.flush_key_usage()
+                except Exception:
+                    log.exception('Could not flush key usage')
+
+        thread = threading.Thread(target=flusher, name='key-flusher')
+        thread.daemon = True
+        thread.start()
+
+        return thread
+
+    def _find(
+        self,
+        spec,
+        **kwargs
+        ):
+        """
+        Like events_coll.find but the time spent reading the
+        events and their number are recorded in the request's
+        metrics.
+        """
+        with metrics.timing('mongo'):
+            cursor = self._events_coll.find(spec, **kwargs)
+
+        return metrics.timed_iter(
+            cursor,
+            phase='mongo',
+            count='documents_returned',
+            )
+
+    def _get_results_by_coord(
+        self,
+        events,
+        now,
+        details=False,
+        fmt='json',
+        ):
+        status = group_by_coord(
+            events=events,
+            now=now,
+            details=details,
+            )
+
+        return self._dumps(status, fmt=fmt)
+
+    def _iter_results_by_coord(
+        self,
+        events,
+        now,
+        details=False,
+        ):
+        """
+        Same document as _get_results_by_coord but encoded
+        incrementally, in chunks of about stream_chunk_size
+        bytes, while events are read.
+        """
+        pieces = iter_json_pieces(
+            events=events,
+            now=now,
+            details=details,
+            )
+
+        return iter_chunks(
+            pieces=pieces,
+            chunk_size=self._stream_chunk_size,
+            )
+
+    def _cache_chunks(
+        self,
+        cache_key,
+        chunks,
+        ):
+        body = []
+        for chunk in chunks:
+            body.append(chunk)
+            yield chunk
+
+        self._cache.set(cache_key, CachedBody(''.join(body)))
+
+    def _send_cached(
+        self,
+        cached,
+        _request=None,
+        _response=None,
+        ):
+        if _request is None:
+            _request = bottle.request
+        if _response is None:
+            _response = bottle.response
+
+        accept_encoding = _request.environ.get('HTTP_ACCEPT_ENCODING', '')
+        if 'gzip' not in accept_encoding:
+            return cached.body
+
+        # GzipMiddleware leaves encoded responses alone
+        _response.set_header('Content-Encoding', 'gzip')
+        _response.set_header('Vary', self._vary)
+
+        return cached.gzipped()
+
+    def _iter_file(
+        self,
+        fp,
+        ):
+        try:
+            while True:
+                chunk = fp.read(self._stream_chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            fp.close()
+
+    def _open_snapshot(
+        self,
+        today,
+        _request=None,
+        _response=None,
+        ):
+        if _request is None:
+            _request = bottle.request
+        if _response is None:
+            _response = bottle.response
+
+        try:
+            fp = open(self._snapshot_path, 'rb')
+        except IOError, e:
+            log.debug(
+                'Could not open snapshot: {error}'.format(
+                    error=str(e),
+                    )
+                )
+            return None
+
+        stat = os.fstat(fp.fileno())
+        if (
+            datetime.fromtimestamp(stat.st_mtime) < today
+            or
+            self._time() - stat.st_mtime >= self._snapshot_max_age
+            ):
+            log.debug('Snapshot is stale')
+            fp.close()
+            return None
+
+        accept_encoding = _request.environ.get('HTTP_ACCEPT_ENCODING', '')
+        if 'gzip' not in accept_encoding:
+            # Not a file since its fileno is the compressed file's
+            return self._iter_file(
+                gzip.GzipFile(
+                    filename='',
+                    mode='rb',
+                    fileobj=fp,
+                    ),
+                )
+
+        # The file is sent as it is on disk, in chunks or with the
+        # server's wsgi.file_wrapper when it has one
+        _response.set_header('Content-Encoding', 'gzip')
+        _response.set_header('Vary', self._vary)
+        _response.set_header('Content-Length', str(stat.st_size))
+
+        return fp
+
+    def _all(
+        self,
+        _datetime=None,
+        _request=None,
+        _response=None,
+        ):
+        if _datetime is None:
+            _datetime = datetime
+
+        key = self._check_and_get_key(_request=_request)
+        # TODO. Use Los Angeles local time until the timezone
+        # is included in each event's data
+        now = _datetime.now()
+
+        # Allow mongodb to cache requests for today
+        today = now.replace(hour=0,minute=0,second=0,microsecond=0)
+
+        and_parts = live_query_parts(today)
+
+        start_time = self._check_and_get_until(_request=_request)
+        if start_time is not None:
+            and_parts.append(start_time)
+        time_filters = self._check_and_get_time_filters(
+            now=now,
+            _request=_request,
+            )
+        and_parts += time_filters
+        (limit, after) = self._check_and_get_page(_request=_request)
+        fmt = self._check_and_get_format(
+            _request=_request,
+            _response=_response,
+            )
+
+        not_modified = self._check_not_modified(
+            fmt=fmt,
+            today=today,
+            _request=_request,
+            _response=_response,
+            )
+        if not_modified:
+            self._update_key(
+                key=key,
+                now=now,
+                )
+            return ''
+
+        if limit is not None:
+            results = self._page(
+                and_parts=and_parts,
+                limit=limit,
+                after=after,
+                now=now,
+                fmt=fmt,
+                )
+            self._update_key(
+                key=key,
+                now=now,
+                )
+            return results
+
+        if (
+            self._snapshot_path is not None
+            and
+            start_time is None
+            and
+            not time_filters
+            and
+            fmt == 'json'
+            ):
+            snapshot = self._open_snapshot(
+                today=today,
+                _request=_request,
+                _response=_response,
+                )
+            if snapshot is not None:
+                self._update_key(
+                    key=key,
+                    now=now,
+                    )
+                return snapshot
+
+        cache_key = None
+        # Responses filtered by time are not cached since
+        # happening_now depends on the current time
+        if self._cache is not None and not time_filters:
+            until = None
+            if start_time is not None:
+                until = start_time['facebook.start_time']['$lte']
+            cache_key = (self._get_generation(), today, until, fmt)
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                self._update_key(
+                    key=key,
+                    now=now,
+                    )
+                return self._send_cached(
+                    cached,
+                    _request=_request,
+                    _response=_response,
+                    )
+
+        if self._stream and fmt == 'json':
+            events = self._find(
+                OrderedDict([
+                        ('$and', and_parts)
+                        ]),
+                sort=coord_sort,
+                fields=summary_fields,
+                )
+            results = self._iter_results_by_coord(
+                events=events,
+                now=now,
+                )
+            if cache_key is not None:
+                results = self._cache_chunks(
+                    cache_key=cache_key,
+                    chunks=results,
+                    )
+            self._update_key(
+                key=key,
+                now=now,
+                )
+
+            return results
+
+        events = self._find(
+            OrderedDict([
+                    ('$and', and_parts)
+                    ]),
+            sort=[('facebook.start_time', pymongo.ASCENDING)],
+            fields=summary_fields,
+            )
+
+        results = self._get_results_by_coord(
+            events=events,
+            now=now,
+            fmt=fmt,
+            )
+        self._update_key(
+            key=key,
+            now=now,
+            )
+        if cache_key is not None:
+            cached = CachedBody(results)
+            self._cache.set(cache_key, cached)
+            return self._send_cached(
+                cached,
+                _request=_request,
+                _response=_response,
+                )
+
+        return results
+
+    def _page(
+        self,
+        and_parts,
+        limit,
+        after,
+        now,
+        fmt='json',
+        ):
+        """
+        Return at most limit events sorted by start time and id,
+        starting after the given start time and id, and the cursor
+        for the next page or None if this is the last page.
+        """
+        and_parts = list(and_parts)
+        if after is not None:
+            (start_time, _id) = after
+            later = OrderedDict([
+                    ('facebook.start_time', OrderedDict([
+                                ('$gt', start_time),
+                                ]),
+                     ),
+                    ])
+            same_time = OrderedDict([
+                    ('facebook.start_time', start_time),
+                    ('_id', OrderedDict([
+                                ('$gt', _id),
+                                ]),
+                     ),
+                    ])
+            and_parts.append(
+                OrderedDict([
+                        ('$or', [later, same_time]),
+                        ])
+                )
+
+        events = self._find(
+            OrderedDict([
+                    ('$and', and_parts)
+                    ]),
+            sort=[
+                ('facebook.start_time', pymongo.ASCENDING),
+                ('_id', pymongo.ASCENDING),
+                ],
+            # The cursor needs the start time
+            fields=summary_fields + ['facebook.start_time'],
+            limit=limit,
+            )
+        # Expired events are left out of the results but still
+        # count towards the page
+        events = list(events)
+
+        status = group_by_coord(
+            events=events,
+            now=now,
+            )
+        cursor = None
+        if len(events) == limit:
+            cursor = encode_cursor(events[-1])
+        status['paging'] = OrderedDict([
+                ('cursor', cursor),
+                ])
+
+        return self._dumps(status, fmt=fmt)
+
+    def _single_coord(
+        self,
+        lat,
+        lng,
+        _datetime=None,
+        _request=None,
+        _response=None,
+        ):
+        if _datetime is None:
+            _datetime = datetime
+
+        try:
+            lng = float(lng)
+            lat = float(lat)
+        except ValueError:
+            send_error(
+                code=400,
+                message='Invalid coordinates',
+                )
+
+        key = self._check_and_get_key(_request=_request)
+        location = OrderedDict([
+                ('match.ubernear.location', [lng,lat])
+                ])
+        and_parts = [location]
+
+        start_time = self._check_and_get_until(_request=_request)
+        if start_time is not None:
+            and_parts.append(start_time)
+
+        fmt = self._check_and_get_format(
+            _request=_request,
+            _response=_response,
+            )
+        # TODO. Use Los Angeles local time until the timezone
+        # is included in each event's data
+        now = _datetime.now()
+        and_parts += self._check_and_get_time_filters(
+            now=now,
+            _request=_request,
+            )
+
+        not_modified = self._check_not_modified(
+            fmt=fmt,
+            _request=_request,
+            _response=_response,
+            )
+        if not_modified:
+            self._update_key(
+                key=key,
+                now=now,
+                )
+            return ''
+
+        events = self._find(
+            OrderedDict([
+                    ('$and', and_parts)
+                    ]),
+            sort=[('facebook.start_time', pymongo.ASCENDING)],
+            fields=details_fields,
+            )
+
+        results = self._get_results_by_coord(
+            events=events,
+            now=now,
+            details=True,
+            fmt=fmt,
+            )
+        self._update_key(
             key=key,
             now=now,
             )
 
         return results
 
-    def _single_coord(
+    def _tile(
+        self,
+        zoom,
+        x,
+        y,
+        _datetime=None,
+        _request=None,
+        _response=None,
+        ):
+        if _datetime is None:
+            _datetime = datetime
+
+        try:
+            zoom = int(zoom)
+            x = int(x)
+            y = int(y)
+        except ValueError:
+            send_error(
+                code=400,
+                message='Invalid tile',
+                )
+        size = 2 ** min(max(zoom, 0), quadkey_zoom)
+        if (
+            zoom < 0 or zoom > quadkey_zoom
+            or x < 0 or x >= size
+            or y < 0 or y >= size
+            ):
+            send_error(
+                code=400,
+                message='Invalid tile',
+                )
+
+        key = self._check_and_get_key(_request=_request)
+        fmt = self._check_and_get_format(
+            _request=_request,
+            _response=_response,
+            )
+        # TODO. Use Los Angeles local time until the timezone
+        # is included in each event's data
+        now = _datetime.now()
+
+        # Allow mongodb to cache requests for today
+        today = now.replace(hour=0,minute=0,second=0,microsecond=0)
+
+        and_parts = live_query_parts(today)
+        # Anchored prefixes are read from the index
+        and_parts.append(
+            OrderedDict([
+                    ('match.ubernear.quadkey', OrderedDict([
+                                ('$regex', '^{prefix}'.format(
+                                        prefix=tile_quadkey(x, y, zoom),
+                                        ),
+                                 ),
+                                ]),
+                     ),
+                    ])
+            )
+        start_time = self._check_and_get_until(_request=_request)
+        if start_time is not None:
+            and_parts.append(start_time)
+        time_filters = self._check_and_get_time_filters(
+            now=now,
+            _request=_request,
+            )
+        and_parts += time_filters
+
+        not_modified = self._check_not_modified(
+            fmt=fmt,
+            today=today,
+            _request=_request,
+            _response=_response,
+            )
+        if not_modified:
+            self._update_key(
+                key=key,
+                now=now,
+                )
+            return ''
+
+        cache_key = None
+        if (
+            self._cache is not None
+            and
+            start_time is None
+            and not
+            time_filters
+            ):
+            cache_key = (
+                self._get_generation(),
+                today,
+                'tile',
+                zoom,
+                x,
+                y,
+                fmt,
+                )
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                self._update_key(
+                    key=key,
+                    now=now,
+                    )
+                return self._send_cached(
+                    cached,
+                    _request=_request,
+                    _response=_response,
+                    )
+
+        # Sorting would have to be done in memory by the database
+        events = self._find(
+            OrderedDict([
+                    ('$and', and_parts)
+                    ]),
+            fields=tile_fields,
+            )
+        status = group_by_tile(
+            events=events,
+            now=now,
+            zoom=zoom,
+            depth=tile_cluster_depth,
+            top_events=tile_top_events,
+            )
+
+        results = self._dumps(status, fmt=fmt)
+        self._update_key(
+            key=key,
+            now=now,
+            )
+        if cache_key is not None:
+            cached = CachedBody(results)
+            self._cache.set(cache_key, cached)
+            return self._send_cached(
+                cached,
+                _request=_request,
+                _response=_response,
+                )
+
+        return results
+
+    def _box(
+        self,
+        sw_lat,
+        sw_lng,
+        ne_lat,
+        ne_lng,
+        _datetime=None,
+        _request=None,
+        _response=None,
+        ):
+        if _datetime is None:
+            _datetime = datetime
+
+        try:
+            sw_lat = float(sw_lat)
+            sw_lng = float(sw_lng)
+            ne_lat = float(ne_lat)
+            ne_lng = float(ne_lng)
+        except ValueError:
+            send_error(
+                code=400,
+                message='Invalid coordinates',
+                )
+
+        # Boxes crossing the 180th meridian are not supported by
+        # MongoDB's $box
+        if (
+            sw_lat > ne_lat
+            or sw_lng > ne_lng
+            or sw_lat < -90 or ne_lat > 90
+            or sw_lng < -180 or ne_lng > 180
+            ):
+            send_error(
+                code=400,
+                message='Invalid box',
+                )
+
+        key = self._check_and_get_key(_request=_request)
+        fmt = self._check_and_get_format(
+            _request=_request,
+            _response=_response,
+            )
+        # TODO. Use Los Angeles local time until the timezone
+        # is included in each event's data
+        now = _datetime.now()
+
+        # Allow mongodb to cache requests for today
+        today = now.replace(hour=0,minute=0,second=0,microsecond=0)
+
+        # Coordinates are always stored in the form [lng,lat]
+        location = OrderedDict([
+                ('match.ubernear.location', OrderedDict([
+                            ('$within', OrderedDict([
+                                        ('$box', [
+                                                [sw_lng, sw_lat],
+                                                [ne_lng, ne_lat],
+                                                ]),
+                                        ]),
+                             ),
+                            ]),
+                 ),
+                ])
+        end_time = OrderedDict([
+                ('facebook.end_time', OrderedDict([
+                            ('$gt', today),
+                            ]),
+                 ),
+                ])
+        and_parts = [location, end_time]
+
+        start_time = self._check_and_get_until(_request=_request)
+        if start_time is not None:
+            and_parts.append(start_time)
+        and_parts += self._check_and_get_time_filters(
+            now=now,
+            _request=_request,
+            )
+
+        events = self._find(
+            OrderedDict([
+                    ('$and', and_parts)
+                    ]),
+            sort=[('facebook.start_time', pymongo.ASCENDING)],
+            fields=summary_fields,
+            )
+
+        results = self._get_results_by_coord(
+            events=events,
+            now=now,
+            fmt=fmt,
+            )
+        self._update_key(
+            key=key,
+            now=now,
+            )
+
+        return results
+
+    def _near(
         self,
         lat,
         lng,
         _datetime=None,
         _request=None,
+        _response=None,
         ):
         if _datetime is None:
             _datetime = datetime
@@ -390,29 +1959,248 @@ class EventAPI01(object):
                 )
 
         key = self._check_and_get_key(_request=_request)
-        location = OrderedDict([
-                ('match.ubernear.location', [lng,lat])
+        (radius, limit) = self._check_and_get_near_options(
+            _request=_request,
+            )
+        fmt = self._check_and_get_format(
+            _request=_request,
+            _response=_response,
+            )
+        # TODO. Use Los Angeles local time until the timezone
+        # is included in each event's data
+        now = _datetime.now()
+
+        # Allow mongodb to cache requests for today
+        today = now.replace(hour=0,minute=0,second=0,microsecond=0)
+
+        end_time = OrderedDict([
+                ('facebook.end_time', OrderedDict([
+                            ('$gt', today),
+                            ]),
+                 ),
                 ])
-        and_parts = [location]
+        and_parts = [end_time]
 
         start_time = self._check_and_get_until(_request=_request)
         if start_time is not None:
             and_parts.append(start_time)
+        and_parts += self._check_and_get_time_filters(
+            now=now,
+            _request=_request,
+            )
+
+        # Distances are computed the same way event-location's
+        # place search computes them
+        try:
+            with metrics.timing('mongo'):
+                res = self._events_coll.database.command(
+                    bson.SON(
+                        OrderedDict([
+                                ('geoNear', self._events_coll.name),
+                                ('near', [lng, lat]),
+                                ])
+                        ),
+                    spherical=True,
+                    maxDistance=radius/earth_radius,
+                    distanceMultiplier=earth_radius,
+                    query=OrderedDict([
+                            ('$and', and_parts),
+                            ]),
+                    num=near_max_events,
+                    )
+        except pymongo.errors.OperationFailure, e:
+            log.error(
+                'GeoNear search returned error "{error}"'.format(
+                    error=str(e),
+                    )
+                )
+            send_error(
+                code=500,
+                message='Could not search for nearby events',
+                )
+        # Not every server raises when the command fails
+        if not res.get('ok'):
+            log.error(
+                'GeoNear search returned error "{error}"'.format(
+                    error=res.get('errmsg'),
+                    )
+                )
+            send_error(
+                code=500,
+                message='Could not search for nearby events',
+                )
+        metrics.add_count('documents_returned', len(res['results']))
+
+        # Events at the same coordinate are equally distant. Show
+        # them in chronological order.
+        results = sorted(
+            res['results'],
+            key=lambda result: (
+                result['dis'],
+                result['obj']['facebook']['start_time'],
+                ),
+            )
+        status = group_by_coord(
+            events=[result['obj'] for result in results],
+            now=now,
+            details=True,
+            max_coordinates=limit,
+            )
 
-        events = self._events_coll.find(
+        grouped = status['data']['events']
+        distances = OrderedDict()
+        for result in results:
+            api_loc = event_coord_key(result['obj'])
+            if api_loc in grouped and api_loc not in distances:
+                distances[api_loc] = result['dis']
+        status['data']['distances'] = distances
+
+        results = self._dumps(status, fmt=fmt)
+        self._update_key(
+            key=key,
+            now=now,
+            )
+
+        return results
+
+    def _changes(
+        self,
+        _datetime=None,
+        _request=None,
+        _response=None,
+        ):
+        if _datetime is None:
+            _datetime = datetime
+
+        key = self._check_and_get_key(_request=_request)
+        since = self._check_and_get_since(_request=_request)
+        fmt = self._check_and_get_format(
+            _request=_request,
+            _response=_response,
+            )
+        # TODO. Use Los Angeles local time until the timezone
+        # is included in each event's data
+        now = _datetime.now()
+        # The pipeline stamps changes in UTC when they are
+        # written. Read before querying so that changes made during
+        # the request are sent again instead of missed.
+        next_since = _datetime.utcnow() - timedelta(
+            seconds=self._changes_margin,
+            )
+
+        # Allow mongodb to cache requests for today
+        today = now.replace(hour=0,minute=0,second=0,microsecond=0)
+
+        and_parts = live_query_parts(today)
+        and_parts.append(changed_query_part(since))
+        events = self._find(
             OrderedDict([
                     ('$and', and_parts)
                     ]),
-            sort=[('facebook.start_time', pymongo.ASCENDING)],
+            fields=details_fields,
+            )
+        status = group_by_coord(
+            events=events,
+            now=now,
+            details=True,
+            )
+
+        deleted = []
+        if self._expired_coll is not None:
+            expired = self._expired_coll.find(
+                OrderedDict([
+                        ('ubernear.expired', OrderedDict([
+                                    ('$gt', since),
+                                    ]),
+                         ),
+                        ]),
+                fields=['_id'],
+                )
+            deleted = [event['_id'] for event in expired]
+        status['data']['deleted'] = deleted
+        status['paging'] = OrderedDict([
+                ('since', '{since}+00:00'.format(
+                        since=next_since.isoformat(),
+                        ),
+                 ),
+                ])
+
+        results = self._dumps(status, fmt=fmt)
+        self._update_key(
+            key=key,
+            now=now,
             )
 
+        return results
+
+    def _search(
+        self,
+        _datetime=None,
+        _request=None,
+        _response=None,
+        ):
+        if _datetime is None:
+            _datetime = datetime
+
+        key = self._check_and_get_key(_request=_request)
+        (tokens, limit) = self._check_and_get_search_options(
+            _request=_request,
+            )
+        fmt = self._check_and_get_format(
+            _request=_request,
+            _response=_response,
+            )
         # TODO. Use Los Angeles local time until the timezone
         # is included in each event's data
         now = _datetime.now()
+
+        # Allow mongodb to cache requests for today
+        today = now.replace(hour=0,minute=0,second=0,microsecond=0)
+
+        # Events must have every word searched for
+        and_parts = live_query_parts(today)
+        and_parts.append(
+            OrderedDict([
+                    ('ubernear.tokens', OrderedDict([
+                                ('$all', tokens),
+                                ]),
+                     ),
+                    ])
+            )
+        start_time = self._check_and_get_until(_request=_request)
+        if start_time is not None:
+            and_parts.append(start_time)
+        and_parts += self._check_and_get_time_filters(
+            now=now,
+            _request=_request,
+            )
+
+        events = self._find(
+            OrderedDict([
+                    ('$and', and_parts)
+                    ]),
+            sort=[('facebook.start_time', pymongo.ASCENDING)],
+            fields=details_fields,
+            limit=search_max_events,
+            )
+
+        # Events with more of the words in their name come first.
+        # The sort is stable so ties stay in chronological order.
+        # Only the first search_max_events events to start are
+        # ranked since mongodb cannot sort by the words matched.
+        def name_matches(event):
+            name = search_tokens(event['facebook'].get('name', u''))
+            return len([token for token in tokens if token in name])
+        events = sorted(
+            events,
+            key=lambda event: -name_matches(event),
+            )
+
         results = self._get_results_by_coord(
-            events=events,
+            events=events[:limit],
             now=now,
             details=True,
+            fmt=fmt,
             )
         self._update_key(
             key=key,
@@ -421,6 +2209,23 @@ class EventAPI01(object):
 
         return results
 
+    def _metrics(
+        self,
+        _response=None,
+        ):
+        if _response is None:
+            _response = bottle.response
+
+        if not self._expose_metrics:
+            send_error(
+                code=404,
+                message='Not found',
+                )
+
+        _response.content_type = 'text/plain; version=0.0.4'
+
+        return metrics.registry.text()
+
     def _no_version(self):
         send_error(
             code=404,
@@ -439,6 +2244,42 @@ class EventAPI01(object):
     def single_coord(self, version, lat, lng):
         return self._single_coord(lat, lng)
 
+    @bottle.get('/<version>/box/<sw_lat:float>,<sw_lng:float>,'
+                '<ne_lat:float>,<ne_lng:float>')
+    @bottle.get('/<version>/box/<sw_lat:float>,<sw_lng:float>,'
+                '<ne_lat:float>,<ne_lng:float>/')
+    @check_version
+    def box(self, version, sw_lat, sw_lng, ne_lat, ne_lng):
+        return self._box(sw_lat, sw_lng, ne_lat, ne_lng)
+
+    @bottle.get('/<version>/tiles/<zoom:int>/<x:int>/<y:int>')
+    @bottle.get('/<version>/tiles/<zoom:int>/<x:int>/<y:int>/')
+    @check_version
+    def tile(self, version, zoom, x, y):
+        return self._tile(zoom, x, y)
+
+    @bottle.get('/<version>/near/<lat:float>,<lng:float>')
+    @bottle.get('/<version>/near/<lat:float>,<lng:float>/')
+    @check_version
+    def near(self, version, lat, lng):
+        return self._near(lat, lng)
+
+    @bottle.get('/<version>/search')
+    @bottle.get('/<version>/search/')
+    @check_version
+    def search(self, version):
+        return self._search()
+
+    @bottle.get('/<version>/changes')
+    @bottle.get('/<version>/changes/')
+    @check_version
+    def changes(self, version):
+        return self._changes()
+
+    @bottle.get('/metrics')
+    def get_metrics(self):
+        return self._metrics()
+
     @bottle.get('/')
     def no_version(self):
         self._no_version()
@@ -1,18 +1,35 @@
+import sys
 import optparse
 import logging
 import pymongo
 
-from paste.gzipper import middleware
 from bottle import install, run, default_app
 from ubernear.util.config import (
     config_parser,
     collections,
     )
-from ubernear.api import EventAPI01, APIServer
-from ubernear.util import mongo
+from ubernear.api import (
+    EventAPI01,
+    APIServer,
+    GeventAPIServer,
+    GzipMiddleware,
+    )
+from ubernear.indices import (
+    ensure_indices,
+    check_api_indices,
+    )
 
 log = logging.getLogger(__name__)
 
+def _api_collections(coll):
+    return dict(
+        keys_coll=coll['keys-collection'],
+        events_coll=coll['events-collection'],
+        meta_coll=coll.get('meta-collection'),
+        expired_coll=coll.get('expired-collection'),
+        rate_limit_coll=coll.get('rate-limit-collection'),
+        )
+
 def main():
     parser = optparse.OptionParser(
         usage='%prog [OPTS]',
@@ -36,8 +53,51 @@ def main():
               ),
         metavar='PATH',
         )
+    parser.add_option(
+        '--server',
+        help=('How requests are handled: threaded, prefork '
+              'or gevent. gevent requires the gevent package '
+              '[default %default]'
+              ),
+        type='choice', choices=['threaded', 'prefork', 'gevent'],
+        )
+    parser.add_option(
+        '--workers',
+        help=('Number of processes that handle requests when '
+              'the server is prefork [default %default]'
+              ),
+        type='int', metavar='NUM',
+        )
+    parser.add_option(
+        '--concurrency',
+        help=('Number of threads, when the server is threaded, '
+              'or connections, when the server is gevent, that '
+              'are handled at a time [default: 10 threads or '
+              '1000 connections]'
+              ),
+        type='int', metavar='NUM',
+        )
+    parser.add_option(
+        '--keep-alive',
+        help=('Keep connections open between requests '
+              '[default %default]'
+              ),
+        action="store_true", dest="keep_alive"
+        )
+    parser.add_option(
+        '--check-indices',
+        help=('Report the API queries that do not use an index '
+              'and exit instead of starting the server '
+              '[default %default]'
+              ),
+        action="store_true", dest="check_indices"
+        )
     parser.set_defaults(
         verbose=False,
+        server='threaded',
+        workers=4,
+        keep_alive=False,
+        check_indices=False,
         )
 
     options, args = parser.parse_args()
@@ -49,16 +109,64 @@ def main():
     if options.db_config is None:
         parser.error('Missing option --db-config=.')
 
+    if options.server == 'gevent':
+        # Patch before any connections are made
+        from gevent import monkey
+        monkey.patch_all()
+
     config = config_parser(options.config)
     host = config.get('connection', 'host')
     port = config.get('connection', 'port')
 
-    coll = collections(
-        config=options.db_config,
-        read_preference=pymongo.ReadPreference.SECONDARY,
-        )
+    cache_size = 64
+    if config.has_option('cache', 'size'):
+        cache_size = config.getint('cache', 'size')
+    cache_ttl = 300
+    if config.has_option('cache', 'ttl'):
+        cache_ttl = config.getint('cache', 'ttl')
+
+    stream = False
+    if config.has_option('response', 'stream'):
+        stream = config.getboolean('response', 'stream')
+    msgpack = False
+    if config.has_option('response', 'msgpack'):
+        msgpack = config.getboolean('response', 'msgpack')
+
+    expose_metrics = False
+    if config.has_option('metrics', 'expose'):
+        expose_metrics = config.getboolean('metrics', 'expose')
+
+    snapshot_path = None
+    if config.has_option('snapshot', 'path'):
+        snapshot_path = config.get('snapshot', 'path')
+    snapshot_max_age = 30*60
+    if config.has_option('snapshot', 'max-age'):
+        snapshot_max_age = config.getint('snapshot', 'max-age')
+
+    key_cache_size = 1024
+    if config.has_option('keys', 'cache-size'):
+        key_cache_size = config.getint('keys', 'cache-size')
+    key_cache_ttl = 60
+    if config.has_option('keys', 'cache-ttl'):
+        key_cache_ttl = config.getint('keys', 'cache-ttl')
+    key_flush_interval = 10
+    if config.has_option('keys', 'flush-interval'):
+        key_flush_interval = config.getint('keys', 'flush-interval')
+    rate_limit = None
+    if config.has_option('keys', 'rate-limit'):
+        rate_limit = config.getfloat('keys', 'rate-limit')
+    rate_burst = None
+    if config.has_option('keys', 'rate-burst'):
+        rate_burst = config.getint('keys', 'rate-burst')
+
+    def connect():
+        return collections(
+            config=options.db_config,
+            read_preference=pymongo.ReadPreference.SECONDARY,
+            )
+
+    coll = connect()
     events_coll = coll['events-collection']
-    keys_coll = coll['keys-collection']
 
     logging.basicConfig(
         level=logging.DEBUG if options.verbose else logging.INFO,
@@ -66,31 +174,73 @@ def main():
         datefmt='%Y-%m-%dT%H:%M:%S',
         )
 
-    indices = [
-        {'facebook.start_time': pymongo.ASCENDING},
-        ]
-    mongo.create_indices(
-        collection=events_coll,
-        indices=indices,
-        )
+    ensure_indices(coll)
+
+    if options.check_indices:
+        unindexed = check_api_indices(events_coll)
+        if unindexed:
+            sys.exit(1)
+        log.info('All API queries use an index')
+        return
 
     uber_api = EventAPI01(
-        keys_coll=keys_coll,
-        events_coll=events_coll,
+        cache_size=cache_size,
+        cache_ttl=cache_ttl,
+        stream=stream,
+        snapshot_path=snapshot_path,
+        snapshot_max_age=snapshot_max_age,
+        key_cache_size=key_cache_size,
+        key_cache_ttl=key_cache_ttl,
+        key_flush_interval=key_flush_interval,
+        rate_limit=rate_limit,
+        rate_burst=rate_burst,
+        msgpack=msgpack,
+        expose_metrics=expose_metrics,
+        **_api_collections(coll)
         )
     install(uber_api)
 
+    prefork = options.server == 'prefork' and options.workers > 1
+    if prefork:
+        # PyMongo connections, their sockets and the replica set
+        # monitor thread, do not survive a fork. Each worker
+        # connects on its own.
+        coll['database'].connection.close()
+
+    def start_worker():
+        if prefork:
+            uber_api.set_collections(**_api_collections(connect()))
+        uber_api.start_key_flusher()
+
+    server_options = dict(
+        on_worker_start=start_worker,
+        on_worker_exit=uber_api.flush_key_usage,
+        )
+    if options.server == 'gevent':
+        server = GeventAPIServer
+        if options.concurrency is not None:
+            server_options['concurrency'] = options.concurrency
+    else:
+        server = APIServer
+        server_options['keep_alive'] = options.keep_alive
+        if options.server == 'prefork':
+            server_options['workers'] = options.workers
+        if options.concurrency is not None:
+            server_options['threads'] = options.concurrency
+
     log.info(
-        'Starting server http://{host}:{port}'.format(
+        'Starting {server} server http://{host}:{port}'.format(
+            server=options.server,
             host=host,
             port=port,
             )
         )
 
-    app = middleware(default_app())
+    app = GzipMiddleware(default_app())
     run(app=app,
         host=host,
         port=port,
-        server=APIServer,
+        server=server,
         quiet=True,
+        **server_options
         )
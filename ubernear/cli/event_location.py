@@ -1,15 +1,16 @@
 import optparse
 import logging
-import pymongo
 import time
 import random
 
 from ubernear.util import signal_handler
 from ubernear import event_location
+from ubernear import event_results
 from ubernear.util.config import (
     collections,
+    bulk_config,
     )
-from ubernear.util import mongo
+from ubernear.indices import ensure_indices
 
 log = logging.getLogger(__name__)
 
@@ -38,6 +39,14 @@ def main():
               ),
         action="store_true", dest="process_all"
         )
+    parser.add_option(
+        '--snapshot',
+        help=('Path to the file where the response to a request '
+              'for all events is written after the events are '
+              'located'
+              ),
+        metavar='PATH',
+        )
     parser.set_defaults(
         verbose=False,
         process_all=False,
@@ -57,17 +66,14 @@ def main():
         )
 
     coll = collections(options.db_config)
+    (bulk_size, bulk_interval) = bulk_config(options.db_config)
     events_coll = coll['events-collection']
     places_coll = coll['places-collection']
+    meta_coll = coll.get('meta-collection')
+    jobs_coll = coll.get('jobs-collection')
     database = coll['database']
 
-    indices = [
-        {'match.ubernear.location': pymongo.GEO2D},
-        ]
-    mongo.create_indices(
-        collection=events_coll,
-        indices=indices,
-        )
+    ensure_indices(coll)
 
     log.info('Start...')
 
@@ -77,8 +83,20 @@ def main():
         places_coll=places_coll,
         database=database,
         process_all=options.process_all,
+        meta_coll=meta_coll,
+        bulk_size=bulk_size,
+        bulk_interval=bulk_interval,
+        jobs_coll=jobs_coll,
         )
 
+    # Events expire even when no work is found
+    if options.snapshot is not None:
+        log.info('Writing snapshot...')
+        event_results.write_snapshot(
+            events_coll=events_coll,
+            path=options.snapshot,
+            )
+
     if not found_work:
         minutes = 15
         delay = random.randint(60*minutes-1, 60*minutes+1)
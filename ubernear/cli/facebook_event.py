@@ -1,6 +1,5 @@
 import optparse
 import logging
-import pymongo
 import time
 import random
 
@@ -8,11 +7,13 @@ from facepy import GraphAPI
 
 from ubernear.util import signal_handler
 from ubernear import facebook_event
+from ubernear import stages
 from ubernear.util.config import (
     collections,
     config_parser,
+    bulk_config,
     )
-from ubernear.util import mongo
+from ubernear.indices import ensure_indices
 
 log = logging.getLogger(__name__)
 
@@ -48,9 +49,17 @@ def main():
               ),
         action="store_true", dest="process_all"
         )
+    parser.add_option(
+        '--queue-stages',
+        help=('Queue the work left for events stored before '
+              'stages were tracked and exit [default %default]'
+              ),
+        action="store_true", dest="queue_stages"
+        )
     parser.set_defaults(
         verbose=False,
         process_all=False,
+        queue_stages=False,
         )
 
     options, args = parser.parse_args()
@@ -71,29 +80,27 @@ def main():
     config = config_parser(options.config)
     access_token = config.get('facebook', 'access_token')
     graph = GraphAPI(access_token)
+    concurrency = 4
+    if config.has_option('facebook', 'concurrency'):
+        concurrency = config.getint('facebook', 'concurrency')
+    batch_rate = None
+    if config.has_option('facebook', 'batch-rate'):
+        batch_rate = config.getfloat('facebook', 'batch-rate')
 
     usps_id = config.get('usps', 'user_id')
     yahoo_id = config.get('yahoo', 'app_id')
 
     coll = collections(options.db_config)
+    (bulk_size, bulk_interval) = bulk_config(options.db_config)
     events_coll = coll['events-collection']
     expired_coll = coll['expired-collection']
+    jobs_coll = coll.get('jobs-collection')
 
-    indices = [
-        {'facebook.end_time': pymongo.ASCENDING},
-        {'ubernear.fetched': pymongo.ASCENDING},
-        ]
-    mongo.create_indices(
-        collection=events_coll,
-        indices=indices,
-        )
-    indices = [
-        {'facebook.end_time': pymongo.ASCENDING},
-        ]
-    mongo.create_indices(
-        collection=expired_coll,
-        indices=indices,
-        )
+    ensure_indices(coll)
+
+    if options.queue_stages:
+        stages.queue_stages(events_coll)
+        return
 
     log.info('Start...')
 
@@ -108,6 +115,11 @@ def main():
         events_coll=events_coll,
         graph=graph,
         process_all=options.process_all,
+        concurrency=concurrency,
+        batch_rate=batch_rate,
+        bulk_size=bulk_size,
+        bulk_interval=bulk_interval,
+        jobs_coll=jobs_coll,
         )
 
     log.info('Updating venue data...')
@@ -115,6 +127,9 @@ def main():
         events_coll=events_coll,
         usps_id=usps_id,
         process_all=options.process_all,
+        bulk_size=bulk_size,
+        bulk_interval=bulk_interval,
+        jobs_coll=jobs_coll,
         )
 
     log.info('Updating coordinate data...')
@@ -122,6 +137,9 @@ def main():
         events_coll=events_coll,
         yahoo_id=yahoo_id,
         process_all=options.process_all,
+        bulk_size=bulk_size,
+        bulk_interval=bulk_interval,
+        jobs_coll=jobs_coll,
         )
     if coord_work['sleep'] is not None:
         delay = coord_work['sleep']
@@ -14,7 +14,9 @@ from ubernear.util import signal_handler
 from ubernear.util import (
     utc_from_iso8601,
     )
+from ubernear import stages
 from ubernear.util import mongo
+from ubernear.indices import ensure_indices
 from ubernear.util.config import (
     collections,
     config_parser,
@@ -126,6 +128,9 @@ def _save_events(
                         ('ubernear', OrderedDict([
                                     ('source', 'facebook'),
                                     ('fetched', now),
+                                    # Queues the event for lookup
+                                    ('stages', [stages.lookup]),
+                                    ('retry_at', now),
                                     ]),
                          ),
                         ])
@@ -324,13 +329,7 @@ def main():
     expired_coll = coll['expired-collection']
     owners_coll = coll['owners-collection']
 
-    indices = [
-        {'ubernear.last_lookup': pymongo.ASCENDING},
-        ]
-    mongo.create_indices(
-        collection=owners_coll,
-        indices=indices,
-        )
+    ensure_indices(coll)
 
     log.info('Start...')
 
@@ -1,7 +1,6 @@
 import csv
 import optparse
 import logging
-import pymongo
 
 from collections import defaultdict
 from pyusps import address_information
@@ -13,6 +12,7 @@ from ubernear.util.config import (
     absolute_path,
     )
 from ubernear.util import mongo
+from ubernear.indices import ensure_indices
 
 log = logging.getLogger(__name__)
 
@@ -179,13 +179,6 @@ def main():
                 save=save,
                 )
 
-    indices = [
-        {'ubernear.location': pymongo.GEO2D},
-        {'ubernear.last_checked': pymongo.ASCENDING},
-        ]
-    mongo.create_indices(
-        collection=places_coll,
-        indices=indices,
-        )
+    ensure_indices(coll)
 
     log.info('End')
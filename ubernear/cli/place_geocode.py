@@ -12,6 +12,7 @@ from ubernear.util.config import (
     config_parser,
     )
 from ubernear.util import mongo
+from ubernear.indices import ensure_indices
 
 log = logging.getLogger(__name__)
 
@@ -82,6 +83,7 @@ def main():
 
     coll = collections(options.db_config)
     places_coll = coll['places-collection']
+    ensure_indices(coll)
 
     found_work = False
     with _places_cursor(places_coll=places_coll) as cursor:
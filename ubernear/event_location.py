@@ -7,7 +7,14 @@ from collections import OrderedDict
 from datetime import datetime
 from decimal import Decimal
 
+from ubernear import stages
 from ubernear.util import mongo
+from ubernear.event_results import (
+    api_place_id,
+    coord_key,
+    quadkey,
+    change_stamps,
+    )
 from ubernear.util import (
     DefaultOrderedDict,
     )
@@ -33,6 +40,9 @@ max_meters = 100
 # Angle, in radians, of an arc with length max_meters
 # for a sphere with radius earth_radius
 max_angle = 0.000015696
+# Bumped in the meta collection every time matches are written so
+# that readers of matched events know when their copies are stale
+generation_id = 'events'
 
 place_fields = [
     'address',
@@ -664,16 +674,56 @@ def _match_with_venue(
 
     return match
 
+def _add_api_keys(match):
+    # Computed once here instead of for every event in every
+    # API request
+    ubernear = match['ubernear']
+    ubernear['api_place_id'] = api_place_id(
+        place_id=ubernear['place_id'],
+        name=match['place']['name'],
+        )
+    ubernear['coord_key'] = coord_key(ubernear['location'])
+    # Prefixes are the tiles with less zoom containing the match
+    ubernear['quadkey'] = quadkey(ubernear['location'])
+
+def _venue_matchable(event):
+    """
+    Whether event has what _match_with_venue needs.
+    """
+    facebook = event['facebook']
+    venue = facebook.get('venue', {})
+    for field in ['latitude', 'longitude', 'street', 'city']:
+        if field not in venue:
+            return False
+
+    return (
+        'location' in facebook
+        or
+        'name' in facebook.get('owner', {})
+        )
+
 def locate(
     events_coll,
     places_coll,
     database,
     process_all=False,
+    meta_coll=None,
+    bulk_size=None,
+    bulk_interval=None,
+    jobs_coll=None,
+    chunk_size=1000,
     _log=None,
     _datetime=None,
     _match_with_place_fn=None,
     _match_with_venue_fn=None,
     ):
+    """
+    Match events with places and, failing that, with their venues.
+    When bulk_size is given, matches are written in bulk as
+    mongo.bulk_writes does. When jobs_coll is given, events are
+    read in chunks of chunk_size and each pass resumes from its
+    checkpoint as mongo.resumable_chunks does.
+    """
     if _log is None:
         _log = log
     if _datetime is None:
@@ -686,32 +736,21 @@ def locate(
     now = _datetime.utcnow()
 
     if process_all:
+        query = OrderedDict([
+                ('ubernear.lookup_completed',
+                 OrderedDict([
+                            ('$exists', True),
+                            ]),
+                 ),
+                ])
         events = events_coll.find(
-            OrderedDict([
-                    ('ubernear.lookup_completed',
-                     OrderedDict([
-                                ('$exists', True),
-                                ]),
-                     ),
-                    ]),
+            query,
             sort=[('ubernear.fetched', pymongo.ASCENDING)],
             )
     else:
         query_parts = [
-            OrderedDict([
-                    ('ubernear.lookup_completed',
-                     OrderedDict([
-                                ('$exists', True),
-                                ]),
-                     ),
-                    ]),
-            OrderedDict([
-                    ('ubernear.match_completed',
-                     OrderedDict([
-                                ('$exists', False),
-                                ]),
-                     ),
-                    ]),
+            stages.stage_query(stages.match),
+            stages.ready_query(stages.match),
             OrderedDict([
                     ('ubernear.match_failed',
                      OrderedDict([
@@ -720,10 +759,11 @@ def locate(
                      ),
                     ]),
             ]
+        query = OrderedDict([
+                ('$and', query_parts),
+                ])
         events = events_coll.find(
-            OrderedDict([
-                    ('$and', query_parts),
-                    ]),
+            query,
             sort=[('ubernear.fetched', pymongo.ASCENDING)],
             )
 
@@ -737,47 +777,79 @@ def locate(
             )
 
     found_work = False
-    for event in events:
-        found_work = True
-        ubernear = event['ubernear']
-        place_ids = ubernear.get('place_ids', [])
-        place_ids = place_ids
-        match = _match_with_place_fn(
-            event=event,
-            place_ids=place_ids,
-            places_coll=places_coll,
-            database=database,
-            )
+    matched = False
+    write_failures = []
+    # Written before venues are resolved since those queries
+    # depend on match_failed
+    chunks = mongo.resumable_chunks(
+        events,
+        events_coll,
+        spec=query,
+        job=stages.job_name(stages.match, process_all=process_all),
+        jobs_coll=jobs_coll,
+        size=chunk_size,
+        failures=write_failures,
+        )
+    for chunk in chunks:
+        with mongo.bulk_writes(
+            events_coll,
+            size=bulk_size,
+            interval=bulk_interval,
+            stamps=change_stamps,
+            failures=write_failures,
+            ) as writes_coll:
+            for event in chunk:
+                found_work = True
+                ubernear = event['ubernear']
+                place_ids = ubernear.get('place_ids', [])
+                place_ids = place_ids
+                match = _match_with_place_fn(
+                    event=event,
+                    place_ids=place_ids,
+                    places_coll=places_coll,
+                    database=database,
+                    )
 
-        if match is not None:
-            save = OrderedDict([
-                    ('match', match),
-                    ('ubernear.match_completed', now),
-                    ])
-            mongo.save_no_replace(
-                events_coll,
-                _id=event['_id'],
-                save=save,
-                )
-        else:
-            save = OrderedDict([
-                    ('ubernear.match_failed', 'No place match'),
-                    ])
-            mongo.save_no_replace(
-                events_coll,
-                _id=event['_id'],
-                save=save,
-                )
+                if match is not None:
+                    matched = True
+                    _add_api_keys(match)
+                    save = OrderedDict([
+                            ('match', match),
+                            ('ubernear.match_completed', now),
+                            ('ubernear.modified', _datetime.utcnow()),
+                            ])
+                    mongo.save_no_replace(
+                        writes_coll,
+                        _id=event['_id'],
+                        save=save,
+                        remove=stages.done(stages.match),
+                        )
+                else:
+                    save = OrderedDict([
+                            ('ubernear.match_failed', 'No place match'),
+                            ])
+                    # Events stay in the stage to be matched with their
+                    # venue below
+                    remove = None
+                    if not _venue_matchable(event):
+                        remove = stages.done(stages.match)
+                    mongo.save_no_replace(
+                        writes_coll,
+                        _id=event['_id'],
+                        save=save,
+                        remove=remove,
+                        )
 
     if process_all:
+        query = OrderedDict([
+                ('ubernear.lookup_completed',
+                 OrderedDict([
+                            ('$exists', True),
+                            ]),
+                 ),
+                ])
         events = events_coll.find(
-            OrderedDict([
-                    ('ubernear.lookup_completed',
-                     OrderedDict([
-                                ('$exists', True),
-                                ]),
-                     ),
-                    ]),
+            query,
             sort=[('ubernear.fetched', pymongo.ASCENDING)],
             )
     else:
@@ -800,13 +872,8 @@ def locate(
                 ])
         query = OrderedDict([
                 ('$and', [
-                        OrderedDict([
-                                ('ubernear.match_completed',
-                                 OrderedDict([
-                                            ('$exists', False)
-                                            ]),
-                                 ),
-                                ]),
+                        stages.stage_query(stages.match),
+                        stages.ready_query(stages.match),
                         OrderedDict([
                                 ('ubernear.match_failed',
                                  'No place match',
@@ -858,21 +925,56 @@ def locate(
                 ),
             )
 
-    for event in events:
-        found_work = True
-        match = _match_with_venue_fn(
-            event=event,
-            _log=_log,
+    write_failures = []
+    chunks = mongo.resumable_chunks(
+        events,
+        events_coll,
+        spec=query,
+        job=stages.job_name('match-venue', process_all=process_all),
+        jobs_coll=jobs_coll,
+        size=chunk_size,
+        failures=write_failures,
+        )
+    for chunk in chunks:
+        with mongo.bulk_writes(
+            events_coll,
+            size=bulk_size,
+            interval=bulk_interval,
+            stamps=change_stamps,
+            failures=write_failures,
+            ) as writes_coll:
+            for event in chunk:
+                found_work = True
+                match = _match_with_venue_fn(
+                    event=event,
+                    _log=_log,
+                    )
+                if match is not None:
+                    matched = True
+                    _add_api_keys(match)
+                    save = OrderedDict([
+                            ('match', match),
+                            ('ubernear.match_completed', now),
+                            ('ubernear.modified', _datetime.utcnow()),
+                            ])
+                    mongo.save_no_replace(
+                        writes_coll,
+                        _id=event['_id'],
+                        save=save,
+                        remove=stages.done(stages.match),
+                        )
+                elif not process_all:
+                    mongo.save_no_replace(
+                        writes_coll,
+                        _id=event['_id'],
+                        remove=stages.done(stages.match),
+                        )
+
+    if matched and meta_coll is not None:
+        mongo.bump_generation(
+            meta_coll,
+            name=generation_id,
+            now=now,
             )
-        if match is not None:
-            save = OrderedDict([
-                    ('match', match),
-                    ('ubernear.match_completed', now),
-                    ])
-            mongo.save_no_replace(
-                events_coll,
-                _id=event['_id'],
-                save=save,
-                )
 
     return found_work
@@ -0,0 +1,559 @@
+import os
+import gzip
+import shutil
+import tempfile
+import math
+import string
+import calendar
+import json
+import hashlib
+import logging
+import pymongo
+
+from datetime import datetime
+from collections import OrderedDict
+
+from ubernear import metrics
+from ubernear.util import DefaultOrderedDict
+from ubernear.util.address import normalize_string
+
+log = logging.getLogger(__name__)
+
+facebook_events_url = 'http://facebook.com/events'
+# Zoom level of the quadkeys stored with each match. Tiles with
+# more zoom are not served.
+quadkey_zoom = 18
+# Web Mercator does not reach the poles
+max_latitude = 85.05112878
+
+def get_status(
+    code=200,
+    message='OK',
+    ):
+    status = OrderedDict([
+            ('code', code),
+            ('message', message)
+            ])
+    res = OrderedDict([
+            ('status', status),
+            ])
+
+    return res
+
+def coord_key(location):
+    # Coordinates are always stored in the form [lng,lat]
+    (lng, lat) = location
+    # Does not lose precision
+    lat = json.dumps(lat)
+    lng = json.dumps(lng)
+
+    return '{lat},{lng}'.format(lat=lat, lng=lng)
+
+def api_place_id(place_id, name):
+    # Events could have the same _id but different
+    # names since the name stored was the one given
+    # by facebook
+    _hash = hashlib.md5()
+    _hash.update(place_id)
+    _hash.update(name.encode('utf-8'))
+
+    return _hash.hexdigest()
+
+def tile_quadkey(x, y, zoom):
+    """
+    Return the quadkey of the tile at x and y, counted from the top
+    left, in a map with 2**zoom tiles per side.
+    """
+    digits = []
+    for i in xrange(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        digit = 0
+        if x & mask:
+            digit += 1
+        if y & mask:
+            digit += 2
+        digits.append(str(digit))
+
+    return ''.join(digits)
+
+def quadkey(location, zoom=quadkey_zoom):
+    # Coordinates are always stored in the form [lng,lat]
+    (lng, lat) = location
+    lat = min(max(lat, -max_latitude), max_latitude)
+    sin_lat = math.sin(lat * math.pi / 180)
+    x = (lng + 180.0) / 360
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+
+    size = 2 ** zoom
+    tile_x = min(max(int(x * size), 0), size - 1)
+    tile_y = min(max(int(y * size), 0), size - 1)
+
+    return tile_quadkey(tile_x, tile_y, zoom)
+
+def event_place_id(event):
+    # Stored by event-location. Events matched before it was
+    # stored do not have it.
+    ubernear = event['match']['ubernear']
+    place_key = ubernear.get('api_place_id')
+    if place_key is None:
+        place_key = api_place_id(
+            place_id=ubernear['place_id'],
+            name=event['match']['place']['name'],
+            )
+
+    return place_key
+
+def event_coord_key(event):
+    ubernear = event['match']['ubernear']
+    api_loc = ubernear.get('coord_key')
+    if api_loc is None:
+        api_loc = coord_key(ubernear['location'])
+
+    return api_loc
+
+def search_tokens(text):
+    """
+    Return the distinct words of text, lowercased, in the order
+    they first appear. Punctuation separates words, e.g.,
+    rock-n-roll is rock, n and roll.
+    """
+    for punc in string.punctuation:
+        text = text.replace(punc, ' ')
+    words = normalize_string(text).split()
+
+    return list(OrderedDict.fromkeys(words))
+
+def live_query_parts(today):
+    match = OrderedDict([
+            ('match', OrderedDict([
+                        ('$exists', True),
+                        ]),
+             ),
+            ])
+    end_time = OrderedDict([
+            ('facebook.end_time', OrderedDict([
+                        ('$gt', today),
+                        ]),
+             ),
+            ])
+
+    return [match, end_time]
+
+# Stamped with the time each change is written, not when the job
+# making it started, so that clients which synced in between do not
+# miss it
+change_stamps = ['ubernear.modified']
+
+def changed_query_part(since):
+    # Events matched before event-location stamped modified
+    # only have match_completed
+    modified = OrderedDict([
+            ('ubernear.modified', OrderedDict([
+                        ('$gt', since),
+                        ]),
+             ),
+            ])
+    match_completed = OrderedDict([
+            ('ubernear.match_completed', OrderedDict([
+                        ('$gt', since),
+                        ]),
+             ),
+            ])
+    query = OrderedDict([
+            ('$or', [modified, match_completed]),
+            ])
+
+    return query
+
+# The streaming encoder needs the events of each coordinate to be
+# contiguous. The matched place's latitude and longitude are the
+# same as its location but, unlike the location array, they sort
+# as scalars.
+coord_sort = [
+    ('match.place.latitude', pymongo.ASCENDING),
+    ('match.place.longitude', pymongo.ASCENDING),
+    ('facebook.start_time', pymongo.ASCENDING),
+    ]
+
+# Only the fields the API reads are transferred
+summary_fields = [
+    'facebook.id',
+    'facebook.end_time',
+    'match.ubernear.place_id',
+    'match.ubernear.location',
+    'match.ubernear.api_place_id',
+    'match.ubernear.coord_key',
+    'match.place',
+    ]
+details_fields = summary_fields + [
+    'facebook.name',
+    'facebook.start_time',
+    'facebook.description',
+    ]
+tile_fields = summary_fields + [
+    'facebook.name',
+    'facebook.start_time',
+    'match.ubernear.quadkey',
+    ]
+
+def api_event(
+    event,
+    details=False,
+    ):
+    facebook = event['facebook']
+    place_key = event_place_id(event)
+
+    link = '{facebook_events_url}/{_id}'.format(
+        facebook_events_url=facebook_events_url,
+        _id=facebook['id'],
+        )
+
+    res = OrderedDict([
+            ('id', facebook['id']),
+            ])
+    if details is True:
+        res['event_link'] = link
+        res['name'] = facebook['name']
+        res['start_time'] = facebook['start_time']
+        res['end_time'] = facebook['end_time']
+        res['place_id'] = place_key
+
+        description = facebook.get('description', None)
+        if description:
+            res['description'] = description
+
+    return place_key, res
+
+@metrics.timed('group')
+def group_by_coord(
+    events,
+    now,
+    details=False,
+    max_coordinates=None,
+    ):
+    grouped = DefaultOrderedDict(list)
+    places = OrderedDict()
+    event_count = 0
+    for event in events:
+        facebook = event['facebook']
+        if facebook['end_time'] < now:
+            continue
+
+        api_loc = event_coord_key(event)
+        if (
+            max_coordinates is not None
+            and
+            api_loc not in grouped
+            and
+            len(grouped) == max_coordinates
+            ):
+            break
+
+        (place_key, res_event) = api_event(
+            event=event,
+            details=details,
+            )
+        places[place_key] = event['match']['place']
+        grouped[api_loc].append(res_event)
+        event_count += 1
+
+    status = get_status()
+    count = OrderedDict([
+            ('events', event_count),
+            ('places', len(places)),
+            ('coordinates', len(grouped.keys())),
+            ])
+    data = OrderedDict([
+            ('events', grouped),
+            ])
+    if details is True:
+        data['places'] = places
+
+    status['count'] = count
+    status['data'] = data
+
+    return status
+
+def _compact_value(value):
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    if isinstance(value, dict):
+        return OrderedDict([
+                (k, _compact_value(v))
+                for (k, v) in value.iteritems()
+                ])
+    if isinstance(value, list):
+        return [_compact_value(v) for v in value]
+
+    return value
+
+def compact_results(status):
+    """
+    Return the document group_by_coord returns in a form suited
+    to binary encodings. Times are seconds since the epoch and
+    the events, and distances if any, are lists of
+    [latitude, longitude, value] instead of objects keyed by
+    coordinate strings.
+    """
+    res = _compact_value(status)
+    data = res.get('data')
+    if data is None:
+        return res
+
+    for name in ['events', 'distances']:
+        if name not in data:
+            continue
+        by_coord = []
+        for (api_loc, value) in data[name].iteritems():
+            (lat, lng) = api_loc.split(',')
+            by_coord.append([float(lat), float(lng), value])
+        data[name] = by_coord
+
+    return res
+
+@metrics.timed('group')
+def group_by_tile(
+    events,
+    now,
+    zoom,
+    depth,
+    top_events,
+    ):
+    """
+    Group events by the tiles depth zoom levels below zoom that
+    contain them. Each cluster has its event count, the coordinate
+    with the most events and its top_events earliest events.
+    """
+    cluster_zoom = min(zoom + depth, quadkey_zoom)
+    clusters = OrderedDict()
+    coord_counts = DefaultOrderedDict(lambda: DefaultOrderedDict(int))
+    locations = OrderedDict()
+    event_count = 0
+    for event in events:
+        facebook = event['facebook']
+        if facebook['end_time'] < now:
+            continue
+
+        key = event['match']['ubernear']['quadkey'][:cluster_zoom]
+        cluster = clusters.get(key)
+        if cluster is None:
+            cluster = OrderedDict([
+                    ('count', 0),
+                    ('events', []),
+                    ])
+            clusters[key] = cluster
+        cluster['count'] += 1
+        event_count += 1
+
+        api_loc = event_coord_key(event)
+        coord_counts[key][api_loc] += 1
+        locations[api_loc] = event['match']['ubernear']['location']
+
+        # Events are not read in order so only the earliest
+        # are kept
+        cluster['events'].append(event)
+        cluster['events'].sort(
+            key=lambda event: event['facebook']['start_time'],
+            )
+        del cluster['events'][top_events:]
+
+    places = OrderedDict()
+    for key, cluster in clusters.iteritems():
+        counts = coord_counts[key]
+        api_loc = max(counts, key=lambda api_loc: counts[api_loc])
+        (lng, lat) = locations[api_loc]
+        cluster['latitude'] = lat
+        cluster['longitude'] = lng
+
+        res_events = []
+        for event in cluster.pop('events'):
+            (place_key, res_event) = api_event(
+                event=event,
+                details=True,
+                )
+            places[place_key] = event['match']['place']
+            res_events.append(res_event)
+        cluster['events'] = res_events
+
+    status = get_status()
+    count = OrderedDict([
+            ('events', event_count),
+            ('clusters', len(clusters)),
+            ])
+    data = OrderedDict([
+            ('clusters', clusters),
+            ('places', places),
+            ])
+    status['count'] = count
+    status['data'] = data
+
+    return status
+
+def _dumps(obj):
+    return json.dumps(obj, default=datetime.isoformat)
+
+def _iter_data_pieces(
+    events,
+    now,
+    count,
+    details=False,
+    ):
+    """
+    Encode the data of group_by_coord's document incrementally
+    while events are read and set its counts in count once they
+    all were.
+    """
+    yield '{"events": {'
+
+    places = OrderedDict()
+    event_count = 0
+    coord_count = 0
+    current_loc = None
+    for event in events:
+        facebook = event['facebook']
+        if facebook['end_time'] < now:
+            continue
+
+        api_loc = event_coord_key(event)
+        (place_key, res_event) = api_event(
+            event=event,
+            details=details,
+            )
+        places[place_key] = event['match']['place']
+        event_count += 1
+
+        if api_loc == current_loc:
+            yield ', {event}'.format(event=_dumps(res_event))
+            continue
+
+        yield '{sep}{key}: [{event}'.format(
+            sep='' if current_loc is None else '], ',
+            key=_dumps(api_loc),
+            event=_dumps(res_event),
+            )
+        current_loc = api_loc
+        coord_count += 1
+
+    if current_loc is not None:
+        yield ']'
+    yield '}'
+    if details is True:
+        yield ', "places": {places}'.format(places=_dumps(places))
+    yield '}'
+
+    count['events'] = event_count
+    count['places'] = len(places)
+    count['coordinates'] = coord_count
+
+def iter_json_pieces(
+    events,
+    now,
+    details=False,
+    ):
+    """
+    Encode the same document as group_by_coord incrementally
+    while events are read. Events must be sorted so that events
+    with the same coordinates are contiguous. The counts are
+    only known at the end, so they follow the data.
+    """
+    status = get_status()
+    yield '{{"status": {status}, "data": '.format(
+        status=_dumps(status['status']),
+        )
+
+    count = OrderedDict()
+    for piece in _iter_data_pieces(
+        events=events,
+        now=now,
+        count=count,
+        details=details,
+        ):
+        yield piece
+
+    yield ', "count": {count}}}'.format(count=_dumps(count))
+
+def iter_chunks(
+    pieces,
+    chunk_size,
+    ):
+    chunk = []
+    size = 0
+    for piece in pieces:
+        chunk.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+
+    if chunk:
+        yield ''.join(chunk)
+
+def write_snapshot(
+    events_coll,
+    path,
+    _datetime=None,
+    ):
+    """
+    Write the response to an unfiltered API request for all
+    events, gzip-compressed, to path. The file is replaced
+    atomically so readers never see a partial snapshot.
+    """
+    if _datetime is None:
+        _datetime = datetime
+
+    # TODO. Use Los Angeles local time until the timezone
+    # is included in each event's data
+    now = _datetime.now()
+    today = now.replace(hour=0,minute=0,second=0,microsecond=0)
+
+    events = events_coll.find(
+        OrderedDict([
+                ('$and', live_query_parts(today)),
+                ]),
+        sort=coord_sort,
+        fields=summary_fields,
+        )
+
+    # The counts are only known once every event is read. The data
+    # is spooled first so that the counts precede it, as in other
+    # responses.
+    count = OrderedDict()
+    spool = tempfile.TemporaryFile()
+    try:
+        for piece in _iter_data_pieces(
+            events=events,
+            now=now,
+            count=count,
+            ):
+            spool.write(piece)
+        spool.seek(0)
+
+        tmp_path = '{path}.tmp'.format(path=path)
+        with open(tmp_path, 'wb') as fp:
+            gzip_fp = gzip.GzipFile(
+                filename='',
+                mode='wb',
+                fileobj=fp,
+                )
+            try:
+                gzip_fp.write(
+                    '{{"status": {status}, "count": {count}, '
+                    '"data": '.format(
+                        status=_dumps(get_status()['status']),
+                        count=_dumps(count),
+                        )
+                    )
+                shutil.copyfileobj(spool, gzip_fp)
+                gzip_fp.write('}')
+            finally:
+                gzip_fp.close()
+    finally:
+        spool.close()
+    os.rename(tmp_path, path)
+
+    log.debug(
+        'Wrote snapshot {path}'.format(
+            path=path,
+            )
+        )
@@ -1,13 +1,22 @@
+import re
+import random
 import logging
 import pymongo
 
-from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from facepy.exceptions import FacepyError
 from pyusps import address_information
 from pygeocode import geocoder
 
+from ubernear import stages
 from ubernear.util import mongo
+from ubernear.util.ratelimit import TokenBuckets, wait_for_token
+from ubernear.event_results import (
+    search_tokens,
+    change_stamps,
+    )
 from ubernear.util import (
     utc_from_iso8601,
     address as addr_util,
@@ -18,31 +27,133 @@ log = logging.getLogger(__name__)
 facebook_batch_size = 50
 usps_batch_size = 5
 
+# Transitional Graph API errors. Events which fail with them are
+# retried, retry_base after the first failure and twice as long
+# after each of the next ones, up to retry_max, until they have been
+# retried retry_limit times.
+transient_failures = [
+    re.compile('^Null response$'),
+    re.compile(
+        'OAuthException error on get.*: '
+        'Error validating application..'
+        ),
+    re.compile(
+        'OAuthException error on get.*: '
+        'An unexpected error has occurred. '
+        'Please retry your request later..'
+        ),
+    ]
+retry_base = timedelta(minutes=10)
+retry_max = timedelta(days=1)
+retry_limit = 10
+
+# Graph API errors for events which do not exist anymore. It seems
+# facebook should return false instead of the unsupported get error,
+# i.e., the id cannot be found. No bug report has been found to
+# confirm this although some reports suggest it.
+gone_failures = [
+    re.compile('^False response$'),
+    re.compile(
+        'GraphMethodException error on get.*'
+        ': Unsupported get request..',
+        re.IGNORECASE,
+        ),
+    re.compile(
+        'OAuthException error on get.*Some '
+        'of the aliases you requested do not exist.*',
+        re.IGNORECASE,
+        ),
+    ]
+
+def _is_transient(reason):
+    return any(
+        failure.search(reason) is not None
+        for failure in transient_failures
+        )
+
+def _failure_kind(reason):
+    """
+    Classify a lookup failure by its reason as transient, gone or
+    error. The kind is stored with the failure so that queries do
+    not have to match reasons.
+    """
+    if _is_transient(reason):
+        return 'transient'
+    if any(
+        failure.search(reason) is not None
+        for failure in gone_failures
+        ):
+        return 'gone'
+    return 'error'
+
+def _retry_delay(
+    retries,
+    _random=None,
+    ):
+    if _random is None:
+        _random = random
+
+    delay = min(retry_base * 2**retries, retry_max)
+    # Spread the retries of events which failed together, e.g.,
+    # in the same batch
+    seconds = delay.days * 24 * 60 * 60 + delay.seconds
+
+    return timedelta(seconds=seconds * _random.uniform(0.5, 1))
+
 def _mark_as_failed(
     events_coll,
     event_id,
     now,
     field,
     reason='',
+    stage=None,
+    retries=None,
+    _random=None,
     ):
+    """
+    Record why event_id failed in field and take it out of stage,
+    if given. When retries, the number of times the event was
+    already retried, is given and reason is transient the event
+    stays in stage and is retried after an exponential backoff
+    instead. Otherwise the failure is terminal. When retries is
+    given the failure's kind, as _failure_kind returns, is recorded
+    too.
+    """
+    failure = OrderedDict([
+            # If event is retried and it is
+            # successful it would be useful
+            # to know when it failed.
+            ('when', now),
+            ('reason', reason),
+            ])
     save = OrderedDict([
             ('ubernear', OrderedDict([
-                        (field, OrderedDict([
-                                    # If event is retried and it is
-                                    # successful it would be useful
-                                    # to know when it failed.
-                                    ('when', now),
-                                    ('reason', reason),
-                                    ]),
-                         ),
+                        (field, failure),
                         ]),
              ),
             ])
 
+    # Failed events are not retried by stage
+    remove = None
+    if stage is not None:
+        remove = stages.done(stage)
+
+    if retries is not None:
+        failure['kind'] = _failure_kind(reason)
+        if retries < retry_limit and failure['kind'] == 'transient':
+            delay = _retry_delay(retries, _random=_random)
+            save['ubernear']['retry_count'] = retries + 1
+            save['ubernear']['retry_at'] = now + delay
+            failure['terminal'] = False
+            remove = None
+        else:
+            failure['terminal'] = True
+
     mongo.save_no_replace(
         events_coll,
         _id=event_id,
         save=save,
+        remove=remove,
         )
 
 def _save_venues(
@@ -78,6 +189,7 @@ def _save_venues(
                 event_id=event['_id'],
                 now=now,
                 field='normalization_failed',
+                stage=stages.normalize,
                 reason=str(match),
                 )
             continue
@@ -98,21 +210,20 @@ def _save_venues(
             events_coll,
             _id=event['_id'],
             save=save,
+            remove=stages.done(stages.normalize),
             )
 
-def _save_events(
+def _fetch_events(
     events,
-    events_coll,
     graph,
-    now,
-    _log=None,
+    throttle=None,
     ):
-    if _log is None:
-        _log = log
-
     # Don't waste a call to the Facebook Graph API
     if not events:
-        return
+        return []
+
+    if throttle is not None:
+        throttle()
 
     batch = [
         OrderedDict([
@@ -125,9 +236,71 @@ def _save_events(
         ])
         for event in events
     ]
-    reponses = graph.batch(batch)
 
-    for event,response in zip(events,reponses):
+    # facepy's batch is a generator which only sends the request
+    # once it is read, so read it here, e.g., in a worker thread
+    return list(graph.batch(batch))
+
+def _fetch_batches(
+    batches,
+    graph,
+    concurrency=1,
+    throttle=None,
+    ):
+    """
+    Fetch each batch of events from the Graph API, with up to
+    concurrency batches in flight at once, and yield the events
+    and responses of each batch in the order of batches.
+    """
+    if concurrency == 1:
+        for events in batches:
+            yield events, _fetch_events(
+                events=events,
+                graph=graph,
+                throttle=throttle,
+                )
+        return
+
+    pool = ThreadPool(concurrency)
+    try:
+        in_flight = deque()
+        for events in batches:
+            result = pool.apply_async(
+                _fetch_events,
+                kwds=dict(
+                    events=events,
+                    graph=graph,
+                    throttle=throttle,
+                    ),
+                )
+            in_flight.append((events, result))
+            if len(in_flight) == concurrency:
+                (events, result) = in_flight.popleft()
+                yield events, result.get()
+        while in_flight:
+            (events, result) = in_flight.popleft()
+            yield events, result.get()
+    finally:
+        pool.terminate()
+
+def _store_events(
+    events,
+    responses,
+    events_coll,
+    now,
+    _log=None,
+    _random=None,
+    _datetime=None,
+    ):
+    if _log is None:
+        _log = log
+    if _datetime is None:
+        _datetime = datetime
+
+    for event,response in zip(events,responses):
+        # Events which fail with a transitional error stay in the
+        # lookup stage until they are retried
+        retries = event.get('ubernear', {}).get('retry_count', 0)
         if isinstance(response, FacepyError):
             _mark_as_failed(
                 events_coll=events_coll,
@@ -135,6 +308,9 @@ def _save_events(
                 now=now,
                 field='lookup_failed',
                 reason=str(response),
+                stage=stages.lookup,
+                retries=retries,
+                _random=_random,
                 )
             continue
         # Event does not exist anymore
@@ -145,6 +321,9 @@ def _save_events(
                 now=now,
                 field='lookup_failed',
                 reason='False response',
+                stage=stages.lookup,
+                retries=retries,
+                _random=_random,
                 )
             continue
         if response is None:
@@ -156,6 +335,9 @@ def _save_events(
                 now=now,
                 field='lookup_failed',
                 reason='Null response',
+                stage=stages.lookup,
+                retries=retries,
+                _random=_random,
                 )
             continue
 
@@ -173,6 +355,9 @@ def _save_events(
                 now=now,
                 field='lookup_failed',
                 reason='Response id is different',
+                stage=stages.lookup,
+                retries=retries,
+                _random=_random,
                 )
             continue
 
@@ -184,6 +369,9 @@ def _save_events(
                             # been set
                             ('source', 'facebook'),
                             ('lookup_completed', now),
+                            # Unlike now, which is when the job
+                            # started
+                            ('modified', _datetime.utcnow()),
                             ]),
                  ),
                 ])
@@ -203,6 +391,14 @@ def _save_events(
                 save['facebook']['end_time'],
                 naive=True,
                 )
+            # Lets the API filter out long-running events
+            duration = (
+                save['facebook']['end_time']
+                - save['facebook']['start_time']
+                )
+            save['ubernear']['duration_seconds'] = (
+                duration.days * 24 * 60 * 60 + duration.seconds
+                )
         else:
             _mark_as_failed(
                 events_coll=events_coll,
@@ -210,6 +406,9 @@ def _save_events(
                 now=now,
                 field='lookup_failed',
                 reason='Missing start_time or end_time',
+                stage=stages.lookup,
+                retries=retries,
+                _random=_random,
                 )
             continue
         if 'updated_time' in save['facebook']:
@@ -217,6 +416,18 @@ def _save_events(
                 save['facebook']['updated_time'],
                 naive=True,
                 )
+        # Searched by the API
+        save['ubernear']['tokens'] = search_tokens(
+            u'{name} {description}'.format(
+                name=save['facebook'].get('name', u''),
+                description=save['facebook'].get('description', u''),
+                )
+            )
+        # Replaces the lookup stage
+        save['ubernear']['stages'] = stages.next_stages(
+            event=event,
+            facebook=save['facebook'],
+            )
 
 
         _log.debug(
@@ -225,19 +436,76 @@ def _save_events(
                 )
             )
 
+        # Later failures are retried from the first delay again
         mongo.save_no_replace(
             events_coll,
             _id=event['_id'],
             save=save,
+            unset=['ubernear.retry_count', stages.retry_at_field],
             )
 
+def _save_events(
+    events,
+    events_coll,
+    graph,
+    now,
+    _log=None,
+    _random=None,
+    _datetime=None,
+    ):
+    responses = _fetch_events(
+        events=events,
+        graph=graph,
+        )
+    _store_events(
+        events=events,
+        responses=responses,
+        events_coll=events_coll,
+        now=now,
+        _log=_log,
+        _random=_random,
+        _datetime=_datetime,
+        )
+
+def _iter_batches(events, size):
+    batch = []
+    for event in events:
+        batch.append(event)
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
 def update_facebook(
     events_coll,
     graph,
     process_all=False,
+    concurrency=1,
+    batch_rate=None,
+    bulk_size=None,
+    bulk_interval=None,
+    jobs_coll=None,
+    chunk_size=1000,
     _log=None,
     _datetime=None,
+    _time=None,
+    _sleep=None,
+    _random=None,
     ):
+    """
+    Look up events in the Graph API, facebook_batch_size at a
+    time, with up to concurrency batch requests in flight at once
+    and at most batch_rate batch requests per second, when given.
+    Responses are stored by this thread in the order events are
+    read. When bulk_size is given, they are written in bulk as
+    mongo.bulk_writes does. When jobs_coll is given, events are
+    read in chunks of chunk_size and the run resumes from its
+    checkpoint as mongo.resumable_chunks does. Events which fail
+    with a transitional error are retried as _mark_as_failed
+    schedules.
+    """
     if _log is None:
         _log = log
     if _datetime is None:
@@ -246,56 +514,13 @@ def update_facebook(
     now = _datetime.utcnow()
 
     if process_all:
+        query = None
         events = events_coll.find()
     else:
-        # The next three represent transitional graph API errors
-        null_query = OrderedDict([
-                ('ubernear.lookup_failed.reason',
-                 'Null response',
-                 ),
-                ])
-        validating_query = OrderedDict([
-                ('ubernear.lookup_failed.reason', OrderedDict([
-                            ('$regex',
-                             'OAuthException error on get.*: '
-                             'Error validating application..'
-                             )
-                            ]),
-                 )
-                ])
-        retry_query = OrderedDict([
-                ('ubernear.lookup_failed.reason', OrderedDict([
-                            ('$regex',
-                             'OAuthException error on get.*: '
-                             'An unexpected error has occurred. '
-                             'Please retry your request later..'
-                             )
-                            ]),
-                 )
-                ])
-        or_query = OrderedDict([
-                ('$or',
-                 [null_query,
-                  validating_query,
-                  retry_query,
-                  ],
-                 ),
-                ])
-        match_query = OrderedDict([
-                ('ubernear.lookup_completed',
-                 OrderedDict([
-                            ('$exists', False),
-                            ]),
-                 ),
-                ])
-        and_query = OrderedDict([
-                ('$and', [match_query, or_query]),
-                ])
+        query = stages.due_query(stages.lookup, now)
         events = events_coll.find(
-            OrderedDict([
-                    ('$or', [match_query, and_query]),
-                    ]),
-            sort=[('ubernear.fetched', pymongo.ASCENDING)],
+            query,
+            sort=[(stages.retry_at_field, pymongo.ASCENDING)],
             )
 
     count = events.count()
@@ -307,29 +532,55 @@ def update_facebook(
                 ),
             )
 
-    event_batch = []
-    found_work = False
-    # TODO This cursor may timeout if there are too many results
-    for event in events:
-        found_work = True
-        event_batch.append(event)
-        if len(event_batch) == facebook_batch_size:
-            _save_events(
-                events=event_batch,
-                events_coll=events_coll,
-                graph=graph,
-                now=now,
-                _log=_log,
+    throttle = None
+    if batch_rate is not None:
+        # Shared by every worker thread
+        buckets = TokenBuckets(_time=_time)
+        def throttle():
+            wait_for_token(
+                buckets=buckets,
+                key='graph',
+                rate=batch_rate,
+                burst=1,
+                _sleep=_sleep,
                 )
-            event_batch = []
 
-    _save_events(
-        events=event_batch,
-        events_coll=events_coll,
-        graph=graph,
-        now=now,
-        _log=_log,
+    found_work = False
+    write_failures = []
+    chunks = mongo.resumable_chunks(
+        events,
+        events_coll,
+        spec=query,
+        job=stages.job_name(stages.lookup, process_all=process_all),
+        jobs_coll=jobs_coll,
+        size=chunk_size,
+        failures=write_failures,
         )
+    for chunk in chunks:
+        fetched = _fetch_batches(
+            batches=_iter_batches(chunk, facebook_batch_size),
+            graph=graph,
+            concurrency=concurrency,
+            throttle=throttle,
+            )
+        with mongo.bulk_writes(
+            events_coll,
+            size=bulk_size,
+            interval=bulk_interval,
+            stamps=change_stamps,
+            failures=write_failures,
+            ) as writes_coll:
+            for event_batch, responses in fetched:
+                found_work = True
+                _store_events(
+                    events=event_batch,
+                    responses=responses,
+                    events_coll=writes_coll,
+                    now=now,
+                    _log=_log,
+                    _random=_random,
+                    _datetime=_datetime,
+                    )
 
     return found_work
 
@@ -341,7 +592,8 @@ def expire(
     if _datetime is None:
         _datetime = datetime
 
-    last_week = _datetime.utcnow() - timedelta(days=7)
+    now = _datetime.utcnow()
+    last_week = now - timedelta(days=7)
     end_parts = [
         # No guarantees in documentation that
         # $lt doesn't return rows where
@@ -362,38 +614,25 @@ def expire(
     end_query = OrderedDict([
             ('$and', end_parts),
             ])
-    false_query = OrderedDict([
-            ('ubernear.lookup_failed.reason', 'False response'),
-            ])
-    # It seems facebook should return false instead of this error,
-    # i.e., the id cannot be found. No bug report has been found to
-    # confirm this although some reports suggest it.
-    unsupported_query = OrderedDict([
-            ('ubernear.lookup_failed.reason', OrderedDict([
-                        ('$regex',
-                         'GraphMethodException error on get.*'
-                         ': Unsupported get request..',
-                         ),
-                        ('$options', 'i'),
-                        ]),
-             )
-            ])
-    alias_query = OrderedDict([
-            ('ubernear.lookup_failed.reason', OrderedDict([
-                        ('$regex',
-                         'OAuthException error on get.*Some '
-                         'of the aliases you requested do not exist.*'
-                         ),
-                        ('$options', 'i'),
-                        ]),
-             )
-            ])
-    or_query = OrderedDict([
-            ('$or',
-             [false_query,
-              unsupported_query,
-              alias_query,
-              ],
+    # Events which do not exist anymore. Failures stored before
+    # their kind was have only their reason.
+    gone_query = OrderedDict([
+            ('$or', [
+                    OrderedDict([
+                            ('ubernear.lookup_failed.terminal', True),
+                            ('ubernear.lookup_failed.kind', 'gone'),
+                            ]),
+                    OrderedDict([
+                            ('ubernear.lookup_failed.kind', OrderedDict([
+                                        ('$exists', False),
+                                        ]),
+                             ),
+                            ('ubernear.lookup_failed.reason', OrderedDict([
+                                        ('$in', gone_failures),
+                                        ]),
+                             ),
+                            ]),
+                    ],
              ),
             ])
     facebook_query = OrderedDict([
@@ -403,7 +642,7 @@ def expire(
              ),
             ])
     failed_query = OrderedDict([
-        ('$and', [facebook_query, or_query]),
+        ('$and', [facebook_query, gone_query]),
         ])
     cursor = events_coll.find(
         OrderedDict([
@@ -431,6 +670,9 @@ def expire(
                     ('ubernear.place_ids', place_ids),
                     ])
             del ubernear['place_ids']
+        # API clients syncing changes learn about removed events
+        # from this stamp
+        ubernear['expired'] = _datetime.utcnow()
 
         mongo.save_no_replace(
             expired_coll,
@@ -446,42 +688,20 @@ def update_venue(
     events_coll,
     usps_id,
     process_all,
+    bulk_size=None,
+    bulk_interval=None,
+    jobs_coll=None,
+    chunk_size=1000,
     ):
     now = datetime.utcnow()
 
     if process_all:
+        query = None
         events = events_coll.find()
     else:
-        completed_query = OrderedDict([
-                ('ubernear.normalization_completed',
-                 OrderedDict([
-                            ('$exists', False),
-                            ]),
-                 ),
-                ])
-        failed_query = OrderedDict([
-                ('ubernear.normalization_failed',
-                 OrderedDict([
-                            ('$exists', False),
-                            ]),
-                 ),
-                ])
-        lookup_query = OrderedDict([
-                ('ubernear.lookup_completed',
-                 OrderedDict([
-                            ('$exists', True),
-                            ]),
-                 ),
-                ])
+        query = stages.stage_query(stages.normalize)
         events = events_coll.find(
-            OrderedDict([
-                    ('$and',
-                     [completed_query,
-                      failed_query,
-                      lookup_query,
-                      ]
-                     ),
-                    ]),
+            query,
             sort=[('ubernear.fetched', pymongo.ASCENDING)],
             )
 
@@ -495,131 +715,106 @@ def update_venue(
             )
     event_batch = []
     found_work = False
-    # TODO This cursor may timeout if there are too many results
-    for event in events:
-        found_work = True
-        # Don't send venues in the batch that can't be used
-        # Check for missing values here instead of in the query
-        # so it is explicitly known which events are not
-        # eligible for normalization
-        if not 'venue' in event['facebook']:
-            _mark_as_failed(
-                events_coll=events_coll,
-                event_id=event['_id'],
-                now=now,
-                field='normalization_failed',
-                reason='No venue',
-                )
-            continue
-        venue = event['facebook']['venue']
-        # The minimal requirements for the USPS API
-        if (
-            not 'street' in venue
-            or not 'city' in venue
-            or not 'state' in venue
-            ):
-            _mark_as_failed(
-                events_coll=events_coll,
-                event_id=event['_id'],
-                now=now,
-                field='normalization_failed',
-                reason='No street, city or state',
-                )
-            continue
-        # USPS doesn't take long names for states
-        venue['state'] = addr_util.normalize_state(
-            venue['state']
-            )
-        # Make sure it's a valid state abbreviation
-        if venue['state'] not in addr_util.state_abbrev.keys():
-            _mark_as_failed(
-                events_coll=events_coll,
-                event_id=event['_id'],
-                now=now,
-                field='normalization_failed',
-                reason='Invalid state',
-                )
-            continue
-        event_batch.append(event)
-        if len(event_batch) == usps_batch_size:
+    write_failures = []
+    chunks = mongo.resumable_chunks(
+        events,
+        events_coll,
+        spec=query,
+        job=stages.job_name(stages.normalize, process_all=process_all),
+        jobs_coll=jobs_coll,
+        size=chunk_size,
+        failures=write_failures,
+        )
+    for chunk in chunks:
+        with mongo.bulk_writes(
+            events_coll,
+            size=bulk_size,
+            interval=bulk_interval,
+            failures=write_failures,
+            ) as writes_coll:
+            for event in chunk:
+                found_work = True
+                # Don't send venues in the batch that can't be used
+                # Check for missing values here instead of in the query
+                # so it is explicitly known which events are not
+                # eligible for normalization
+                if not 'venue' in event['facebook']:
+                    _mark_as_failed(
+                        events_coll=writes_coll,
+                        event_id=event['_id'],
+                        now=now,
+                        field='normalization_failed',
+                        stage=stages.normalize,
+                        reason='No venue',
+                        )
+                    continue
+                venue = event['facebook']['venue']
+                # The minimal requirements for the USPS API
+                if (
+                    not 'street' in venue
+                    or not 'city' in venue
+                    or not 'state' in venue
+                    ):
+                    _mark_as_failed(
+                        events_coll=writes_coll,
+                        event_id=event['_id'],
+                        now=now,
+                        field='normalization_failed',
+                        stage=stages.normalize,
+                        reason='No street, city or state',
+                        )
+                    continue
+                # USPS doesn't take long names for states
+                venue['state'] = addr_util.normalize_state(
+                    venue['state']
+                    )
+                # Make sure it's a valid state abbreviation
+                if venue['state'] not in addr_util.state_abbrev.keys():
+                    _mark_as_failed(
+                        events_coll=writes_coll,
+                        event_id=event['_id'],
+                        now=now,
+                        field='normalization_failed',
+                        stage=stages.normalize,
+                        reason='Invalid state',
+                        )
+                    continue
+                event_batch.append(event)
+                if len(event_batch) == usps_batch_size:
+                    _save_venues(
+                        events=event_batch,
+                        events_coll=writes_coll,
+                        usps_id=usps_id,
+                        now=now,
+                        )
+                    event_batch = []
+
             _save_venues(
                 events=event_batch,
-                events_coll=events_coll,
+                events_coll=writes_coll,
                 usps_id=usps_id,
                 now=now,
                 )
             event_batch = []
 
-    _save_venues(
-        events=event_batch,
-        events_coll=events_coll,
-        usps_id=usps_id,
-        now=now,
-        )
-
     return found_work
 
 def update_coordinate(
     events_coll,
     yahoo_id,
     process_all,
+    bulk_size=None,
+    bulk_interval=None,
+    jobs_coll=None,
+    chunk_size=1000,
     ):
     now = datetime.utcnow()
 
     if process_all:
+        query = None
         events = events_coll.find()
     else:
-        latitude_query = OrderedDict([
-                ('facebook.venue.latitude',
-                 OrderedDict([
-                            ('$exists', False),
-                            ]),
-                 ),
-                ])
-        longitude_query = OrderedDict([
-                ('facebook.venue.longitude',
-                 OrderedDict([
-                            ('$exists', False),
-                            ]),
-                 ),
-                ])
-        or_query = OrderedDict([
-                ('$or',
-                 [latitude_query,
-                  longitude_query,
-                  ]
-                 ),
-                ])
-        failed_query = OrderedDict([
-                ('ubernear.geocoding_failed',
-                 OrderedDict([
-                            ('$exists', False),
-                            ]),
-                 ),
-                ])
-        completed_query = OrderedDict([
-                ('ubernear.geocoding_completed',
-                 OrderedDict([
-                            ('$exists', False),
-                            ]),
-                 ),
-                ])
-        lookup_query = OrderedDict([
-                ('ubernear.lookup_completed',
-                 OrderedDict([
-                            ('$exists', True),
-                            ]),
-                 ),
-                ])
-        query = OrderedDict([
-                ('$and',
-                 [or_query,
-                  failed_query,
-                  completed_query,
-                  lookup_query,
-                  ]
-                 ),
-                ])
+        query = stages.stage_query(stages.geocode)
         events = events_coll.find(
             query,
             sort=[('ubernear.fetched', pymongo.ASCENDING)],
@@ -637,84 +832,105 @@ def update_coordinate(
             ('found_work', False),
             ('sleep', None),
             ])
-    # TODO This cursor may timeout if there are too many results
-    for event in events:
-        found_work['found_work'] = True
-        # Check for missing values here instead of in the query
-        # so it is explicitly known which events are not
-        # eligible for geocoding
-        if not 'venue' in event['facebook']:
-            _mark_as_failed(
-                events_coll=events_coll,
-                event_id=event['_id'],
-                now=now,
-                field='geocoding_failed',
-                reason='No venue',
-                )
-            continue
-        venue = event['facebook']['venue']
-        # The minimal requirements for geocoding
-        if 'normalized' in event:
-            address = event['normalized']['address']
-            city = event['normalized']['city']
-        elif (
-            not 'street' in venue
-            or not 'city' in venue
-            ):
-            _mark_as_failed(
-                events_coll=events_coll,
-                event_id=event['_id'],
-                now=now,
-                field='geocoding_failed',
-                reason='No street or city',
-                )
-            continue
-        else:
-            address = venue['street']
-            city = venue['city']
-        request = '{address},{city}'.format(
-            address=address.encode('utf-8'),
-            city=city.encode('utf-8'),
-            )
-        try:
-            # TODO figure out which error corresponds to the
-            # rate limit reached and return the number of hours
-            # to sleep
-            response = geocoder.geocode_yahoo(request, yahoo_id)
-        except geocoder.GeocoderAmbiguousResultError, e:
-            _mark_as_failed(
-                events_coll=events_coll,
-                event_id=event['_id'],
-                now=now,
-                field='geocoding_failed',
-                reason=str(e),
-                )
-            continue
-        if response is None:
-            _mark_as_failed(
-                events_coll=events_coll,
-                event_id=event['_id'],
-                now=now,
-                field='geocoding_failed',
-                reason='Null response',
-                )
-            continue
-
-        save = OrderedDict([
-            ('facebook.venue.latitude', response['lat']),
-            ('facebook.venue.longitude', response['lng']),
-            ('ubernear.geocoding_completed', now),
-            ('ubernear.geocoding_source', 'yahoo'),
-            ])
-        log.debug(
-            'Storing coordinates for {event_id}'.format(
-                event_id=event['_id'],
-                )
-            )
-        mongo.save_no_replace(
+    write_failures = []
+    chunks = mongo.resumable_chunks(
+        events,
+        events_coll,
+        spec=query,
+        job=stages.job_name(stages.geocode, process_all=process_all),
+        jobs_coll=jobs_coll,
+        size=chunk_size,
+        failures=write_failures,
+        )
+    for chunk in chunks:
+        with mongo.bulk_writes(
             events_coll,
-            _id=event['_id'],
-            save=save,
-            )
+            size=bulk_size,
+            interval=bulk_interval,
+            failures=write_failures,
+            ) as writes_coll:
+            for event in chunk:
+                found_work['found_work'] = True
+                # Check for missing values here instead of in the query
+                # so it is explicitly known which events are not
+                # eligible for geocoding
+                if not 'venue' in event['facebook']:
+                    _mark_as_failed(
+                        events_coll=writes_coll,
+                        event_id=event['_id'],
+                        now=now,
+                        field='geocoding_failed',
+                        stage=stages.geocode,
+                        reason='No venue',
+                        )
+                    continue
+                venue = event['facebook']['venue']
+                # The minimal requirements for geocoding
+                if 'normalized' in event:
+                    address = event['normalized']['address']
+                    city = event['normalized']['city']
+                elif (
+                    not 'street' in venue
+                    or not 'city' in venue
+                    ):
+                    _mark_as_failed(
+                        events_coll=writes_coll,
+                        event_id=event['_id'],
+                        now=now,
+                        field='geocoding_failed',
+                        stage=stages.geocode,
+                        reason='No street or city',
+                        )
+                    continue
+                else:
+                    address = venue['street']
+                    city = venue['city']
+                request = '{address},{city}'.format(
+                    address=address.encode('utf-8'),
+                    city=city.encode('utf-8'),
+                    )
+                try:
+                    # TODO figure out which error corresponds to the
+                    # rate limit reached and return the number of hours
+                    # to sleep
+                    response = geocoder.geocode_yahoo(request, yahoo_id)
+                except geocoder.GeocoderAmbiguousResultError, e:
+                    _mark_as_failed(
+                        events_coll=writes_coll,
+                        event_id=event['_id'],
+                        now=now,
+                        field='geocoding_failed',
+                        stage=stages.geocode,
+                        reason=str(e),
+                        )
+                    continue
+                if response is None:
+                    _mark_as_failed(
+                        events_coll=writes_coll,
+                        event_id=event['_id'],
+                        now=now,
+                        field='geocoding_failed',
+                        stage=stages.geocode,
+                        reason='Null response',
+                        )
+                    continue
+
+                save = OrderedDict([
+                    ('facebook.venue.latitude', response['lat']),
+                    ('facebook.venue.longitude', response['lng']),
+                    ('ubernear.geocoding_completed', now),
+                    ('ubernear.geocoding_source', 'yahoo'),
+                    ])
+                log.debug(
+                    'Storing coordinates for {event_id}'.format(
+                        event_id=event['_id'],
+                        )
+                    )
+                mongo.save_no_replace(
+                    writes_coll,
+                    _id=event['_id'],
+                    save=save,
+                    remove=stages.done(stages.geocode),
+                    )
 
     return found_work
@@ -0,0 +1,247 @@
+import logging
+import pymongo
+
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+from ubernear.util import mongo
+from ubernear.stages import stages_field, retry_at_field
+from ubernear.event_results import (
+    live_query_parts,
+    changed_query_part,
+    coord_sort,
+    )
+
+log = logging.getLogger(__name__)
+
+# The indices each collection needs keyed by the collection's name
+# in the database configuration
+indices = OrderedDict([
+        ('events-collection', [
+                OrderedDict([
+                        ('facebook.end_time', pymongo.ASCENDING),
+                        ]),
+                OrderedDict([
+                        ('ubernear.fetched', pymongo.ASCENDING),
+                        ]),
+                # Each job finds its work by stage
+                OrderedDict([
+                        (stages_field, pymongo.ASCENDING),
+                        ('ubernear.fetched', pymongo.ASCENDING),
+                        ]),
+                # Lookups which are due
+                OrderedDict([
+                        (stages_field, pymongo.ASCENDING),
+                        (retry_at_field, pymongo.ASCENDING),
+                        ]),
+                # Resumable jobs read their stage in _id order
+                OrderedDict([
+                        (stages_field, pymongo.ASCENDING),
+                        ('_id', pymongo.ASCENDING),
+                        ]),
+                # geoNear and $box need a 2d index, and a collection
+                # can only have one
+                OrderedDict([
+                        ('match.ubernear.location', pymongo.GEO2D),
+                        ]),
+                # Requests for all events sort by start time and
+                # bound it when until is given. The end time is
+                # in the index so it is filtered without reading
+                # each event.
+                OrderedDict([
+                        ('facebook.start_time', pymongo.ASCENDING),
+                        ('facebook.end_time', pymongo.ASCENDING),
+                        ]),
+                # Paged requests for all events
+                OrderedDict([
+                        ('facebook.start_time', pymongo.ASCENDING),
+                        ('_id', pymongo.ASCENDING),
+                        ]),
+                # Streamed requests for all events and snapshots
+                OrderedDict(
+                    coord_sort
+                    + [('facebook.end_time', pymongo.ASCENDING)]
+                    ),
+                # Requests for a single coordinate
+                OrderedDict([
+                        ('match.ubernear.location', pymongo.ASCENDING),
+                        ('facebook.start_time', pymongo.ASCENDING),
+                        ]),
+                # Requests with max_duration
+                OrderedDict([
+                        ('ubernear.duration_seconds', pymongo.ASCENDING),
+                        ('facebook.start_time', pymongo.ASCENDING),
+                        ]),
+                # Requests for a tile
+                OrderedDict([
+                        ('match.ubernear.quadkey', pymongo.ASCENDING),
+                        ]),
+                # Searches
+                OrderedDict([
+                        ('ubernear.tokens', pymongo.ASCENDING),
+                        ]),
+                # Requests for changes
+                OrderedDict([
+                        ('ubernear.modified', pymongo.ASCENDING),
+                        ]),
+                OrderedDict([
+                        ('ubernear.match_completed', pymongo.ASCENDING),
+                        ]),
+                ]),
+        ('expired-collection', [
+                OrderedDict([
+                        ('facebook.end_time', pymongo.ASCENDING),
+                        ]),
+                OrderedDict([
+                        ('ubernear.expired', pymongo.ASCENDING),
+                        ]),
+                ]),
+        ('owners-collection', [
+                OrderedDict([
+                        ('ubernear.last_lookup', pymongo.ASCENDING),
+                        ]),
+                ]),
+        ('places-collection', [
+                OrderedDict([
+                        ('ubernear.location', pymongo.GEO2D),
+                        ]),
+                OrderedDict([
+                        ('ubernear.last_checked', pymongo.ASCENDING),
+                        ]),
+                ]),
+        ])
+
+def ensure_indices(
+    coll,
+    _log=None,
+    ):
+    """
+    Build, in the background, the indices of every collection in
+    coll, as returned by ubernear.util.config.collections, that
+    are missing.
+    """
+    if _log is None:
+        _log = log
+
+    for name, coll_indices in indices.iteritems():
+        collection = coll.get(name)
+        if collection is None:
+            continue
+        _log.debug(
+            'Ensuring indices for {name}'.format(
+                name=name,
+                )
+            )
+        mongo.create_indices(
+            collection=collection,
+            indices=coll_indices,
+            background=True,
+            )
+
+def api_queries(
+    _datetime=None,
+    ):
+    """
+    Return the name, spec and sort of each query the API makes
+    with find.
+    """
+    if _datetime is None:
+        _datetime = datetime
+
+    today = _datetime.now().replace(hour=0,minute=0,second=0,microsecond=0)
+    start_time = OrderedDict([
+            ('facebook.start_time', OrderedDict([
+                        ('$lte', today),
+                        ]),
+             ),
+            ])
+    location = OrderedDict([
+            ('match.ubernear.location', [-118.331231, 34.101593]),
+            ])
+    box = OrderedDict([
+            ('match.ubernear.location', OrderedDict([
+                        ('$within', OrderedDict([
+                                    ('$box', [
+                                            [-118.5, 33.9],
+                                            [-118.1, 34.2],
+                                            ]),
+                                    ]),
+                         ),
+                        ]),
+             ),
+            ])
+    by_start_time = [('facebook.start_time', pymongo.ASCENDING)]
+    by_start_time_and_id = by_start_time + [('_id', pymongo.ASCENDING)]
+    changed = changed_query_part(today - timedelta(days=1))
+    max_duration = OrderedDict([
+            ('ubernear.duration_seconds', OrderedDict([
+                        ('$lte', 24*60*60),
+                        ]),
+             ),
+            ])
+    tile = OrderedDict([
+            ('match.ubernear.quadkey', OrderedDict([
+                        ('$regex', '^0231'),
+                        ]),
+             ),
+            ])
+    tokens = OrderedDict([
+            ('ubernear.tokens', OrderedDict([
+                        ('$all', ['jazz', 'night']),
+                        ]),
+             ),
+            ])
+
+    return [
+        ('all', live_query_parts(today), by_start_time),
+        ('all until', live_query_parts(today) + [start_time], by_start_time),
+        ('all stream', live_query_parts(today), coord_sort),
+        ('all paged', live_query_parts(today), by_start_time_and_id),
+        ('single coordinate', [location], by_start_time),
+        ('single coordinate until', [location, start_time], by_start_time),
+        ('box', [box] + live_query_parts(today)[1:], by_start_time),
+        ('changes', live_query_parts(today) + [changed], None),
+        ('search', live_query_parts(today) + [tokens], by_start_time),
+        ('tile', live_query_parts(today) + [tile], None),
+        ('all max duration',
+         live_query_parts(today) + [max_duration],
+         by_start_time,
+         ),
+        ]
+
+def _uses_index(explain):
+    # MongoDB 3.0 and later explain queries differently
+    if 'queryPlanner' in explain:
+        return 'COLLSCAN' not in repr(explain['queryPlanner'])
+
+    return not explain['cursor'].startswith('BasicCursor')
+
+def check_api_indices(
+    events_coll,
+    _log=None,
+    _datetime=None,
+    ):
+    """
+    Explain each query the API makes and return the names of
+    those which do not use an index.
+    """
+    if _log is None:
+        _log = log
+
+    unindexed = []
+    for name, and_parts, sort in api_queries(_datetime=_datetime):
+        explain = events_coll.find(
+            OrderedDict([
+                    ('$and', and_parts),
+                    ]),
+            sort=sort,
+            ).explain()
+        if not _uses_index(explain):
+            _log.warn(
+                'The {name} query does not use an index'.format(
+                    name=name,
+                    )
+                )
+            unindexed.append(name)
+
+    return unindexed
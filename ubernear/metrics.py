@@ -0,0 +1,303 @@
+import time
+import bisect
+import threading
+import functools
+
+from collections import OrderedDict
+
+# In seconds
+default_buckets = [
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    ]
+# In bytes
+size_buckets = [
+    1024, 4*1024, 16*1024, 64*1024, 256*1024, 1024*1024, 4*1024*1024,
+    16*1024*1024,
+    ]
+# In documents
+count_buckets = [0, 1, 10, 100, 1000, 10000, 100000]
+
+# Requests are handled by a single thread, or greenlet when gevent
+# patches threading, from start to finish
+_local = threading.local()
+
+class RequestMetrics(object):
+    """
+    The time spent in each phase of a request and other counts.
+    Phases do not overlap: the time spent in a phase started while
+    another is running only counts towards the newer phase.
+    """
+    def __init__(
+        self,
+        _time=None,
+        ):
+        if _time is None:
+            _time = time.time
+
+        self._time = _time
+        self.started = _time()
+        self.timings = OrderedDict()
+        self.counts = OrderedDict()
+        self._phases = []
+        self._phase_started = None
+
+    def _add_time(self, now):
+        if self._phases:
+            phase = self._phases[-1]
+            self.timings[phase] = (
+                self.timings.get(phase, 0) + now - self._phase_started
+                )
+
+    def enter(self, phase):
+        now = self._time()
+        self._add_time(now)
+        self._phases.append(phase)
+        self._phase_started = now
+
+    def exit(self):
+        now = self._time()
+        self._add_time(now)
+        self._phases.pop()
+        self._phase_started = now
+
+    def add_count(self, name, count):
+        self.counts[name] = self.counts.get(name, 0) + count
+
+    def total(self):
+        return self._time() - self.started
+
+    def all_timings(self, total=None):
+        """
+        The timings together with the time not spent in any
+        phase, other, and the total time.
+        """
+        if total is None:
+            total = self.total()
+
+        timings = OrderedDict(self.timings)
+        timings['other'] = max(total - sum(self.timings.values()), 0)
+        timings['total'] = total
+
+        return timings
+
+    def fields(self, total=None):
+        """
+        Return the timings, in milliseconds, and counts as
+        key=value strings.
+        """
+        timings = self.all_timings(total=total)
+        fields = [
+            '{phase}_ms={ms:.3f}'.format(phase=phase, ms=seconds*1000)
+            for (phase, seconds) in timings.iteritems()
+            ]
+        fields += [
+            '{name}={count}'.format(name=name, count=count)
+            for (name, count) in self.counts.iteritems()
+            ]
+
+        return fields
+
+def start_request(_time=None):
+    request_metrics = RequestMetrics(_time=_time)
+    _local.current = request_metrics
+
+    return request_metrics
+
+def end_request():
+    _local.current = None
+
+def current():
+    """
+    The metrics of the request being handled by this thread or
+    None outside of a request.
+    """
+    return getattr(_local, 'current', None)
+
+class timing(object):
+    """
+    Time a block as phase of the current request, if any.
+    """
+    def __init__(self, phase):
+        self._phase = phase
+        self._metrics = None
+
+    def __enter__(self):
+        self._metrics = current()
+        if self._metrics is not None:
+            self._metrics.enter(self._phase)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._metrics is not None:
+            self._metrics.exit()
+
+def timed(phase):
+    """
+    Decorate a function so that calls are timed as phase.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timing(phase):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timed_iter(
+    iterable,
+    phase,
+    count=None,
+    ):
+    """
+    Time reading each item of iterable as phase and add the
+    number of items read to count.
+    """
+    with timing(phase):
+        iterator = iter(iterable)
+    while True:
+        with timing(phase):
+            try:
+                item = iterator.next()
+            except StopIteration:
+                return
+        if count is not None:
+            request_metrics = current()
+            if request_metrics is not None:
+                request_metrics.add_count(count, 1)
+        yield item
+
+def add_count(name, count):
+    request_metrics = current()
+    if request_metrics is not None:
+        request_metrics.add_count(name, count)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Histogram(object):
+    """
+    A Prometheus histogram with a single label.
+    """
+    def __init__(
+        self,
+        name,
+        description,
+        label,
+        buckets=None,
+        ):
+        if buckets is None:
+            buckets = default_buckets
+
+        self._name = name
+        self._description = description
+        self._label = label
+        self._buckets = sorted(buckets) + [float('inf')]
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            values = self._values.get(label_value)
+            if values is None:
+                values = OrderedDict([
+                        ('buckets', [0] * len(self._buckets)),
+                        ('sum', 0),
+                        ('count', 0),
+                        ])
+                self._values[label_value] = values
+            index = bisect.bisect_left(self._buckets, value)
+            for i in xrange(index, len(self._buckets)):
+                values['buckets'][i] += 1
+            values['sum'] += value
+            values['count'] += 1
+
+    def text(self):
+        lines = [
+            '# HELP {name} {description}'.format(
+                name=self._name,
+                description=self._description,
+                ),
+            '# TYPE {name} histogram'.format(name=self._name),
+            ]
+        with self._lock:
+            for (label_value, values) in self._values.iteritems():
+                label = '{label}="{value}"'.format(
+                    label=self._label,
+                    value=label_value,
+                    )
+                for (bound, count) in zip(self._buckets, values['buckets']):
+                    lines.append(
+                        '{name}_bucket{{{label},le="{le}"}} {count}'.format(
+                            name=self._name,
+                            label=label,
+                            le=_format_value(bound),
+                            count=count,
+                            )
+                        )
+                lines.append(
+                    '{name}_sum{{{label}}} {sum}'.format(
+                        name=self._name,
+                        label=label,
+                        sum=_format_value(values['sum']),
+                        )
+                    )
+                lines.append(
+                    '{name}_count{{{label}}} {count}'.format(
+                        name=self._name,
+                        label=label,
+                        count=values['count'],
+                        )
+                    )
+
+        return '\n'.join(lines) + '\n'
+
+class Registry(object):
+    """
+    Histograms of the metrics of every request handled by this
+    process.
+    """
+    def __init__(self):
+        self._seconds = Histogram(
+            name='ubernear_api_request_seconds',
+            description='Time spent in each phase of API requests.',
+            label='phase',
+            )
+        self._bytes = Histogram(
+            name='ubernear_api_response_bytes',
+            description='Size of API responses as sent.',
+            label='status',
+            buckets=size_buckets,
+            )
+        self._counts = Histogram(
+            name='ubernear_api_documents',
+            description=(
+                'Documents the database returned and events sent by '
+                'API requests.'
+                ),
+            label='kind',
+            buckets=count_buckets,
+            )
+
+    def observe(
+        self,
+        request_metrics,
+        total,
+        status,
+        size,
+        ):
+        timings = request_metrics.all_timings(total=total)
+        for (phase, seconds) in timings.iteritems():
+            self._seconds.observe(phase, seconds)
+        self._bytes.observe(status, size)
+        for (name, count) in request_metrics.counts.iteritems():
+            self._counts.observe(name, count)
+
+    def text(self):
+        return ''.join([
+                self._seconds.text(),
+                self._bytes.text(),
+                self._counts.text(),
+                ])
+
+registry = Registry()
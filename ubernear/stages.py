@@ -0,0 +1,156 @@
+import logging
+
+from datetime import datetime
+from collections import OrderedDict
+
+from ubernear.util import mongo
+
+log = logging.getLogger(__name__)
+
+# The work left to do on each event is kept in an indexed array so
+# that each job finds its events with an equality query instead of
+# scanning for missing fields. facebook-owner queues new events for
+# lookup, the lookup queues the remaining stages and each stage
+# removes itself once it is done with an event.
+stages_field = 'ubernear.stages'
+# When an event in the lookup stage is due. Set when it is queued
+# and pushed back after each failure which is retried.
+retry_at_field = 'ubernear.retry_at'
+
+lookup = 'lookup'
+normalize = 'normalize'
+geocode = 'geocode'
+match = 'match'
+
+# The stages which must be done with an event before each stage
+# takes it. Matching uses the normalized address and the geocoded
+# coordinate, and a failed match takes the event out of the stage.
+requires = OrderedDict([
+        (match, [normalize, geocode]),
+        ])
+
+def job_name(name, process_all=False):
+    """
+    The name of the checkpoint, in the jobs collection, of the job
+    called name. Runs over every event keep their own.
+    """
+    if process_all:
+        return '{name}-all'.format(name=name)
+    return name
+
+def stage_query(stage):
+    return OrderedDict([
+            (stages_field, stage),
+            ])
+
+def ready_query(stage):
+    """
+    The events which are not in any stage that stage requires.
+    """
+    return OrderedDict([
+            (stages_field, OrderedDict([
+                        ('$nin', requires.get(stage, [])),
+                        ]),
+             ),
+            ])
+
+def due_query(stage, now):
+    """
+    The events in stage which are due at now.
+    """
+    return OrderedDict([
+            (stages_field, stage),
+            (retry_at_field, OrderedDict([
+                        ('$lte', now),
+                        ]),
+             ),
+            ])
+
+def done(stage):
+    """
+    The changes, as save_no_replace's remove, that take an event
+    out of stage.
+    """
+    return OrderedDict([
+            (stages_field, stage),
+            ])
+
+def next_stages(event, facebook):
+    """
+    The stages left for event once facebook, the Graph API's
+    response, is stored.
+    """
+    ubernear = event.get('ubernear', {})
+    stages = []
+    if (
+        'normalization_completed' not in ubernear
+        and
+        'normalization_failed' not in ubernear
+        ):
+        stages.append(normalize)
+
+    venue = facebook.get('venue', {})
+    if (
+        ('latitude' not in venue or 'longitude' not in venue)
+        and
+        'geocoding_completed' not in ubernear
+        and
+        'geocoding_failed' not in ubernear
+        ):
+        stages.append(geocode)
+
+    # Events which could not be matched with a place are still
+    # matched with their venue
+    if 'match_completed' not in ubernear:
+        stages.append(match)
+
+    return stages
+
+def queue_stages(
+    events_coll,
+    _log=None,
+    _datetime=None,
+    ):
+    """
+    Queue the stages left for events stored before stages were
+    tracked. This reads every event without stages so it is meant
+    to be run once.
+    """
+    if _log is None:
+        _log = log
+    if _datetime is None:
+        _datetime = datetime
+
+    now = _datetime.utcnow()
+    events = events_coll.find(
+        OrderedDict([
+                (stages_field, OrderedDict([
+                            ('$exists', False),
+                            ]),
+                 ),
+                ]),
+        )
+    count = 0
+    for event in events:
+        save = OrderedDict()
+        if 'lookup_completed' in event.get('ubernear', {}):
+            save[stages_field] = next_stages(
+                event=event,
+                facebook=event['facebook'],
+                )
+        else:
+            save[stages_field] = [lookup]
+            save[retry_at_field] = now
+        mongo.save_no_replace(
+            events_coll,
+            _id=event['_id'],
+            save=save,
+            )
+        count += 1
+
+    _log.info(
+        'Queued stages for {count} event{s}'.format(
+            count=count,
+            s='' if count == 1 else 's',
+            ),
+        )
@@ -1,14 +1,30 @@
+import os
+import gzip
 import json
+import zlib
+import bson
 import fudge
 
+from fudge.inspector import arg
 from nose.tools import eq_ as eq
 from collections import OrderedDict
 from datetime import datetime
 
-from ubernear.test.util import assert_raises
+from ubernear import metrics
+from ubernear.test.util import assert_raises, tmp_dirs
+from ubernear.event_results import (
+    summary_fields,
+    details_fields,
+    tile_fields,
+    )
 from ubernear.api import (
     EventAPI01,
     APIHTTPError,
+    GzipMiddleware,
+    APILogger,
+    _serve_worker,
+    encode_cursor,
+    decode_cursor,
     get_status,
     send_error,
     check_version,
@@ -416,6 +432,7 @@ class TestApi(object):
         update.with_args(
             OrderedDict([('_id', 'foo')]),
             change,
+            safe=False,
             )
 
         events_coll = fudge.Fake('events_coll')
@@ -1938,6 +1955,7 @@ class TestApi(object):
         update.with_args(
             OrderedDict([('_id', 'foo host')]),
             change,
+            safe=False,
             )
 
         events_coll = fudge.Fake('events_coll')
@@ -1966,6 +1984,7 @@ class TestApi(object):
         find.with_args(
             query,
             sort=[('facebook.start_time', 1)],
+            fields=summary_fields,
             )
 
         place = OrderedDict([
@@ -2021,6 +2040,9 @@ class TestApi(object):
                  )
         query.has_attr(key=_hash)
         query.has_attr(until='')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
+        query.has_attr(limit='', cursor='')
         fake_request.has_attr(query=query)
 
         environ = fudge.Fake('environ')
@@ -2106,6 +2128,7 @@ class TestApi(object):
         update.with_args(
             OrderedDict([('_id', 'foo host')]),
             change,
+            safe=False,
             )
 
         events_coll = fudge.Fake('events_coll')
@@ -2141,6 +2164,7 @@ class TestApi(object):
         find.with_args(
             query,
             sort=[('facebook.start_time', 1)],
+            fields=summary_fields,
             )
 
         place = OrderedDict([
@@ -2196,6 +2220,9 @@ class TestApi(object):
                  )
         query.has_attr(key=_hash)
         query.has_attr(until='2012-02-11T05:55:43.965992+00:00')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
+        query.has_attr(limit='', cursor='')
         fake_request.has_attr(query=query)
 
         environ = fudge.Fake('environ')
@@ -2273,6 +2300,9 @@ class TestApi(object):
                  )
         query.has_attr(key=_hash)
         query.has_attr(until='foo')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
+        query.has_attr(limit='', cursor='')
         fake_request.has_attr(query=query)
 
         environ = fudge.Fake('environ')
@@ -2337,6 +2367,7 @@ class TestApi(object):
         update.with_args(
             OrderedDict([('_id', 'foo host')]),
             change,
+            safe=False,
             )
 
         events_coll = fudge.Fake('events_coll')
@@ -2351,6 +2382,7 @@ class TestApi(object):
                     ('$and', [query])
                     ]),
             sort=[('facebook.start_time', 1)],
+            fields=details_fields,
             )
 
         place = OrderedDict([
@@ -2406,6 +2438,8 @@ class TestApi(object):
                  )
         query.has_attr(key=_hash)
         query.has_attr(until='')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
         fake_request.has_attr(query=query)
 
         environ = fudge.Fake('environ')
@@ -2508,6 +2542,7 @@ class TestApi(object):
         update.with_args(
             OrderedDict([('_id', 'foo host')]),
             change,
+            safe=False,
             )
 
         events_coll = fudge.Fake('events_coll')
@@ -2532,6 +2567,7 @@ class TestApi(object):
         find.with_args(
             query,
             sort=[('facebook.start_time', 1)],
+            fields=details_fields,
             )
 
         place = OrderedDict([
@@ -2587,6 +2623,8 @@ class TestApi(object):
                  )
         query.has_attr(key=_hash)
         query.has_attr(until='2012-02-11T05:55:43.965992+00:00')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
         fake_request.has_attr(query=query)
 
         environ = fudge.Fake('environ')
@@ -2708,6 +2746,8 @@ class TestApi(object):
                  )
         query.has_attr(key=_hash)
         query.has_attr(until='foo')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
         fake_request.has_attr(query=query)
 
         environ = fudge.Fake('environ')
@@ -2740,3 +2780,2371 @@ class TestApi(object):
             '"Invalid until parameter value"}}'
             )
         eq(error.status, 400)
+
+    @fudge.with_fakes
+    def test_all_cached(self):
+        keys_coll = fudge.Fake('keys_coll')
+
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        key = OrderedDict([
+                ('secret', 'foo secret'),
+                ('disabled', False),
+                ])
+        find_one.returns(key)
+
+        now = datetime(2012, 1, 23, 5, 26, 56)
+        update = keys_coll.expects('update')
+        update.times_called(2)
+
+        meta_coll = fudge.Fake('meta_coll')
+        find_one = meta_coll.expects('find_one')
+        find_one.with_args(OrderedDict([('_id', 'events')]))
+        find_one.times_called(1)
+        find_one.returns(
+            OrderedDict([
+                    ('_id', 'events'),
+                    ('generation', 3),
+                    ])
+            )
+
+        events_coll = fudge.Fake('events_coll')
+        find = events_coll.expects('find')
+        find.times_called(1)
+        place = OrderedDict([
+                ('name', 'Playhouse'),
+                ])
+        event = OrderedDict([
+                ('_id', '347324708616762'),
+                ('facebook', OrderedDict([
+                            ('id', '347324708616762'),
+                            ('end_time',
+                             datetime(2012, 1, 24, 1, 30),
+                             ),
+                            ]),
+                 ),
+                ('match', OrderedDict([
+                            ('ubernear', OrderedDict([
+                                        ('place_id',
+                                         'cb036268-2ba8-47db-906c-ca3b66d4da73'
+                                         ),
+                                        ('location', [-118.331231, 34.101593]),
+                                        ]),
+                             ),
+                            ('place', place),
+                            ])
+                 ),
+                ])
+        find.returns([event])
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        _hash = ('ff1ccc056ab035a8808bba5f76a56f4425fd4588c14aaad625'
+                 'c7bfb39ab92b92'
+                 )
+        query.has_attr(key=_hash)
+        query.has_attr(until='')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
+        query.has_attr(limit='', cursor='')
+        fake_request.has_attr(query=query)
+
+        fake_request.has_attr(environ={'REMOTE_ADDR': 'foo host'})
+
+        fake_response = fudge.Fake('response')
+        fake_response.provides('set_header')
+
+        fake_datetime = fudge.Fake('datetime')
+        utcnow = fake_datetime.expects('now')
+        utcnow.returns(now)
+
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(100.0)
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            meta_coll=meta_coll,
+            cache_size=2,
+            cache_ttl=300,
+            _time=fake_time,
+            )
+        res_1 = api._all(
+            _request=fake_request,
+            _response=fake_response,
+            _datetime=fake_datetime,
+            )
+        res_2 = api._all(
+            _request=fake_request,
+            _response=fake_response,
+            _datetime=fake_datetime,
+            )
+
+        eq(res_1, res_2)
+        eq(json.loads(res_2)['count']['events'], 1)
+
+    @fudge.with_fakes
+    def test_box_simple(self):
+        keys_coll = fudge.Fake('keys_coll')
+        keys_coll.remember_order()
+
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        key = OrderedDict([
+                ('secret', 'foo secret'),
+                ('disabled', False),
+                ])
+        find_one.returns(key)
+
+        now = datetime(2012, 1, 23, 5, 26, 56)
+        update = keys_coll.expects('update')
+        change = OrderedDict([
+                ('$set', OrderedDict([
+                            ('last_used', now),
+                            ]),
+                 ),
+                ('$inc', OrderedDict([
+                            ('times_used', 1),
+                            ]),
+                 ),
+                ])
+        update.with_args(
+            OrderedDict([('_id', 'foo host')]),
+            change,
+            safe=False,
+            )
+
+        events_coll = fudge.Fake('events_coll')
+        events_coll.remember_order()
+
+        find = events_coll.expects('find')
+        query = OrderedDict([
+                ('$and', [
+                        OrderedDict([
+                                ('match.ubernear.location', OrderedDict([
+                                            ('$within', OrderedDict([
+                                                        ('$box', [
+                                                                [-118.4, 34.0],
+                                                                [-118.3, 34.2],
+                                                                ]),
+                                                        ]),
+                                             ),
+                                            ]),
+                                 ),
+                                ]),
+                        OrderedDict([
+                                ('facebook.end_time', OrderedDict([
+                                            ('$gt',
+                                             datetime(2012, 1, 23),
+                                             ),
+                                            ]),
+                                 ),
+                                ]),
+                        ],
+                 ),
+                ])
+        find.with_args(
+            query,
+            sort=[('facebook.start_time', 1)],
+            fields=summary_fields,
+            )
+
+        place = OrderedDict([
+                ('address', '6506 Hollywood Blvd'),
+                ('name', 'Playhouse'),
+                ])
+        event = OrderedDict([
+                ('_id', '347324708616762'),
+                ('facebook', OrderedDict([
+                            ('name', 'Birthday Party'),
+                            ('id', '347324708616762'),
+                            ('start_time',
+                             datetime(2012, 1, 23, 20),
+                             ),
+                            ('end_time',
+                             datetime(2012, 1, 24, 1, 30),
+                             ),
+                            ]),
+                 ),
+                ('match', OrderedDict([
+                            ('ubernear', OrderedDict([
+                                        ('place_id',
+                                         'cb036268-2ba8-47db-906c-ca3b66d4da73'
+                                         ),
+                                        ('location', [-118.331231, 34.101593]),
+                                        ]),
+                             ),
+                            ('place', place),
+                            ])
+                 ),
+                ])
+        find.returns([event])
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        _hash = ('ff1ccc056ab035a8808bba5f76a56f4425fd4588c14aaad625'
+                 'c7bfb39ab92b92'
+                 )
+        query.has_attr(key=_hash)
+        query.has_attr(until='')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
+        fake_request.has_attr(query=query)
+
+        environ = fudge.Fake('environ')
+        environ.remember_order()
+        get = environ.expects('get')
+        get.with_args('REMOTE_ADDR')
+        get.returns('foo host')
+
+        fake_request.has_attr(environ=environ)
+
+        fake_datetime = fudge.Fake('datetime')
+        utcnow = fake_datetime.expects('now')
+        utcnow.with_arg_count(0)
+        utcnow.returns(now)
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            )
+        res = api._box(
+            '34.0',
+            '-118.4',
+            '34.2',
+            '-118.3',
+            _request=fake_request,
+            _datetime=fake_datetime,
+            )
+
+        res_event = OrderedDict([
+                ('id', '347324708616762'),
+                ])
+        expected = OrderedDict([
+                ('status', OrderedDict([
+                            ('code', 200),
+                            ('message', 'OK'),
+                            ]),
+                 ),
+                ('count', OrderedDict([
+                            ('events', 1),
+                            ('places', 1),
+                            ('coordinates', 1),
+                            ]),
+                 ),
+                ('data', OrderedDict([
+                            ('events', OrderedDict([
+                                        ('34.101593,-118.331231', [
+                                                res_event,
+                                                ]
+                                         ),
+                                        ]),
+                             ),
+                            ]),
+                 ),
+                ])
+
+        expected = json.dumps(
+            expected,
+            default=datetime.isoformat,
+            )
+        eq(res, expected)
+
+    @fudge.with_fakes
+    def test_box_bad_coords(self):
+        keys_coll = fudge.Fake('keys_coll')
+        events_coll = fudge.Fake('events_coll')
+        fake_request = fudge.Fake('request')
+        fake_datetime = fudge.Fake('datetime')
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            )
+        error = assert_raises(
+            APIHTTPError,
+            api._box,
+            'foo',
+            '-118.4',
+            '34.2',
+            '-118.3',
+            _request=fake_request,
+            _datetime=fake_datetime,
+            )
+
+        eq(
+            error.output,
+            '{"status": {"code": 400, "message": '
+            '"Invalid coordinates"}}'
+            )
+        eq(error.status, 400)
+
+    @fudge.with_fakes
+    def test_box_invalid_box(self):
+        keys_coll = fudge.Fake('keys_coll')
+        events_coll = fudge.Fake('events_coll')
+        fake_request = fudge.Fake('request')
+        fake_datetime = fudge.Fake('datetime')
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            )
+        error = assert_raises(
+            APIHTTPError,
+            api._box,
+            '34.2',
+            '-118.4',
+            '34.0',
+            '-118.3',
+            _request=fake_request,
+            _datetime=fake_datetime,
+            )
+
+        eq(
+            error.output,
+            '{"status": {"code": 400, "message": '
+            '"Invalid box"}}'
+            )
+        eq(error.status, 400)
+
+    @fudge.with_fakes
+    def test_near_simple(self):
+        keys_coll = fudge.Fake('keys_coll')
+        keys_coll.remember_order()
+
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        key = OrderedDict([
+                ('secret', 'foo secret'),
+                ('disabled', False),
+                ])
+        find_one.returns(key)
+
+        now = datetime(2012, 1, 23, 5, 26, 56)
+        update = keys_coll.expects('update')
+        change = OrderedDict([
+                ('$set', OrderedDict([
+                            ('last_used', now),
+                            ]),
+                 ),
+                ('$inc', OrderedDict([
+                            ('times_used', 1),
+                            ]),
+                 ),
+                ])
+        update.with_args(
+            OrderedDict([('_id', 'foo host')]),
+            change,
+            safe=False,
+            )
+
+        place_1 = OrderedDict([
+                ('name', 'Playhouse'),
+                ])
+        place_2 = OrderedDict([
+                ('name', 'Tabaco House'),
+                ])
+        event_1 = OrderedDict([
+                ('_id', '347324708616762'),
+                ('facebook', OrderedDict([
+                            ('name', 'Birthday Party'),
+                            ('id', '347324708616762'),
+                            ('start_time',
+                             datetime(2012, 1, 23, 20),
+                             ),
+                            ('end_time',
+                             datetime(2012, 1, 24, 1, 30),
+                             ),
+                            ]),
+                 ),
+                ('match', OrderedDict([
+                            ('ubernear', OrderedDict([
+                                        ('place_id',
+                                         'cb036268-2ba8-47db-906c-ca3b66d4da73'
+                                         ),
+                                        ('location', [-118.331231, 34.101593]),
+                                        ]),
+                             ),
+                            ('place', place_1),
+                            ])
+                 ),
+                ])
+        event_2 = OrderedDict([
+                ('_id', '267649766610622'),
+                ('facebook', OrderedDict([
+                            ('name', 'Bachelor Party'),
+                            ('id', '267649766610622'),
+                            ('start_time',
+                             datetime(2012, 1, 23, 18),
+                             ),
+                            ('end_time',
+                             datetime(2012, 1, 24, 1, 30),
+                             ),
+                            ]),
+                 ),
+                ('match', OrderedDict([
+                            ('ubernear', OrderedDict([
+                                        ('place_id',
+                                         'cca1d8d3-83ef-44d8-876c-23592b14f6e4'
+                                         ),
+                                        ('location', [-118.396004, 34.167198]),
+                                        ]),
+                             ),
+                            ('place', place_2),
+                            ])
+                 ),
+                ])
+
+        database = fudge.Fake('database')
+        command = database.expects('command')
+        command.with_args(
+            bson.SON(
+                OrderedDict([
+                        ('geoNear', 'events'),
+                        ('near', [-118.331231, 34.101593]),
+                        ])
+                ),
+            spherical=True,
+            maxDistance=500.0/6371000,
+            distanceMultiplier=6371000,
+            query=OrderedDict([
+                    ('$and', [
+                            OrderedDict([
+                                    ('facebook.end_time', OrderedDict([
+                                                ('$gt',
+                                                 datetime(2012, 1, 23),
+                                                 ),
+                                                ]),
+                                     ),
+                                    ]),
+                            ],
+                     ),
+                    ]),
+            num=1000,
+            )
+        command.returns(
+            OrderedDict([
+                    ('ok', 1.0),
+                    ('results', [
+                            OrderedDict([
+                                    ('dis', 460.2),
+                                    ('obj', event_2),
+                                    ]),
+                            OrderedDict([
+                                    ('dis', 0.0),
+                                    ('obj', event_1),
+                                    ]),
+                            ],
+                     ),
+                    ])
+            )
+
+        events_coll = fudge.Fake('events_coll')
+        events_coll.has_attr(name='events')
+        events_coll.has_attr(database=database)
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        _hash = ('ff1ccc056ab035a8808bba5f76a56f4425fd4588c14aaad625'
+                 'c7bfb39ab92b92'
+                 )
+        query.has_attr(key=_hash)
+        query.has_attr(until='')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
+        query.has_attr(radius='500')
+        query.has_attr(limit='1')
+        fake_request.has_attr(query=query)
+
+        environ = fudge.Fake('environ')
+        environ.remember_order()
+        get = environ.expects('get')
+        get.with_args('REMOTE_ADDR')
+        get.returns('foo host')
+
+        fake_request.has_attr(environ=environ)
+
+        fake_datetime = fudge.Fake('datetime')
+        utcnow = fake_datetime.expects('now')
+        utcnow.with_arg_count(0)
+        utcnow.returns(now)
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            )
+        res = api._near(
+            '34.101593',
+            '-118.331231',
+            _request=fake_request,
+            _datetime=fake_datetime,
+            )
+
+        res_event = OrderedDict([
+                ('id', '347324708616762'),
+                ('event_link', 'http://facebook.com/events/347324708616762'),
+                ('name', 'Birthday Party'),
+                ('start_time',
+                 datetime(2012, 1, 23, 20),
+                 ),
+                ('end_time',
+                 datetime(2012, 1, 24, 1, 30),
+                 ),
+                ('place_id', 'b5396d0eaff5f58e8405f7af4129cc7b'),
+                ])
+        expected = OrderedDict([
+                ('status', OrderedDict([
+                            ('code', 200),
+                            ('message', 'OK'),
+                            ]),
+                 ),
+                ('count', OrderedDict([
+                            ('events', 1),
+                            ('places', 1),
+                            ('coordinates', 1),
+                            ]),
+                 ),
+                ('data', OrderedDict([
+                            ('events', OrderedDict([
+                                        ('34.101593,-118.331231', [
+                                                res_event,
+                                                ]
+                                         ),
+                                        ]),
+                             ),
+                            ('places', OrderedDict([
+                                        ('b5396d0eaff5f58e8405f7af4129cc7b',
+                                         place_1,
+                                         ),
+                                        ]),
+                             ),
+                            ('distances', OrderedDict([
+                                        ('34.101593,-118.331231', 0.0),
+                                        ]),
+                             ),
+                            ]),
+                 ),
+                ])
+
+        expected = json.dumps(
+            expected,
+            default=datetime.isoformat,
+            )
+        eq(res, expected)
+
+    @fudge.with_fakes
+    def test_near_command_error(self):
+        keys_coll = fudge.Fake('keys_coll')
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        find_one.returns(
+            OrderedDict([
+                    ('secret', 'foo secret'),
+                    ('disabled', False),
+                    ])
+            )
+
+        database = fudge.Fake('database')
+        command = database.expects('command')
+        command.returns(
+            OrderedDict([
+                    ('ok', 0.0),
+                    ('errmsg', 'no geo index'),
+                    ])
+            )
+
+        events_coll = fudge.Fake('events_coll')
+        events_coll.has_attr(name='events')
+        events_coll.has_attr(database=database)
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        _hash = ('ff1ccc056ab035a8808bba5f76a56f4425fd4588c14aaad625'
+                 'c7bfb39ab92b92'
+                 )
+        query.has_attr(key=_hash)
+        query.has_attr(until='')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
+        query.has_attr(radius='500')
+        query.has_attr(limit='1')
+        fake_request.has_attr(query=query)
+
+        environ = fudge.Fake('environ')
+        get = environ.expects('get')
+        get.with_args('REMOTE_ADDR')
+        get.returns('foo host')
+        fake_request.has_attr(environ=environ)
+
+        fake_datetime = fudge.Fake('datetime')
+        fake_datetime.provides('now').returns(
+            datetime(2012, 1, 23, 5, 26, 56),
+            )
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            )
+        error = assert_raises(
+            APIHTTPError,
+            api._near,
+            '34.101593',
+            '-118.331231',
+            _request=fake_request,
+            _datetime=fake_datetime,
+            )
+
+        eq(
+            error.output,
+            '{"status": {"code": 500, "message": '
+            '"Could not search for nearby events"}}'
+            )
+        eq(error.status, 500)
+
+    @fudge.with_fakes
+    def test_check_and_get_near_options_default(self):
+        keys_coll = fudge.Fake('keys_coll')
+        events_coll = fudge.Fake('events_coll')
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            )
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        query.has_attr(radius='')
+        query.has_attr(limit='')
+        fake_request.has_attr(query=query)
+
+        res = api._check_and_get_near_options(
+            _request=fake_request,
+            )
+
+        eq(res, (1000, 20))
+
+    @fudge.with_fakes
+    def test_check_and_get_near_options_error(self):
+        keys_coll = fudge.Fake('keys_coll')
+        events_coll = fudge.Fake('events_coll')
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            )
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        query.has_attr(radius='100')
+        query.has_attr(limit='1000')
+        fake_request.has_attr(query=query)
+
+        error = assert_raises(
+            APIHTTPError,
+            api._check_and_get_near_options,
+            _request=fake_request,
+            )
+
+        eq(
+            error.output,
+            '{"status": {"code": 400, "message": '
+            '"Invalid limit parameter value"}}'
+            )
+        eq(error.status, 400)
+
+    @fudge.with_fakes
+    def test_iter_results_by_coord_simple(self):
+        keys_coll = fudge.Fake('keys_coll')
+        events_coll = fudge.Fake('events_coll')
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            stream_chunk_size=64,
+            )
+
+        def event(_id, location, name, end_time):
+            return OrderedDict([
+                    ('_id', _id),
+                    ('facebook', OrderedDict([
+                                ('name', 'Party {_id}'.format(_id=_id)),
+                                ('id', _id),
+                                ('start_time', datetime(2012, 1, 23, 20)),
+                                ('end_time', end_time),
+                                ]),
+                     ),
+                    ('match', OrderedDict([
+                                ('ubernear', OrderedDict([
+                                            ('place_id', 'place ' + name),
+                                            ('location', location),
+                                            ]),
+                                 ),
+                                ('place', OrderedDict([
+                                            ('name', name),
+                                            ]),
+                                 ),
+                                ]),
+                     ),
+                    ])
+
+        end_time = datetime(2012, 1, 24, 1, 30)
+        events = [
+            event('1', [-118.331231, 34.101593], 'Playhouse', end_time),
+            event('2', [-118.331231, 34.101593], 'HousePlay', end_time),
+            event('3', [-118.331231, 34.101593], 'Expired',
+                  datetime(2012, 1, 23, 1),
+                  ),
+            event('4', [-118.396004, 34.167198], 'Rafu', end_time),
+            ]
+        now = datetime(2012, 1, 23, 18, 38, 18, 62766)
+
+        for details in [False, True]:
+            chunks = list(
+                api._iter_results_by_coord(
+                    events=events,
+                    now=now,
+                    details=details,
+                    )
+                )
+            expected = api._get_results_by_coord(
+                events=events,
+                now=now,
+                details=details,
+                )
+
+            assert len(chunks) > 1
+            eq(
+                json.loads(''.join(chunks)),
+                json.loads(expected),
+                )
+
+    @fudge.with_fakes
+    def test_iter_results_by_coord_empty(self):
+        keys_coll = fudge.Fake('keys_coll')
+        events_coll = fudge.Fake('events_coll')
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            )
+
+        res = ''.join(
+            api._iter_results_by_coord(
+                events=[],
+                now=datetime(2012, 1, 23, 18, 38, 18, 62766),
+                )
+            )
+
+        eq(
+            res,
+            '{"status": {"code": 200, "message": "OK"}, "data": '
+            '{"events": {}}, "count": {"events": 0, "places": 0, '
+            '"coordinates": 0}}',
+            )
+
+    @fudge.with_fakes
+    def test_gzip_middleware_simple(self):
+        def app(environ, start_response):
+            start_response(
+                '200 OK',
+                [('Content-Type', 'application/json'),
+                 ('Content-Length', '24'),
+                 ],
+                )
+            return ['{"foo": ', '"bar", ', '"sna": "fu"}']
+
+        fake_start_response = fudge.Fake(
+            'start_response',
+            callable=True,
+            )
+        fake_start_response.with_args(
+            '200 OK',
+            [('Content-Type', 'application/json'),
+             ('Content-Encoding', 'gzip'),
+             ('Vary', 'Accept-Encoding'),
+             ],
+            None,
+            )
+
+        middleware = GzipMiddleware(app)
+        environ = {'HTTP_ACCEPT_ENCODING': 'gzip, deflate'}
+        res = list(middleware(environ, fake_start_response))
+
+        assert len(res) > 1
+        res = zlib.decompress(''.join(res), 16 + zlib.MAX_WBITS)
+        eq(res, '{"foo": "bar", "sna": "fu"}')
+
+    @fudge.with_fakes
+    def test_gzip_middleware_already_encoded(self):
+        headers = [
+            ('Content-Type', 'application/json'),
+            ('Content-Encoding', 'gzip'),
+            ]
+        def app(environ, start_response):
+            start_response('200 OK', headers)
+            return ['foo']
+
+        fake_start_response = fudge.Fake(
+            'start_response',
+            callable=True,
+            )
+        fake_start_response.with_args('200 OK', headers, None)
+
+        middleware = GzipMiddleware(app)
+        environ = {'HTTP_ACCEPT_ENCODING': 'gzip'}
+        res = middleware(environ, fake_start_response)
+
+        eq(res, ['foo'])
+
+    @fudge.with_fakes
+    def test_api_logger_metrics(self):
+        def app(environ, start_response):
+            metrics.add_count('documents_returned', 2)
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return ['foo', 'bar']
+
+        fake_start_response = fudge.Fake(
+            'start_response',
+            callable=True,
+            )
+
+        fake_log = fudge.Fake('log')
+        info = fake_log.expects('info')
+        info.with_args(
+            arg.startswith(
+                'foo host GET /0.1?key=foo HTTP/1.1 200 OK 6 - - other_ms=',
+                )
+            )
+
+        environ = {
+            'REMOTE_ADDR': 'foo host',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/0.1',
+            'QUERY_STRING': 'key=foo',
+            }
+        middleware = APILogger(app)
+        with fudge.patched_context('ubernear.api', 'log', fake_log):
+            res = middleware(environ, fake_start_response)
+            eq(list(res), ['foo', 'bar'])
+            res.close()
+
+        eq(environ['ubernear.metrics'].counts['documents_returned'], 2)
+        eq(metrics.current(), None)
+        assert 'ubernear_api_documents_count{kind="documents_returned"}' in (
+            metrics.registry.text()
+            )
+
+    @fudge.with_fakes
+    def test_metrics_not_exposed(self):
+        api = EventAPI01(
+            keys_coll=None,
+            events_coll=None,
+            )
+        msg = assert_raises(
+            APIHTTPError,
+            api._metrics,
+            _response=fudge.Fake('response'),
+            )
+        eq(msg.status, 404)
+
+    @fudge.with_fakes
+    def test_all_stream(self):
+        keys_coll = fudge.Fake('keys_coll')
+
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        key = OrderedDict([
+                ('secret', 'foo secret'),
+                ('disabled', False),
+                ])
+        find_one.returns(key)
+
+        now = datetime(2012, 1, 23, 5, 26, 56)
+        update = keys_coll.expects('update')
+        update.times_called(2)
+
+        events_coll = fudge.Fake('events_coll')
+        find = events_coll.expects('find')
+        find.times_called(1)
+        query = OrderedDict([
+                ('$and', [
+                        OrderedDict([
+                                ('match', OrderedDict([
+                                            ('$exists', True),
+                                            ]),
+                                 ),
+                                ]),
+                        OrderedDict([
+                                ('facebook.end_time', OrderedDict([
+                                            ('$gt',
+                                             datetime(2012, 1, 23),
+                                             ),
+                                            ]),
+                                 ),
+                                ]),
+                        ],
+                 ),
+                ])
+        find.with_args(
+            query,
+            sort=[
+                ('match.place.latitude', 1),
+                ('match.place.longitude', 1),
+                ('facebook.start_time', 1),
+                ],
+            fields=summary_fields,
+            )
+        event = OrderedDict([
+                ('_id', '347324708616762'),
+                ('facebook', OrderedDict([
+                            ('id', '347324708616762'),
+                            ('end_time',
+                             datetime(2012, 1, 24, 1, 30),
+                             ),
+                            ]),
+                 ),
+                ('match', OrderedDict([
+                            ('ubernear', OrderedDict([
+                                        ('place_id',
+                                         'cb036268-2ba8-47db-906c-ca3b66d4da73'
+                                         ),
+                                        ('location', [-118.331231, 34.101593]),
+                                        ]),
+                             ),
+                            ('place', OrderedDict([
+                                        ('name', 'Playhouse'),
+                                        ]),
+                             ),
+                            ])
+                 ),
+                ])
+        find.returns([event])
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        _hash = ('ff1ccc056ab035a8808bba5f76a56f4425fd4588c14aaad625'
+                 'c7bfb39ab92b92'
+                 )
+        query.has_attr(key=_hash)
+        query.has_attr(until='')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
+        query.has_attr(limit='', cursor='')
+        fake_request.has_attr(query=query)
+
+        fake_request.has_attr(environ={'REMOTE_ADDR': 'foo host'})
+
+        fake_datetime = fudge.Fake('datetime')
+        utcnow = fake_datetime.expects('now')
+        utcnow.returns(now)
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            cache_size=2,
+            stream=True,
+            )
+        res_1 = ''.join(
+            api._all(
+                _request=fake_request,
+                _datetime=fake_datetime,
+                )
+            )
+        # Served from the cache
+        res_2 = api._all(
+            _request=fake_request,
+            _datetime=fake_datetime,
+            )
+
+        eq(res_1, res_2)
+        expected = OrderedDict([
+                ('status', OrderedDict([
+                            ('code', 200),
+                            ('message', 'OK'),
+                            ]),
+                 ),
+                ('data', OrderedDict([
+                            ('events', OrderedDict([
+                                        ('34.101593,-118.331231', [
+                                                OrderedDict([
+                                                        ('id',
+                                                         '347324708616762',
+                                                         ),
+                                                        ]),
+                                                ]
+                                         ),
+                                        ]),
+                             ),
+                            ]),
+                 ),
+                ('count', OrderedDict([
+                            ('events', 1),
+                            ('places', 1),
+                            ('coordinates', 1),
+                            ]),
+                 ),
+                ])
+        eq(res_1, json.dumps(expected))
+
+    @tmp_dirs(1)
+    @fudge.with_fakes
+    def test_open_snapshot_simple(self, tmp):
+        path = os.path.join(tmp, 'all.json.gz')
+        fp = gzip.open(path, 'wb')
+        fp.write('{"foo": "bar"}')
+        fp.close()
+        mtime = os.stat(path).st_mtime
+
+        fake_request = fudge.Fake('request')
+        fake_request.has_attr(environ={'HTTP_ACCEPT_ENCODING': 'gzip'})
+
+        fake_response = fudge.Fake('response')
+        set_header = fake_response.expects('set_header')
+        set_header.with_args('Content-Encoding', 'gzip')
+        set_header.next_call().with_args('Vary', 'Accept-Encoding')
+        set_header.next_call().with_args(
+            'Content-Length',
+            str(os.stat(path).st_size),
+            )
+
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(mtime + 10)
+
+        api = EventAPI01(
+            keys_coll=None,
+            events_coll=None,
+            snapshot_path=path,
+            _time=fake_time,
+            )
+        res = api._open_snapshot(
+            today=datetime.fromtimestamp(mtime - 10),
+            _request=fake_request,
+            _response=fake_response,
+            )
+        try:
+            body = res.read()
+        finally:
+            res.close()
+
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        eq(body, '{"foo": "bar"}')
+
+    @tmp_dirs(1)
+    @fudge.with_fakes
+    def test_open_snapshot_no_gzip(self, tmp):
+        path = os.path.join(tmp, 'all.json.gz')
+        fp = gzip.open(path, 'wb')
+        fp.write('{"foo": "bar"}')
+        fp.close()
+        mtime = os.stat(path).st_mtime
+
+        fake_request = fudge.Fake('request')
+        fake_request.has_attr(environ={})
+
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(mtime + 10)
+
+        api = EventAPI01(
+            keys_coll=None,
+            events_coll=None,
+            snapshot_path=path,
+            _time=fake_time,
+            )
+        res = api._open_snapshot(
+            today=datetime.fromtimestamp(mtime - 10),
+            _request=fake_request,
+            _response=fudge.Fake('response'),
+            )
+        try:
+            # Decompressed as it is sent
+            eq(isinstance(res, file), False)
+            body = ''.join(res)
+        finally:
+            res.close()
+
+        eq(body, '{"foo": "bar"}')
+
+    @tmp_dirs(1)
+    @fudge.with_fakes
+    def test_open_snapshot_stale(self, tmp):
+        path = os.path.join(tmp, 'all.json.gz')
+        fp = gzip.open(path, 'wb')
+        fp.write('{"foo": "bar"}')
+        fp.close()
+        mtime = os.stat(path).st_mtime
+
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(mtime + 60)
+
+        api = EventAPI01(
+            keys_coll=None,
+            events_coll=None,
+            snapshot_path=path,
+            snapshot_max_age=60,
+            _time=fake_time,
+            )
+        # Written too long ago
+        res = api._open_snapshot(
+            today=datetime.fromtimestamp(mtime - 10),
+            _request=fudge.Fake('request'),
+            _response=fudge.Fake('response'),
+            )
+        eq(res, None)
+
+        # Written before today
+        fake_time.returns(mtime + 10)
+        res = api._open_snapshot(
+            today=datetime.fromtimestamp(mtime + 5),
+            _request=fudge.Fake('request'),
+            _response=fudge.Fake('response'),
+            )
+        eq(res, None)
+
+    @fudge.with_fakes
+    def test_open_snapshot_missing(self):
+        api = EventAPI01(
+            keys_coll=None,
+            events_coll=None,
+            snapshot_path='/does/not/exist/all.json.gz',
+            )
+        res = api._open_snapshot(
+            today=datetime(2012, 1, 23),
+            _request=fudge.Fake('request'),
+            _response=fudge.Fake('response'),
+            )
+        eq(res, None)
+
+    @fudge.with_fakes
+    def test_check_and_get_key_cached(self):
+        keys_coll = fudge.Fake('keys_coll')
+
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        find_one.times_called(1)
+        key = OrderedDict([
+                ('secret', 'foo secret'),
+                ('disabled', False),
+                ])
+        find_one.returns(key)
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=fudge.Fake('events_coll'),
+            key_cache_size=2,
+            )
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        _hash = ('ff1ccc056ab035a8808bba5f76a56f4425fd4588c14aaad625'
+                 'c7bfb39ab92b92'
+                 )
+        query.has_attr(key=_hash)
+        fake_request.has_attr(query=query)
+        fake_request.has_attr(environ={'REMOTE_ADDR': 'foo host'})
+
+        eq(api._check_and_get_key(_request=fake_request), 'foo host')
+        eq(api._check_and_get_key(_request=fake_request), 'foo host')
+
+    @fudge.with_fakes
+    def test_check_and_get_key_cached_not_assigned(self):
+        keys_coll = fudge.Fake('keys_coll')
+
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        find_one.times_called(1)
+        find_one.returns(None)
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=fudge.Fake('events_coll'),
+            key_cache_size=2,
+            )
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        query.has_attr(key='foo key')
+        fake_request.has_attr(query=query)
+        fake_request.has_attr(environ={'REMOTE_ADDR': 'foo host'})
+
+        for i in xrange(2):
+            msg = assert_raises(
+                APIHTTPError,
+                api._check_and_get_key,
+                _request=fake_request,
+                )
+            eq(msg.status, 400)
+
+    @fudge.with_fakes
+    def test_check_and_get_key_rate_limited(self):
+        keys_coll = fudge.Fake('keys_coll')
+
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        find_one.times_called(1)
+        key = OrderedDict([
+                ('secret', 'foo secret'),
+                ('disabled', False),
+                ('rate_limit', 0.5),
+                ('rate_burst', 1),
+                ])
+        find_one.returns(key)
+
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(100.0)
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=fudge.Fake('events_coll'),
+            key_cache_size=2,
+            rate_limit=10,
+            _time=fake_time,
+            )
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        _hash = ('ff1ccc056ab035a8808bba5f76a56f4425fd4588c14aaad625'
+                 'c7bfb39ab92b92'
+                 )
+        query.has_attr(key=_hash)
+        fake_request.has_attr(query=query)
+        fake_request.has_attr(environ={'REMOTE_ADDR': 'foo host'})
+
+        eq(api._check_and_get_key(_request=fake_request), 'foo host')
+        error = assert_raises(
+            APIHTTPError,
+            api._check_and_get_key,
+            _request=fake_request,
+            )
+        eq(error.status, 429)
+        eq(error.headers['Retry-After'], '2')
+        eq(
+            json.loads(error.output),
+            OrderedDict([
+                    ('status', OrderedDict([
+                                ('code', 429),
+                                ('message', 'Rate limit exceeded'),
+                                ]),
+                     ),
+                    ]),
+            )
+
+    @fudge.with_fakes
+    def test_check_and_get_key_default_rate_limit(self):
+        keys_coll = fudge.Fake('keys_coll')
+
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        key = OrderedDict([
+                ('secret', 'foo secret'),
+                ('disabled', False),
+                ])
+        find_one.returns(key)
+
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(100.0)
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=fudge.Fake('events_coll'),
+            rate_limit=2,
+            _time=fake_time,
+            )
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        _hash = ('ff1ccc056ab035a8808bba5f76a56f4425fd4588c14aaad625'
+                 'c7bfb39ab92b92'
+                 )
+        query.has_attr(key=_hash)
+        fake_request.has_attr(query=query)
+        fake_request.has_attr(environ={'REMOTE_ADDR': 'foo host'})
+
+        # The burst defaults to the rate
+        for i in xrange(2):
+            eq(api._check_and_get_key(_request=fake_request), 'foo host')
+        error = assert_raises(
+            APIHTTPError,
+            api._check_and_get_key,
+            _request=fake_request,
+            )
+        eq(error.status, 429)
+        eq(error.headers['Retry-After'], '1')
+
+    @fudge.with_fakes
+    def test_set_collections_simple(self):
+        meta_coll = fudge.Fake('meta_coll')
+        find_one = meta_coll.expects('find_one')
+        find_one.with_args(OrderedDict([('_id', 'events')]))
+        find_one.returns(
+            OrderedDict([
+                    ('_id', 'events'),
+                    ('generation', 3),
+                    ])
+            )
+
+        # As a prefork worker does after forking
+        api = EventAPI01(
+            keys_coll=fudge.Fake('parent_keys_coll'),
+            events_coll=fudge.Fake('parent_events_coll'),
+            meta_coll=fudge.Fake('parent_meta_coll'),
+            )
+        api.set_collections(
+            keys_coll=fudge.Fake('keys_coll'),
+            events_coll=fudge.Fake('events_coll'),
+            meta_coll=meta_coll,
+            )
+
+        eq(api._get_generation(), 3)
+
+    @fudge.with_fakes
+    def test_update_key_batched(self):
+        keys_coll = fudge.Fake('keys_coll')
+        keys_coll.remember_order()
+
+        first = datetime(2012, 1, 23, 5, 26, 56)
+        last = datetime(2012, 1, 23, 5, 27, 10)
+        update = keys_coll.expects('update')
+        update.with_args(
+            OrderedDict([('_id', 'foo')]),
+            OrderedDict([
+                    ('$set', OrderedDict([
+                                ('last_used', last),
+                                ]),
+                     ),
+                    ('$inc', OrderedDict([
+                                ('times_used', 2),
+                                ]),
+                     ),
+                    ]),
+            safe=True,
+            )
+        update = keys_coll.next_call('update')
+        update.with_args(
+            OrderedDict([('_id', 'bar')]),
+            OrderedDict([
+                    ('$set', OrderedDict([
+                                ('last_used', first),
+                                ]),
+                     ),
+                    ('$inc', OrderedDict([
+                                ('times_used', 1),
+                                ]),
+                     ),
+                    ]),
+            safe=True,
+            )
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=fudge.Fake('events_coll'),
+            key_flush_interval=10,
+            )
+
+        api._update_key(key='foo', now=last)
+        api._update_key(key='bar', now=first)
+        api._update_key(key='foo', now=first)
+        api.flush_key_usage()
+        # Nothing left to flush
+        api.flush_key_usage()
+
+    @fudge.with_fakes
+    def test_all_not_modified(self):
+        keys_coll = fudge.Fake('keys_coll')
+
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        key = OrderedDict([
+                ('secret', 'foo secret'),
+                ('disabled', False),
+                ])
+        find_one.returns(key)
+
+        now = datetime(2012, 1, 23, 5, 26, 56)
+        update = keys_coll.expects('update')
+        update.times_called(1)
+
+        meta_coll = fudge.Fake('meta_coll')
+        find_one = meta_coll.expects('find_one')
+        find_one.with_args(OrderedDict([('_id', 'events')]))
+        find_one.returns(
+            OrderedDict([
+                    ('_id', 'events'),
+                    ('generation', 3),
+                    ('modified', datetime(2012, 1, 23, 13, 20)),
+                    ])
+            )
+
+        # No events are read
+        events_coll = fudge.Fake('events_coll')
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        _hash = ('ff1ccc056ab035a8808bba5f76a56f4425fd4588c14aaad625'
+                 'c7bfb39ab92b92'
+                 )
+        query.has_attr(key=_hash)
+        query.has_attr(until='')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
+        query.has_attr(limit='', cursor='')
+        fake_request.has_attr(query=query)
+        fake_request.has_attr(
+            environ={
+                'REMOTE_ADDR': 'foo host',
+                # Compared weakly
+                'HTTP_IF_NONE_MATCH': 'W/"2-20120123", "3-20120123"',
+                },
+            )
+
+        fake_response = fudge.Fake('response')
+        fake_response.remember_order()
+        set_header = fake_response.expects('set_header')
+        set_header.with_args('ETag', 'W/"3-20120123"')
+        set_header = fake_response.next_call('set_header')
+        set_header.with_args('Last-Modified', 'Mon, 23 Jan 2012 13:20:00 GMT')
+
+        fake_datetime = fudge.Fake('datetime')
+        utcnow = fake_datetime.expects('now')
+        utcnow.returns(now)
+
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(1200.0)
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            meta_coll=meta_coll,
+            _time=fake_time,
+            )
+        res = api._all(
+            _request=fake_request,
+            _response=fake_response,
+            _datetime=fake_datetime,
+            )
+
+        eq(res, '')
+        eq(fake_response.status, 304)
+
+    @fudge.with_fakes
+    def test_all_cached_gzip(self):
+        keys_coll = fudge.Fake('keys_coll')
+
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        key = OrderedDict([
+                ('secret', 'foo secret'),
+                ('disabled', False),
+                ])
+        find_one.returns(key)
+
+        now = datetime(2012, 1, 23, 5, 26, 56)
+        update = keys_coll.expects('update')
+        update.times_called(3)
+
+        events_coll = fudge.Fake('events_coll')
+        find = events_coll.expects('find')
+        find.times_called(1)
+        find.returns([])
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        _hash = ('ff1ccc056ab035a8808bba5f76a56f4425fd4588c14aaad625'
+                 'c7bfb39ab92b92'
+                 )
+        query.has_attr(key=_hash)
+        query.has_attr(until='')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
+        query.has_attr(limit='', cursor='')
+        fake_request.has_attr(query=query)
+        fake_request.has_attr(
+            environ={
+                'REMOTE_ADDR': 'foo host',
+                'HTTP_ACCEPT_ENCODING': 'gzip, deflate',
+                },
+            )
+
+        fake_response = fudge.Fake('response')
+        set_header = fake_response.expects('set_header')
+        set_header.times_called(6)
+
+        fake_datetime = fudge.Fake('datetime')
+        utcnow = fake_datetime.expects('now')
+        utcnow.returns(now)
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            cache_size=2,
+            )
+        res = [
+            api._all(
+                _request=fake_request,
+                _response=fake_response,
+                _datetime=fake_datetime,
+                )
+            for i in xrange(3)
+            ]
+
+        # Compressed only once
+        assert res[0] is res[1] is res[2]
+        res = zlib.decompress(res[0], 16 + zlib.MAX_WBITS)
+        eq(json.loads(res)['count']['events'], 0)
+
+    @fudge.with_fakes
+    def test_serve_worker_simple(self):
+        server = fudge.Fake('server')
+        server.remember_order()
+        on_worker_start = fudge.Fake('on_worker_start', callable=True)
+        on_worker_exit = fudge.Fake('on_worker_exit', callable=True)
+        serve_forever = server.expects('serve_forever')
+        serve_forever.raises(KeyboardInterrupt)
+
+        assert_raises(
+            KeyboardInterrupt,
+            _serve_worker,
+            server,
+            on_worker_start=on_worker_start.expects_call(),
+            on_worker_exit=on_worker_exit.expects_call(),
+            )
+
+    @fudge.with_fakes
+    def test_cursor_simple(self):
+        event = OrderedDict([
+                ('_id', '347324708616762'),
+                ('facebook', OrderedDict([
+                            ('start_time',
+                             datetime(2012, 1, 23, 20, 0, 0, 500),
+                             ),
+                            ]),
+                 ),
+                ])
+        cursor = encode_cursor(event)
+
+        eq(
+            decode_cursor(cursor),
+            (datetime(2012, 1, 23, 20, 0, 0, 500), '347324708616762'),
+            )
+
+    @fudge.with_fakes
+    def test_check_and_get_page_error(self):
+        api = EventAPI01(
+            keys_coll=fudge.Fake('keys_coll'),
+            events_coll=fudge.Fake('events_coll'),
+            )
+
+        for limit, cursor, message in [
+            ('0', '', 'Invalid limit parameter value'),
+            ('foo', '', 'Invalid limit parameter value'),
+            ('', 'foo', 'Invalid cursor parameter value'),
+            ]:
+            fake_request = fudge.Fake('request')
+            query = fudge.Fake('query')
+            query.has_attr(limit=limit, cursor=cursor)
+            fake_request.has_attr(query=query)
+
+            msg = assert_raises(
+                APIHTTPError,
+                api._check_and_get_page,
+                _request=fake_request,
+                )
+            eq(msg.status, 400)
+            eq(json.loads(msg.output)['status']['message'], message)
+
+    @fudge.with_fakes
+    def test_all_paged(self):
+        keys_coll = fudge.Fake('keys_coll')
+
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        key = OrderedDict([
+                ('secret', 'foo secret'),
+                ('disabled', False),
+                ])
+        find_one.returns(key)
+
+        now = datetime(2012, 1, 23, 5, 26, 56)
+        update = keys_coll.expects('update')
+
+        after = OrderedDict([
+                ('_id', '347324708616761'),
+                ('facebook', OrderedDict([
+                            ('start_time', datetime(2012, 1, 23, 19, 0)),
+                            ]),
+                 ),
+                ])
+
+        events_coll = fudge.Fake('events_coll')
+        find = events_coll.expects('find')
+        query = OrderedDict([
+                ('$and', [
+                        OrderedDict([
+                                ('match', OrderedDict([
+                                            ('$exists', True),
+                                            ]),
+                                 ),
+                                ]),
+                        OrderedDict([
+                                ('facebook.end_time', OrderedDict([
+                                            ('$gt',
+                                             datetime(2012, 1, 23),
+                                             ),
+                                            ]),
+                                 ),
+                                ]),
+                        OrderedDict([
+                                ('$or', [
+                                        OrderedDict([
+                                                ('facebook.start_time',
+                                                 OrderedDict([
+                                                            ('$gt',
+                                                             datetime(
+                                                                2012, 1, 23,
+                                                                19, 0,
+                                                                ),
+                                                             ),
+                                                            ]),
+                                                 ),
+                                                ]),
+                                        OrderedDict([
+                                                ('facebook.start_time',
+                                                 datetime(2012, 1, 23, 19, 0),
+                                                 ),
+                                                ('_id', OrderedDict([
+                                                            ('$gt',
+                                                             '347324708616761',
+                                                             ),
+                                                            ]),
+                                                 ),
+                                                ]),
+                                        ]),
+                                ]),
+                        ],
+                 ),
+                ])
+        find.with_args(
+            query,
+            sort=[
+                ('facebook.start_time', 1),
+                ('_id', 1),
+                ],
+            fields=summary_fields + ['facebook.start_time'],
+            limit=1,
+            )
+        event = OrderedDict([
+                ('_id', '347324708616762'),
+                ('facebook', OrderedDict([
+                            ('id', '347324708616762'),
+                            ('start_time',
+                             datetime(2012, 1, 23, 20, 0),
+                             ),
+                            ('end_time',
+                             datetime(2012, 1, 24, 1, 30),
+                             ),
+                            ]),
+                 ),
+                ('match', OrderedDict([
+                            ('ubernear', OrderedDict([
+                                        ('place_id',
+                                         'cb036268-2ba8-47db-906c-ca3b66d4da73'
+                                         ),
+                                        ('location', [-118.331231, 34.101593]),
+                                        ]),
+                             ),
+                            ('place', OrderedDict([
+                                        ('name', 'Playhouse'),
+                                        ]),
+                             ),
+                            ])
+                 ),
+                ])
+        find.returns([event])
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        _hash = ('ff1ccc056ab035a8808bba5f76a56f4425fd4588c14aaad625'
+                 'c7bfb39ab92b92'
+                 )
+        query.has_attr(key=_hash)
+        query.has_attr(until='')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
+        query.has_attr(limit='1', cursor=encode_cursor(after))
+        fake_request.has_attr(query=query)
+        fake_request.has_attr(environ={'REMOTE_ADDR': 'foo host'})
+
+        fake_datetime = fudge.Fake('datetime')
+        utcnow = fake_datetime.expects('now')
+        utcnow.returns(now)
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            )
+        res = api._all(
+            _request=fake_request,
+            _datetime=fake_datetime,
+            )
+
+        res = json.loads(res, object_pairs_hook=OrderedDict)
+        eq(res['count']['events'], 1)
+        eq(
+            res['data']['events'].keys(),
+            ['34.101593,-118.331231'],
+            )
+        eq(res['paging']['cursor'], encode_cursor(event))
+
+    @fudge.with_fakes
+    def test_changes_simple(self):
+        keys_coll = fudge.Fake('keys_coll')
+
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        key = OrderedDict([
+                ('secret', 'foo secret'),
+                ('disabled', False),
+                ])
+        find_one.returns(key)
+        keys_coll.expects('update')
+
+        since = datetime(2012, 1, 22, 13, 0)
+        events_coll = fudge.Fake('events_coll')
+        find = events_coll.expects('find')
+        query = OrderedDict([
+                ('$and', [
+                        OrderedDict([
+                                ('match', OrderedDict([
+                                            ('$exists', True),
+                                            ]),
+                                 ),
+                                ]),
+                        OrderedDict([
+                                ('facebook.end_time', OrderedDict([
+                                            ('$gt',
+                                             datetime(2012, 1, 23),
+                                             ),
+                                            ]),
+                                 ),
+                                ]),
+                        OrderedDict([
+                                ('$or', [
+                                        OrderedDict([
+                                                ('ubernear.modified',
+                                                 OrderedDict([
+                                                            ('$gt', since),
+                                                            ]),
+                                                 ),
+                                                ]),
+                                        OrderedDict([
+                                                ('ubernear.match_completed',
+                                                 OrderedDict([
+                                                            ('$gt', since),
+                                                            ]),
+                                                 ),
+                                                ]),
+                                        ]),
+                                ]),
+                        ],
+                 ),
+                ])
+        find.with_args(
+            query,
+            fields=details_fields,
+            )
+        event = OrderedDict([
+                ('_id', '347324708616762'),
+                ('facebook', OrderedDict([
+                            ('name', 'Birthday Party'),
+                            ('id', '347324708616762'),
+                            ('start_time',
+                             datetime(2012, 1, 23, 20, 0),
+                             ),
+                            ('end_time',
+                             datetime(2012, 1, 24, 1, 30),
+                             ),
+                            ]),
+                 ),
+                ('match', OrderedDict([
+                            ('ubernear', OrderedDict([
+                                        ('place_id',
+                                         'cb036268-2ba8-47db-906c-ca3b66d4da73'
+                                         ),
+                                        ('location', [-118.331231, 34.101593]),
+                                        ]),
+                             ),
+                            ('place', OrderedDict([
+                                        ('name', 'Playhouse'),
+                                        ]),
+                             ),
+                            ])
+                 ),
+                ])
+        find.returns([event])
+
+        expired_coll = fudge.Fake('expired_coll')
+        find = expired_coll.expects('find')
+        find.with_args(
+            OrderedDict([
+                    ('ubernear.expired', OrderedDict([
+                                ('$gt', since),
+                                ]),
+                     ),
+                    ]),
+            fields=['_id'],
+            )
+        find.returns([OrderedDict([('_id', '226680217397995')])])
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        _hash = ('ff1ccc056ab035a8808bba5f76a56f4425fd4588c14aaad625'
+                 'c7bfb39ab92b92'
+                 )
+        query.has_attr(key=_hash)
+        query.has_attr(since='2012-01-22T05:00:00-08:00')
+        fake_request.has_attr(query=query)
+        fake_request.has_attr(environ={'REMOTE_ADDR': 'foo host'})
+
+        fake_datetime = fudge.Fake('datetime')
+        fake_datetime.expects('now').returns(
+            datetime(2012, 1, 23, 5, 26, 56),
+            )
+        fake_datetime.expects('utcnow').returns(
+            datetime(2012, 1, 23, 13, 26, 56),
+            )
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            expired_coll=expired_coll,
+            )
+        res = api._changes(
+            _request=fake_request,
+            _datetime=fake_datetime,
+            )
+
+        res = json.loads(res, object_pairs_hook=OrderedDict)
+        eq(res['count']['events'], 1)
+        eq(
+            res['data']['events']['34.101593,-118.331231'][0]['name'],
+            'Birthday Party',
+            )
+        eq(res['data']['deleted'], ['226680217397995'])
+        eq(res['paging']['since'], '2012-01-23T13:25:56+00:00')
+
+    @fudge.with_fakes
+    def test_check_and_get_since_error(self):
+        api = EventAPI01(
+            keys_coll=fudge.Fake('keys_coll'),
+            events_coll=fudge.Fake('events_coll'),
+            )
+
+        # Times without a timezone are ambiguous
+        for since in ['', 'foo', '2012-01-22T05:00:00']:
+            fake_request = fudge.Fake('request')
+            query = fudge.Fake('query')
+            query.has_attr(since=since)
+            fake_request.has_attr(query=query)
+
+            msg = assert_raises(
+                APIHTTPError,
+                api._check_and_get_since,
+                _request=fake_request,
+                )
+            eq(msg.status, 400)
+            eq(
+                json.loads(msg.output)['status']['message'],
+                'Invalid since parameter value',
+                )
+
+    @fudge.with_fakes
+    def test_check_and_get_format_msgpack(self):
+        fake_request = fudge.Fake('request')
+        fake_request.has_attr(
+            environ={
+                'HTTP_ACCEPT': 'application/x-msgpack, application/json',
+                },
+            )
+
+        fake_response = fudge.Fake('response')
+        set_header = fake_response.expects('set_header')
+        set_header.with_args('Vary', 'Accept')
+
+        api = EventAPI01(
+            keys_coll=None,
+            events_coll=None,
+            msgpack=True,
+            )
+        res = api._check_and_get_format(
+            _request=fake_request,
+            _response=fake_response,
+            )
+
+        eq(res, 'msgpack')
+        eq(fake_response.content_type, 'application/x-msgpack')
+
+    @fudge.with_fakes
+    def test_check_and_get_format_json(self):
+        fake_request = fudge.Fake('request')
+        fake_request.has_attr(environ={'HTTP_ACCEPT': 'application/json'})
+
+        fake_response = fudge.Fake('response')
+        fake_response.expects('set_header').with_args('Vary', 'Accept')
+
+        api = EventAPI01(
+            keys_coll=None,
+            events_coll=None,
+            msgpack=True,
+            )
+        res = api._check_and_get_format(
+            _request=fake_request,
+            _response=fake_response,
+            )
+        eq(res, 'json')
+
+        # The Accept header is ignored unless MessagePack is enabled
+        api = EventAPI01(
+            keys_coll=None,
+            events_coll=None,
+            )
+        res = api._check_and_get_format(
+            _request=fudge.Fake('request'),
+            _response=fudge.Fake('response'),
+            )
+        eq(res, 'json')
+
+    @fudge.with_fakes
+    def test_check_not_modified_msgpack(self):
+        meta_coll = fudge.Fake('meta_coll')
+        find_one = meta_coll.expects('find_one')
+        find_one.returns(
+            OrderedDict([
+                    ('_id', 'events'),
+                    ('generation', 3),
+                    ])
+            )
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        query.has_attr(happening_now='')
+        fake_request.has_attr(query=query)
+        fake_request.has_attr(environ={'HTTP_IF_NONE_MATCH': '"3-20120123"'})
+
+        fake_response = fudge.Fake('response')
+        fake_response.remember_order()
+        set_header = fake_response.expects('set_header')
+        set_header.with_args('ETag', 'W/"3-20120123-msgpack"')
+        set_header = fake_response.next_call('set_header')
+        set_header.with_args('Last-Modified', 'Mon, 23 Jan 2012 08:00:00 GMT')
+
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(1200.0)
+
+        api = EventAPI01(
+            keys_coll=None,
+            events_coll=None,
+            meta_coll=meta_coll,
+            msgpack=True,
+            _time=fake_time,
+            )
+        res = api._check_not_modified(
+            fmt='msgpack',
+            today=datetime(2012, 1, 23),
+            _request=fake_request,
+            _response=fake_response,
+            )
+
+        # The JSON response's ETag does not match
+        eq(res, False)
+
+    @fudge.with_fakes
+    def test_check_not_modified_happening_now(self):
+        meta_coll = fudge.Fake('meta_coll')
+        find_one = meta_coll.expects('find_one')
+        find_one.returns(
+            OrderedDict([
+                    ('_id', 'events'),
+                    ('generation', 3),
+                    ])
+            )
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        query.has_attr(happening_now='true')
+        fake_request.has_attr(query=query)
+        fake_request.has_attr(environ={'HTTP_IF_NONE_MATCH': '"3-20120123"'})
+
+        # Neither header is set
+        fake_response = fudge.Fake('response')
+
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(1200.0)
+
+        api = EventAPI01(
+            keys_coll=None,
+            events_coll=None,
+            meta_coll=meta_coll,
+            _time=fake_time,
+            )
+        res = api._check_not_modified(
+            today=datetime(2012, 1, 23),
+            _request=fake_request,
+            _response=fake_response,
+            )
+
+        eq(res, False)
+
+    @fudge.with_fakes
+    def test_search_simple(self):
+        keys_coll = fudge.Fake('keys_coll')
+
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        key = OrderedDict([
+                ('secret', 'foo secret'),
+                ('disabled', False),
+                ])
+        find_one.returns(key)
+        keys_coll.expects('update')
+
+        events_coll = fudge.Fake('events_coll')
+        find = events_coll.expects('find')
+        query = OrderedDict([
+                ('$and', [
+                        OrderedDict([
+                                ('match', OrderedDict([
+                                            ('$exists', True),
+                                            ]),
+                                 ),
+                                ]),
+                        OrderedDict([
+                                ('facebook.end_time', OrderedDict([
+                                            ('$gt',
+                                             datetime(2012, 1, 23),
+                                             ),
+                                            ]),
+                                 ),
+                                ]),
+                        OrderedDict([
+                                ('ubernear.tokens', OrderedDict([
+                                            ('$all', ['jazz', 'night']),
+                                            ]),
+                                 ),
+                                ]),
+                        ],
+                 ),
+                ])
+        find.with_args(
+            query,
+            sort=[('facebook.start_time', 1)],
+            fields=details_fields,
+            limit=1000,
+            )
+
+        def event(_id, name, start_time, location):
+            return OrderedDict([
+                    ('_id', _id),
+                    ('facebook', OrderedDict([
+                                ('id', _id),
+                                ('name', name),
+                                ('start_time', start_time),
+                                ('end_time', datetime(2012, 1, 24, 1, 30)),
+                                ]),
+                     ),
+                    ('match', OrderedDict([
+                                ('ubernear', OrderedDict([
+                                            ('place_id', 'foo place'),
+                                            ('location', location),
+                                            ]),
+                                 ),
+                                ('place', OrderedDict([
+                                            ('name', 'Playhouse'),
+                                            ]),
+                                 ),
+                                ])
+                     ),
+                    ])
+        find.returns([
+                event(
+                    '1',
+                    'Open Mic',
+                    datetime(2012, 1, 23, 19),
+                    [-118.1, 34.1],
+                    ),
+                event(
+                    '2',
+                    'Jazz Night',
+                    datetime(2012, 1, 23, 20),
+                    [-118.2, 34.2],
+                    ),
+                event(
+                    '3',
+                    'Night Out',
+                    datetime(2012, 1, 23, 21),
+                    [-118.3, 34.3],
+                    ),
+                ])
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        _hash = ('ff1ccc056ab035a8808bba5f76a56f4425fd4588c14aaad625'
+                 'c7bfb39ab92b92'
+                 )
+        query.has_attr(key=_hash)
+        query.has_attr(q='Jazz, night', limit='2', until='')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
+        fake_request.has_attr(query=query)
+        fake_request.has_attr(environ={'REMOTE_ADDR': 'foo host'})
+
+        fake_datetime = fudge.Fake('datetime')
+        fake_datetime.expects('now').returns(
+            datetime(2012, 1, 23, 5, 26, 56),
+            )
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            )
+        res = api._search(
+            _request=fake_request,
+            _datetime=fake_datetime,
+            )
+
+        # Ranked by the words in the name and then by start time
+        res = json.loads(res, object_pairs_hook=OrderedDict)
+        eq(res['count']['events'], 2)
+        eq(
+            res['data']['events'].keys(),
+            ['34.2,-118.2', '34.3,-118.3'],
+            )
+
+    @fudge.with_fakes
+    def test_check_and_get_search_options_error(self):
+        api = EventAPI01(
+            keys_coll=fudge.Fake('keys_coll'),
+            events_coll=fudge.Fake('events_coll'),
+            )
+
+        for q, limit, message in [
+            ('', '', 'Invalid q parameter value'),
+            ('!?', '', 'Invalid q parameter value'),
+            ('jazz', '0', 'Invalid limit parameter value'),
+            ('jazz', '501', 'Invalid limit parameter value'),
+            ]:
+            fake_request = fudge.Fake('request')
+            query = fudge.Fake('query')
+            query.has_attr(q=q, limit=limit)
+            fake_request.has_attr(query=query)
+
+            msg = assert_raises(
+                APIHTTPError,
+                api._check_and_get_search_options,
+                _request=fake_request,
+                )
+            eq(msg.status, 400)
+            eq(json.loads(msg.output)['status']['message'], message)
+
+    @fudge.with_fakes
+    def test_check_and_get_time_filters_simple(self):
+        api = EventAPI01(
+            keys_coll=fudge.Fake('keys_coll'),
+            events_coll=fudge.Fake('events_coll'),
+            )
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        query.has_attr(max_duration='86400', happening_now='true')
+        query.has_attr(**{'from': '2012-02-11T05:55:43+00:00'})
+        fake_request.has_attr(query=query)
+
+        now = datetime(2012, 2, 10, 22, 0)
+        res = api._check_and_get_time_filters(
+            now=now,
+            _request=fake_request,
+            )
+
+        eq(res,
+           [OrderedDict([
+                    ('facebook.end_time', OrderedDict([
+                                ('$gt', datetime(2012, 2, 10, 21, 55, 43)),
+                                ]),
+                     ),
+                    ]),
+            OrderedDict([
+                    ('ubernear.duration_seconds', OrderedDict([
+                                ('$lte', 86400),
+                                ]),
+                     ),
+                    ]),
+            OrderedDict([
+                    ('facebook.start_time', OrderedDict([
+                                ('$lte', now),
+                                ]),
+                     ),
+                    ]),
+            OrderedDict([
+                    ('facebook.end_time', OrderedDict([
+                                ('$gt', now),
+                                ]),
+                     ),
+                    ]),
+            ]
+           )
+
+    @fudge.with_fakes
+    def test_check_and_get_time_filters_error(self):
+        api = EventAPI01(
+            keys_coll=fudge.Fake('keys_coll'),
+            events_coll=fudge.Fake('events_coll'),
+            )
+
+        for _from, max_duration, happening_now, message in [
+            ('foo', '', '', 'Invalid from parameter value'),
+            ('', '0', '', 'Invalid max_duration parameter value'),
+            ('', 'foo', '', 'Invalid max_duration parameter value'),
+            ('', '', 'yes', 'Invalid happening_now parameter value'),
+            ]:
+            fake_request = fudge.Fake('request')
+            query = fudge.Fake('query')
+            query.has_attr(
+                max_duration=max_duration,
+                happening_now=happening_now,
+                )
+            query.has_attr(**{'from': _from})
+            fake_request.has_attr(query=query)
+
+            msg = assert_raises(
+                APIHTTPError,
+                api._check_and_get_time_filters,
+                now=datetime(2012, 2, 10, 22, 0),
+                _request=fake_request,
+                )
+            eq(msg.status, 400)
+            eq(json.loads(msg.output)['status']['message'], message)
+
+    @fudge.with_fakes
+    def test_tile_simple(self):
+        keys_coll = fudge.Fake('keys_coll')
+
+        find_one = keys_coll.expects('find_one')
+        find_one.with_args('foo host')
+        key = OrderedDict([
+                ('secret', 'foo secret'),
+                ('disabled', False),
+                ])
+        find_one.returns(key)
+        keys_coll.expects('update')
+
+        events_coll = fudge.Fake('events_coll')
+        find = events_coll.expects('find')
+        query = OrderedDict([
+                ('$and', [
+                        OrderedDict([
+                                ('match', OrderedDict([
+                                            ('$exists', True),
+                                            ]),
+                                 ),
+                                ]),
+                        OrderedDict([
+                                ('facebook.end_time', OrderedDict([
+                                            ('$gt',
+                                             datetime(2012, 1, 23),
+                                             ),
+                                            ]),
+                                 ),
+                                ]),
+                        OrderedDict([
+                                ('match.ubernear.quadkey', OrderedDict([
+                                            ('$regex', '^023'),
+                                            ]),
+                                 ),
+                                ]),
+                        ],
+                 ),
+                ])
+        find.with_args(
+            query,
+            fields=tile_fields,
+            )
+        event = OrderedDict([
+                ('_id', '347324708616762'),
+                ('facebook', OrderedDict([
+                            ('name', 'Birthday Party'),
+                            ('id', '347324708616762'),
+                            ('start_time', datetime(2012, 1, 23, 20)),
+                            ('end_time', datetime(2012, 1, 24, 1, 30)),
+                            ]),
+                 ),
+                ('match', OrderedDict([
+                            ('ubernear', OrderedDict([
+                                        ('place_id', 'foo place'),
+                                        ('location', [-118.331231, 34.101593]),
+                                        ('quadkey', '023012311121321201'),
+                                        ]),
+                             ),
+                            ('place', OrderedDict([
+                                        ('name', 'Playhouse'),
+                                        ]),
+                             ),
+                            ])
+                 ),
+                ])
+        find.returns([event])
+
+        fake_request = fudge.Fake('request')
+        query = fudge.Fake('query')
+        _hash = ('ff1ccc056ab035a8808bba5f76a56f4425fd4588c14aaad625'
+                 'c7bfb39ab92b92'
+                 )
+        query.has_attr(key=_hash)
+        query.has_attr(until='')
+        query.has_attr(max_duration='', happening_now='')
+        query.has_attr(**{'from': ''})
+        fake_request.has_attr(query=query)
+        fake_request.has_attr(environ={'REMOTE_ADDR': 'foo host'})
+
+        fake_datetime = fudge.Fake('datetime')
+        fake_datetime.expects('now').returns(
+            datetime(2012, 1, 23, 5, 26, 56),
+            )
+
+        api = EventAPI01(
+            keys_coll=keys_coll,
+            events_coll=events_coll,
+            )
+        res = api._tile(
+            3,
+            1,
+            3,
+            _request=fake_request,
+            _datetime=fake_datetime,
+            )
+
+        res = json.loads(res, object_pairs_hook=OrderedDict)
+        eq(res['count'], OrderedDict([('events', 1), ('clusters', 1)]))
+        cluster = res['data']['clusters']['023012']
+        eq(cluster['count'], 1)
+        eq(cluster['latitude'], 34.101593)
+        eq(cluster['events'][0]['name'], 'Birthday Party')
+
+    @fudge.with_fakes
+    def test_tile_invalid(self):
+        api = EventAPI01(
+            keys_coll=fudge.Fake('keys_coll'),
+            events_coll=fudge.Fake('events_coll'),
+            )
+
+        for zoom, x, y in [(19, 0, 0), (2, 4, 0), (2, 0, -1)]:
+            msg = assert_raises(
+                APIHTTPError,
+                api._tile,
+                zoom,
+                x,
+                y,
+                _request=fudge.Fake('request'),
+                _datetime=fudge.Fake('datetime'),
+                )
+            eq(msg.status, 400)
+            eq(json.loads(msg.output)['status']['message'], 'Invalid tile')
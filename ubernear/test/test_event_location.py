@@ -24,6 +24,50 @@ class FakeCursor(object):
     def count(self, *args):
         return len(self._events)
 
+def _get_field(event, field):
+    value = event
+    for key in field.split('.'):
+        if key not in value:
+            return None
+        value = value[key]
+    return value
+
+class FakeEventsCollection(object):
+    """
+    Finds events with the parts of locate's queries which depend on
+    their stages and records the updates.
+    """
+    def __init__(self, events):
+        self._events = events
+        self.updates = []
+
+    def _matches(self, event, query):
+        for part in query['$and']:
+            for field, value in part.items():
+                found = _get_field(event, field)
+                if field == 'ubernear.stages':
+                    if isinstance(value, dict):
+                        if set(value['$nin']) & set(found):
+                            return False
+                    elif value not in found:
+                        return False
+                elif field == 'ubernear.match_failed':
+                    if isinstance(value, dict):
+                        if (found is not None) != value['$exists']:
+                            return False
+                    elif found != value:
+                        return False
+        return True
+
+    def find(self, query, sort=None):
+        return FakeCursor([
+                event for event in self._events
+                if self._matches(event, query)
+                ])
+
+    def update(self, spec, document, upsert=False, safe=False):
+        self.updates.append((spec['_id'], document))
+
 class TestEventLocation(object):
     def setUp(self):
         fudge.clear_expectations()
@@ -5121,16 +5165,11 @@ class TestEventLocation(object):
         find = events_coll.expects('find')
         query_parts = [
             OrderedDict([
-                    ('ubernear.lookup_completed',
-                     OrderedDict([
-                                ('$exists', True),
-                                ]),
-                     ),
+                    ('ubernear.stages', 'match'),
                     ]),
             OrderedDict([
-                    ('ubernear.match_completed',
-                     OrderedDict([
-                                ('$exists', False),
+                    ('ubernear.stages', OrderedDict([
+                                ('$nin', ['normalize', 'geocode']),
                                 ]),
                      ),
                     ]),
@@ -5186,6 +5225,15 @@ class TestEventLocation(object):
                                  [-118.331231, 34.101593],
                                  ),
                                 ('match.ubernear.matched', ['page']),
+                                ('match.ubernear.api_place_id',
+                                 'b5396d0eaff5f58e8405f7af4129cc7b',
+                                 ),
+                                ('match.ubernear.coord_key',
+                                 '34.101593,-118.331231',
+                                 ),
+                                ('match.ubernear.quadkey',
+                                 '023012311121321201',
+                                 ),
                                 ('match.place.address',
                                  '6506 Hollywood Blvd',
                                  ),
@@ -5199,8 +5247,16 @@ class TestEventLocation(object):
                                 ('ubernear.match_completed',
                                  datetime(2012, 5, 22, 3, 35, 8),
                                  ),
+                                ('ubernear.modified',
+                                 datetime(2012, 5, 22, 3, 35, 8),
+                                 ),
                                 ]),
-                     )]),
+                     ),
+                    ('$pull', OrderedDict([
+                                ('ubernear.stages', 'match'),
+                                ]),
+                     ),
+                    ]),
             upsert=True,
             safe=True,
             )
@@ -5224,6 +5280,15 @@ class TestEventLocation(object):
                                 ('match.ubernear.distance',
                                  44.07166072513344,
                                  ),
+                                ('match.ubernear.api_place_id',
+                                 'c4fff80bea530fad01e46f770f8c5993',
+                                 ),
+                                ('match.ubernear.coord_key',
+                                 '34.167198,-118.396004',
+                                 ),
+                                ('match.ubernear.quadkey',
+                                 '023012311102333032',
+                                 ),
                                 ('match.place.address', '320 E 2nd St'),
                                 ('match.place.country', 'US'),
                                 ('match.place.locality', 'Los Angeles'),
@@ -5237,8 +5302,16 @@ class TestEventLocation(object):
                                 ('ubernear.match_completed',
                                  datetime(2012, 5, 22, 3, 35, 8),
                                  ),
+                                ('ubernear.modified',
+                                 datetime(2012, 5, 22, 3, 35, 8),
+                                 ),
                                 ]),
-                     )]),
+                     ),
+                    ('$pull', OrderedDict([
+                                ('ubernear.stages', 'match'),
+                                ]),
+                     ),
+                    ]),
             upsert=True,
             safe=True,
             )
@@ -5264,9 +5337,11 @@ class TestEventLocation(object):
         query = OrderedDict([
                 ('$and', [
                         OrderedDict([
-                                ('ubernear.match_completed',
-                                 OrderedDict([
-                                            ('$exists', False),
+                                ('ubernear.stages', 'match'),
+                                ]),
+                        OrderedDict([
+                                ('ubernear.stages', OrderedDict([
+                                            ('$nin', ['normalize', 'geocode']),
                                             ]),
                                  ),
                                 ]),
@@ -5412,23 +5487,207 @@ class TestEventLocation(object):
         eq(found_work, True)
 
     @fudge.with_fakes
-    def test_locate_match_with_venue_simple(self):
+    def test_locate_match_with_place_slow(self):
         events_coll = fudge.Fake('events_coll')
         events_coll.remember_order()
 
         find = events_coll.expects('find')
-        query_parts = [
+        event = OrderedDict([
+                ('_id', '226680217397995'),
+                ('ubernear', OrderedDict([
+                            ('place_ids',
+                             ['cb036268-2ba8-47db-906c-ca3b66d4da73'],
+                             ),
+                            ]),
+                 ),
+                ])
+        find.returns(FakeCursor([event]))
+
+        # A request for changes made while the event is matched
+        # returns a since between when the job started and when
+        # the match is written. The match must be newer.
+        update = events_coll.expects('update')
+        update.with_args(
             OrderedDict([
-                    ('ubernear.lookup_completed',
-                     OrderedDict([
-                                ('$exists', True),
+                    ('_id', '226680217397995'),
+                    ]),
+            OrderedDict([
+                    ('$set', OrderedDict([
+                                ('match.ubernear.score', 100),
+                                ('match.ubernear.place_id',
+                                 'cb036268-2ba8-47db-906c-ca3b66d4da73'
+                                 ),
+                                ('match.ubernear.source', 'factual'),
+                                ('match.ubernear.location',
+                                 [-118.331231, 34.101593],
+                                 ),
+                                ('match.ubernear.api_place_id',
+                                 'b5396d0eaff5f58e8405f7af4129cc7b',
+                                 ),
+                                ('match.ubernear.coord_key',
+                                 '34.101593,-118.331231',
+                                 ),
+                                ('match.ubernear.quadkey',
+                                 '023012311121321201',
+                                 ),
+                                ('match.place.name', 'Playhouse'),
+                                ('ubernear.match_completed',
+                                 datetime(2012, 5, 22, 3, 35, 8),
+                                 ),
+                                ('ubernear.modified',
+                                 datetime(2012, 5, 22, 3, 41, 30),
+                                 ),
+                                ]),
+                     ),
+                    ('$pull', OrderedDict([
+                                ('ubernear.stages', 'match'),
+                                ]),
+                     ),
+                    ]),
+            upsert=True,
+            safe=True,
+            )
+
+        find = events_coll.next_call('find')
+        find.returns(FakeCursor([]))
+
+        fake_log = fudge.Fake('log')
+        fake_log.provides('info')
+
+        fake_match_with_place = fudge.Fake(
+            'match_with_place',
+            callable=True,
+            )
+        fake_match_with_place.returns(
+            OrderedDict([
+                    ('ubernear', OrderedDict([
+                                ('score', 100),
+                                ('place_id',
+                                 'cb036268-2ba8-47db-906c-ca3b66d4da73'
+                                 ),
+                                ('source', 'factual'),
+                                ('location', [-118.331231, 34.101593]),
                                 ]),
                      ),
+                    ('place', OrderedDict([
+                                ('name', 'Playhouse'),
+                                ]),
+                     ),
+                    ])
+            )
+
+        fake_datetime = fudge.Fake('datetime')
+        utcnow = fake_datetime.expects('utcnow')
+        utcnow.returns(datetime(2012, 5, 22, 3, 35, 8))
+        utcnow.next_call().returns(datetime(2012, 5, 22, 3, 41, 30))
+
+        found_work = event_location.locate(
+            events_coll=events_coll,
+            places_coll=fudge.Fake('places_coll'),
+            database=fudge.Fake('database'),
+            _log=fake_log,
+            _datetime=fake_datetime,
+            _match_with_place_fn=fake_match_with_place,
+            _match_with_venue_fn=fudge.Fake('_match_with_venue'),
+            )
+
+        eq(found_work, True)
+
+    @fudge.with_fakes
+    def test_locate_match_after_geocode(self):
+        event = OrderedDict([
+                ('_id', '226680217397995'),
+                ('facebook', OrderedDict([
+                            ('venue', OrderedDict([
+                                        ('street', '6506 Hollywood Blvd'),
+                                        ('city', 'Los Angeles'),
+                                        ]),
+                             ),
+                            ]),
+                 ),
+                ('ubernear', OrderedDict([
+                            ('stages', ['geocode', 'match']),
+                            ]),
+                 ),
+                ])
+        events_coll = FakeEventsCollection([event])
+
+        fake_log = fudge.Fake('log')
+        fake_log.provides('info')
+
+        fake_match_with_place = fudge.Fake(
+            'match_with_place',
+            callable=True,
+            )
+        fake_match_with_place.with_args(
+            event=event,
+            place_ids=[],
+            places_coll=None,
+            database=None,
+            )
+        fake_match_with_place.returns(
+            OrderedDict([
+                    ('ubernear', OrderedDict([
+                                ('score', 100),
+                                ('place_id',
+                                 'cb036268-2ba8-47db-906c-ca3b66d4da73'
+                                 ),
+                                ('source', 'factual'),
+                                ('location', [-118.331231, 34.101593]),
+                                ]),
+                     ),
+                    ('place', OrderedDict([
+                                ('name', 'Playhouse'),
+                                ]),
+                     ),
+                    ])
+            )
+
+        fake_datetime = fudge.Fake('datetime')
+        fake_datetime.provides('utcnow').returns(
+            datetime(2012, 5, 22, 3, 35, 8),
+            )
+
+        def locate():
+            return event_location.locate(
+                events_coll=events_coll,
+                places_coll=None,
+                database=None,
+                _log=fake_log,
+                _datetime=fake_datetime,
+                _match_with_place_fn=fake_match_with_place,
+                _match_with_venue_fn=fudge.Fake('_match_with_venue'),
+                )
+
+        # The event is not matched, and taken out of the match
+        # stage, before it has a coordinate
+        eq(locate(), False)
+        eq(events_coll.updates, [])
+
+        event['facebook']['venue']['latitude'] = 34.101593
+        event['facebook']['venue']['longitude'] = -118.331231
+        event['ubernear']['stages'] = ['match']
+
+        eq(locate(), True)
+        eq(len(events_coll.updates), 1)
+        _id, document = events_coll.updates[0]
+        eq(_id, '226680217397995')
+        eq(document['$set']['match.place.name'], 'Playhouse')
+        eq(document['$pull'], OrderedDict([('ubernear.stages', 'match')]))
+
+    @fudge.with_fakes
+    def test_locate_match_with_venue_simple(self):
+        events_coll = fudge.Fake('events_coll')
+        events_coll.remember_order()
+
+        find = events_coll.expects('find')
+        query_parts = [
+            OrderedDict([
+                    ('ubernear.stages', 'match'),
                     ]),
             OrderedDict([
-                    ('ubernear.match_completed',
-                     OrderedDict([
-                                ('$exists', False),
+                    ('ubernear.stages', OrderedDict([
+                                ('$nin', ['normalize', 'geocode']),
                                 ]),
                      ),
                     ]),
@@ -5471,9 +5730,11 @@ class TestEventLocation(object):
         query = OrderedDict([
                 ('$and', [
                         OrderedDict([
-                                ('ubernear.match_completed',
-                                 OrderedDict([
-                                            ('$exists', False),
+                                ('ubernear.stages', 'match'),
+                                ]),
+                        OrderedDict([
+                                ('ubernear.stages', OrderedDict([
+                                            ('$nin', ['normalize', 'geocode']),
                                             ]),
                                  ),
                                 ]),
@@ -5567,6 +5828,15 @@ class TestEventLocation(object):
                                 ('match.ubernear.location',
                                  [-118.331231, 34.101593],
                                  ),
+                                ('match.ubernear.api_place_id',
+                                 '6168c8074db7929e4ab4744ebf8f0217',
+                                 ),
+                                ('match.ubernear.coord_key',
+                                 '34.101593,-118.331231',
+                                 ),
+                                ('match.ubernear.quadkey',
+                                 '023012311121321201',
+                                 ),
                                 ('match.place.address',
                                  '6506 Hollywood Blvd',
                                  ),
@@ -5577,8 +5847,16 @@ class TestEventLocation(object):
                                 ('ubernear.match_completed',
                                  datetime(2012, 5, 22, 3, 35, 8),
                                  ),
+                                ('ubernear.modified',
+                                 datetime(2012, 5, 22, 3, 35, 8),
+                                 ),
                                 ]),
-                     )]),
+                     ),
+                    ('$pull', OrderedDict([
+                                ('ubernear.stages', 'match'),
+                                ]),
+                     ),
+                    ]),
             upsert=True,
             safe=True,
             )
@@ -5597,6 +5875,15 @@ class TestEventLocation(object):
                                 ('match.ubernear.location',
                                  [-118.396004, 34.167198],
                                  ),
+                                ('match.ubernear.api_place_id',
+                                 '7e8ec9608dfb53d208d01a14aec006f4',
+                                 ),
+                                ('match.ubernear.coord_key',
+                                 '34.167198,-118.396004',
+                                 ),
+                                ('match.ubernear.quadkey',
+                                 '023012311102333032',
+                                 ),
                                 ('match.place.address', '320 E 2Nd St'),
                                 ('match.place.locality', 'Los Angeles'),
                                 ('match.place.name',
@@ -5607,8 +5894,16 @@ class TestEventLocation(object):
                                 ('ubernear.match_completed',
                                  datetime(2012, 5, 22, 3, 35, 8),
                                  ),
+                                ('ubernear.modified',
+                                 datetime(2012, 5, 22, 3, 35, 8),
+                                 ),
                                 ]),
-                     )]),
+                     ),
+                    ('$pull', OrderedDict([
+                                ('ubernear.stages', 'match'),
+                                ]),
+                     ),
+                    ]),
             upsert=True,
             safe=True,
             )
@@ -5699,16 +5994,11 @@ class TestEventLocation(object):
         find = events_coll.expects('find')
         query_parts = [
             OrderedDict([
-                    ('ubernear.lookup_completed',
-                     OrderedDict([
-                                ('$exists', True),
-                                ]),
-                     ),
+                    ('ubernear.stages', 'match'),
                     ]),
             OrderedDict([
-                    ('ubernear.match_completed',
-                     OrderedDict([
-                                ('$exists', False),
+                    ('ubernear.stages', OrderedDict([
+                                ('$nin', ['normalize', 'geocode']),
                                 ]),
                      ),
                     ]),
@@ -5731,8 +6021,20 @@ class TestEventLocation(object):
         ubernear = OrderedDict([
                 ('place_ids', ['cb036268-2ba8-47db-906c-ca3b66d4da73']),
                 ])
+        # Can be matched with its venue
+        facebook = OrderedDict([
+                ('location', 'Playhouse'),
+                ('venue', OrderedDict([
+                            ('street', '6506 Hollywood Blvd'),
+                            ('latitude', 34.101593),
+                            ('longitude', -118.331231),
+                            ('city', 'Los Angeles'),
+                            ]),
+                 ),
+                ])
         event = OrderedDict([
                 ('_id', '226680217397995'),
+                ('facebook', facebook),
                 ('ubernear', ubernear),
                 ])
         events = [event]
@@ -5780,9 +6082,11 @@ class TestEventLocation(object):
         query = OrderedDict([
                 ('$and', [
                         OrderedDict([
-                                ('ubernear.match_completed',
-                                 OrderedDict([
-                                            ('$exists', False),
+                                ('ubernear.stages', 'match'),
+                                ]),
+                        OrderedDict([
+                                ('ubernear.stages', OrderedDict([
+                                            ('$nin', ['normalize', 'geocode']),
                                             ]),
                                  ),
                                 ]),
@@ -5876,16 +6180,11 @@ class TestEventLocation(object):
         find = events_coll.expects('find')
         query_parts = [
             OrderedDict([
-                    ('ubernear.lookup_completed',
-                     OrderedDict([
-                                ('$exists', True),
-                                ]),
-                     ),
+                    ('ubernear.stages', 'match'),
                     ]),
             OrderedDict([
-                    ('ubernear.match_completed',
-                     OrderedDict([
-                                ('$exists', False),
+                    ('ubernear.stages', OrderedDict([
+                                ('$nin', ['normalize', 'geocode']),
                                 ]),
                      ),
                     ]),
@@ -5928,9 +6227,11 @@ class TestEventLocation(object):
         query = OrderedDict([
                 ('$and', [
                         OrderedDict([
-                                ('ubernear.match_completed',
-                                 OrderedDict([
-                                            ('$exists', False),
+                                ('ubernear.stages', 'match'),
+                                ]),
+                        OrderedDict([
+                                ('ubernear.stages', OrderedDict([
+                                            ('$nin', ['normalize', 'geocode']),
                                             ]),
                                  ),
                                 ]),
@@ -5995,6 +6296,22 @@ class TestEventLocation(object):
         fake_cursor = FakeCursor(events)
         find.returns(fake_cursor)
 
+        # Not retried
+        update = events_coll.expects('update')
+        update.with_args(
+            OrderedDict([
+                    ('_id', '226680217397995'),
+                    ]),
+            OrderedDict([
+                    ('$pull', OrderedDict([
+                                ('ubernear.stages', 'match'),
+                                ]),
+                     ),
+                    ]),
+            upsert=True,
+            safe=True,
+            )
+
         fake_log = fudge.Fake('log')
         fake_log.remember_order()
 
@@ -6097,16 +6414,11 @@ class TestEventLocation(object):
         find = events_coll.expects('find')
         query_parts = [
             OrderedDict([
-                    ('ubernear.lookup_completed',
-                     OrderedDict([
-                                ('$exists', True),
-                                ]),
-                     ),
+                    ('ubernear.stages', 'match'),
                     ]),
             OrderedDict([
-                    ('ubernear.match_completed',
-                     OrderedDict([
-                                ('$exists', False),
+                    ('ubernear.stages', OrderedDict([
+                                ('$nin', ['normalize', 'geocode']),
                                 ]),
                      ),
                     ]),
@@ -6152,9 +6464,11 @@ class TestEventLocation(object):
         query = OrderedDict([
                 ('$and', [
                         OrderedDict([
-                                ('ubernear.match_completed',
-                                 OrderedDict([
-                                            ('$exists', False),
+                                ('ubernear.stages', 'match'),
+                                ]),
+                        OrderedDict([
+                                ('ubernear.stages', OrderedDict([
+                                            ('$nin', ['normalize', 'geocode']),
                                             ]),
                                  ),
                                 ]),
@@ -6223,3 +6537,122 @@ class TestEventLocation(object):
             )
 
         eq(found_work, False)
+
+    @fudge.with_fakes
+    def test_locate_bumps_generation(self):
+        events_coll = fudge.Fake('events_coll')
+        events_coll.remember_order()
+
+        find = events_coll.expects('find')
+        event = OrderedDict([
+                ('_id', '226680217397995'),
+                ('ubernear', OrderedDict()),
+                ])
+        find.returns(FakeCursor([event]))
+
+        update = events_coll.expects('update')
+        update.with_args(
+            OrderedDict([
+                    ('_id', '226680217397995'),
+                    ]),
+            OrderedDict([
+                    ('$set', OrderedDict([
+                                ('match.ubernear.place_id',
+                                 'cb036268-2ba8-47db-906c-ca3b66d4da73',
+                                 ),
+                                ('match.ubernear.location',
+                                 [-118.331231, 34.101593],
+                                 ),
+                                ('match.ubernear.api_place_id',
+                                 'b5396d0eaff5f58e8405f7af4129cc7b',
+                                 ),
+                                ('match.ubernear.coord_key',
+                                 '34.101593,-118.331231',
+                                 ),
+                                ('match.ubernear.quadkey',
+                                 '023012311121321201',
+                                 ),
+                                ('match.place.name', 'Playhouse'),
+                                ('ubernear.match_completed',
+                                 datetime(2012, 5, 22, 3, 35, 8),
+                                 ),
+                                ('ubernear.modified',
+                                 datetime(2012, 5, 22, 3, 35, 8),
+                                 ),
+                                ]),
+                     ),
+                    ('$pull', OrderedDict([
+                                ('ubernear.stages', 'match'),
+                                ]),
+                     ),
+                    ]),
+            upsert=True,
+            safe=True,
+            )
+
+        find = events_coll.next_call('find')
+        find.returns(FakeCursor([]))
+
+        meta_coll = fudge.Fake('meta_coll')
+        update = meta_coll.expects('update')
+        update.with_args(
+            OrderedDict([
+                    ('_id', 'events'),
+                    ]),
+            OrderedDict([
+                    ('$inc', OrderedDict([
+                                ('generation', 1),
+                                ]),
+                     ),
+                    ('$set', OrderedDict([
+                                ('modified',
+                                 datetime(2012, 5, 22, 3, 35, 8),
+                                 ),
+                                ]),
+                     ),
+                    ]),
+            upsert=True,
+            safe=True,
+            )
+
+        fake_datetime = fudge.Fake('datetime')
+        utcnow = fake_datetime.expects('utcnow')
+        utcnow.returns(datetime(2012, 5, 22, 3, 35, 8))
+
+        fake_log = fudge.Fake('log')
+        fake_log.provides('info')
+        places_coll = fudge.Fake('places_coll')
+        database = fudge.Fake('database')
+
+        fake_match_with_place = fudge.Fake(
+            'match_with_place',
+            callable=True,
+            )
+        match = OrderedDict([
+                ('ubernear', OrderedDict([
+                            ('place_id',
+                             'cb036268-2ba8-47db-906c-ca3b66d4da73'
+                             ),
+                            ('location', [-118.331231, 34.101593]),
+                            ]),
+                 ),
+                ('place', OrderedDict([
+                            ('name', 'Playhouse'),
+                            ]),
+                 ),
+                ])
+        fake_match_with_place.returns(match)
+        fake_match_with_venue = fudge.Fake('match_with_venue')
+
+        found_work = event_location.locate(
+            events_coll=events_coll,
+            places_coll=places_coll,
+            database=database,
+            meta_coll=meta_coll,
+            _log=fake_log,
+            _datetime=fake_datetime,
+            _match_with_place_fn=fake_match_with_place,
+            _match_with_venue_fn=fake_match_with_venue,
+            )
+
+        eq(found_work, True)
@@ -0,0 +1,281 @@
+import os
+import gzip
+import json
+import fudge
+
+from nose.tools import eq_ as eq
+from collections import OrderedDict
+from datetime import datetime
+
+from ubernear.test.util import tmp_dirs
+from ubernear import event_results
+
+class TestEventResults(object):
+    def setUp(self):
+        fudge.clear_expectations()
+
+    @tmp_dirs(1)
+    @fudge.with_fakes
+    def test_write_snapshot_simple(self, tmp):
+        events_coll = fudge.Fake('events_coll')
+        find = events_coll.expects('find')
+        query = OrderedDict([
+                ('$and', [
+                        OrderedDict([
+                                ('match', OrderedDict([
+                                            ('$exists', True),
+                                            ]),
+                                 ),
+                                ]),
+                        OrderedDict([
+                                ('facebook.end_time', OrderedDict([
+                                            ('$gt',
+                                             datetime(2012, 1, 23),
+                                             ),
+                                            ]),
+                                 ),
+                                ]),
+                        ],
+                 ),
+                ])
+        find.with_args(
+            query,
+            sort=[
+                ('match.place.latitude', 1),
+                ('match.place.longitude', 1),
+                ('facebook.start_time', 1),
+                ],
+            fields=event_results.summary_fields,
+            )
+        event = OrderedDict([
+                ('_id', '347324708616762'),
+                ('facebook', OrderedDict([
+                            ('id', '347324708616762'),
+                            ('end_time',
+                             datetime(2012, 1, 24, 1, 30),
+                             ),
+                            ]),
+                 ),
+                ('match', OrderedDict([
+                            ('ubernear', OrderedDict([
+                                        ('place_id',
+                                         'cb036268-2ba8-47db-906c-ca3b66d4da73'
+                                         ),
+                                        ('location', [-118.331231, 34.101593]),
+                                        ]),
+                             ),
+                            ('place', OrderedDict([
+                                        ('name', 'Playhouse'),
+                                        ]),
+                             ),
+                            ])
+                 ),
+                ])
+        find.returns([event])
+
+        fake_datetime = fudge.Fake('datetime')
+        now = fake_datetime.expects('now')
+        now.returns(datetime(2012, 1, 23, 5, 26, 56))
+
+        path = os.path.join(tmp, 'all.json.gz')
+        event_results.write_snapshot(
+            events_coll=events_coll,
+            path=path,
+            _datetime=fake_datetime,
+            )
+
+        eq(os.listdir(tmp), ['all.json.gz'])
+        fp = gzip.open(path)
+        try:
+            res = fp.read()
+        finally:
+            fp.close()
+        expected = OrderedDict([
+                ('status', OrderedDict([
+                            ('code', 200),
+                            ('message', 'OK'),
+                            ]),
+                 ),
+                ('count', OrderedDict([
+                            ('events', 1),
+                            ('places', 1),
+                            ('coordinates', 1),
+                            ]),
+                 ),
+                ('data', OrderedDict([
+                            ('events', OrderedDict([
+                                        ('34.101593,-118.331231', [
+                                                OrderedDict([
+                                                        ('id',
+                                                         '347324708616762',
+                                                         ),
+                                                        ]),
+                                                ]
+                                         ),
+                                        ]),
+                             ),
+                            ]),
+                 ),
+                ])
+        eq(res, json.dumps(expected))
+
+    @fudge.with_fakes
+    def test_group_by_coord_stored_keys(self):
+        event = OrderedDict([
+                ('_id', '347324708616762'),
+                ('facebook', OrderedDict([
+                            ('id', '347324708616762'),
+                            ('name', 'Party Night'),
+                            ('start_time',
+                             datetime(2012, 1, 23, 20, 0),
+                             ),
+                            ('end_time',
+                             datetime(2012, 1, 24, 1, 30),
+                             ),
+                            ]),
+                 ),
+                ('match', OrderedDict([
+                            ('ubernear', OrderedDict([
+                                        ('place_id',
+                                         'cb036268-2ba8-47db-906c-ca3b66d4da73'
+                                         ),
+                                        ('location', [-118.331231, 34.101593]),
+                                        ('api_place_id', 'foo place id'),
+                                        ('coord_key', 'foo coord key'),
+                                        ]),
+                             ),
+                            ('place', OrderedDict([
+                                        ('name', 'Playhouse'),
+                                        ]),
+                             ),
+                            ])
+                 ),
+                ])
+
+        res = event_results.group_by_coord(
+            events=[event],
+            now=datetime(2012, 1, 23, 5, 26, 56),
+            details=True,
+            )
+
+        eq(res['data']['events'].keys(), ['foo coord key'])
+        eq(res['data']['places'].keys(), ['foo place id'])
+        eq(
+            res['data']['events']['foo coord key'][0]['place_id'],
+            'foo place id',
+            )
+
+    @fudge.with_fakes
+    def test_compact_results_simple(self):
+        event = OrderedDict([
+                ('id', '347324708616762'),
+                ('start_time', datetime(2012, 1, 23, 20, 0)),
+                ('end_time', datetime(2012, 1, 24, 1, 30)),
+                ])
+        status = event_results.get_status()
+        status['count'] = OrderedDict([
+                ('events', 1),
+                ])
+        status['data'] = OrderedDict([
+                ('events', OrderedDict([
+                            ('34.101593,-118.331231', [event]),
+                            ]),
+                 ),
+                ('distances', OrderedDict([
+                            ('34.101593,-118.331231', 12.5),
+                            ]),
+                 ),
+                ])
+
+        res = event_results.compact_results(status)
+
+        res_event = OrderedDict([
+                ('id', '347324708616762'),
+                ('start_time', 1327348800),
+                ('end_time', 1327368600),
+                ])
+        eq(res['count'], OrderedDict([('events', 1)]))
+        eq(
+            res['data']['events'],
+            [[34.101593, -118.331231, [res_event]]],
+            )
+        eq(res['data']['distances'], [[34.101593, -118.331231, 12.5]])
+        # The document itself is left alone
+        eq(status['data']['events'].keys(), ['34.101593,-118.331231'])
+
+    @fudge.with_fakes
+    def test_compact_results_error(self):
+        status = event_results.get_status(code=400, message='Bad')
+
+        eq(event_results.compact_results(status), status)
+
+    @fudge.with_fakes
+    def test_quadkey_simple(self):
+        location = [-118.331231, 34.101593]
+
+        eq(event_results.quadkey(location), '023012311121321201')
+        eq(event_results.quadkey(location, zoom=3), '023')
+        eq(event_results.tile_quadkey(1, 3, 3), '023')
+        eq(event_results.tile_quadkey(0, 0, 0), '')
+        # Latitudes beyond Web Mercator's are clipped
+        eq(event_results.quadkey([0, 90], zoom=2), '10')
+
+    @fudge.with_fakes
+    def test_search_tokens_punctuation(self):
+        eq(
+            event_results.search_tokens(u'Rock-n-Roll Night: rock on!'),
+            [u'rock', u'n', u'roll', u'night', u'on'],
+            )
+
+    @fudge.with_fakes
+    def test_group_by_tile_simple(self):
+        def event(_id, start_time, location, key):
+            return OrderedDict([
+                    ('_id', _id),
+                    ('facebook', OrderedDict([
+                                ('id', _id),
+                                ('name', 'Party {_id}'.format(_id=_id)),
+                                ('start_time', start_time),
+                                ('end_time', datetime(2012, 1, 24, 1, 30)),
+                                ]),
+                     ),
+                    ('match', OrderedDict([
+                                ('ubernear', OrderedDict([
+                                            ('place_id', 'foo place'),
+                                            ('location', location),
+                                            ('quadkey', key),
+                                            ]),
+                                 ),
+                                ('place', OrderedDict([
+                                            ('name', 'Playhouse'),
+                                            ]),
+                                 ),
+                                ])
+                     ),
+                    ])
+        events = [
+            event('1', datetime(2012, 1, 23, 21), [-118.3, 34.1], '02301'),
+            event('2', datetime(2012, 1, 23, 20), [-118.4, 34.2], '02302'),
+            event('3', datetime(2012, 1, 23, 19), [-118.3, 34.1], '02303'),
+            event('4', datetime(2012, 1, 23, 18), [-70.1, 40.1], '03201'),
+            # Already over
+            event('5', datetime(2012, 1, 22, 18), [-70.1, 40.1], '03201'),
+            ]
+        events[-1]['facebook']['end_time'] = datetime(2012, 1, 23)
+
+        res = event_results.group_by_tile(
+            events=events,
+            now=datetime(2012, 1, 23, 5, 26, 56),
+            zoom=2,
+            depth=1,
+            top_events=2,
+            )
+
+        eq(res['count'], OrderedDict([('events', 4), ('clusters', 2)]))
+        clusters = res['data']['clusters']
+        eq(clusters.keys(), ['023', '032'])
+        eq(clusters['023']['count'], 3)
+        eq(clusters['023']['latitude'], 34.1)
+        eq(clusters['023']['longitude'], -118.3)
+        eq([e['id'] for e in clusters['023']['events']], ['3', '2'])
+        eq([e['id'] for e in clusters['032']['events']], ['4'])
@@ -1,8 +1,9 @@
 import fudge
+import threading
 
 from nose.tools import eq_ as eq
 from collections import OrderedDict
-from datetime import datetime
+from datetime import datetime, timedelta
 from facepy.exceptions import FacepyError
 
 from ubernear import facebook_event
@@ -23,6 +24,12 @@ class FakeCursor(object):
     def count(self):
         return len(self._events)
 
+def _fake_datetime(now):
+    fake_datetime = fudge.Fake('datetime')
+    fake_datetime.provides('utcnow').returns(now)
+
+    return fake_datetime
+
 class TestFacebookEvent(object):
     def setUp(self):
         fudge.clear_expectations()
@@ -47,7 +54,7 @@ class TestFacebookEvent(object):
                     ]),
             ]
         batch.with_args(request)
-        batch.returns([
+        batch.returns(iter([
                 OrderedDict([
                         ('title', 'event title 226680217397995'),
                         ('id', '226680217397995'),
@@ -60,7 +67,7 @@ class TestFacebookEvent(object):
                         ('start_time', '2012-02-26T08:00:00+00:00'),
                         ('end_time', '2012-02-26T11:00:00+00:00'),
                         ]),
-                ])
+                ]))
 
         if fake_log is None:
             self._fake_log = fudge.Fake('log')
@@ -97,6 +104,12 @@ class TestFacebookEvent(object):
                 ('ubernear.lookup_completed',
                  datetime(2011, 11, 16, 2, 50, 32),
                  ),
+                ('ubernear.modified',
+                 datetime(2011, 11, 16, 2, 50, 32),
+                 ),
+                ('ubernear.duration_seconds', 10800),
+                ('ubernear.tokens', []),
+                ('ubernear.stages', ['normalize', 'geocode', 'match']),
                 ])
         update.with_args(
             OrderedDict([
@@ -104,6 +117,11 @@ class TestFacebookEvent(object):
                     ]),
             OrderedDict([
                     ('$set', save),
+                    ('$unset', OrderedDict([
+                                ('ubernear.retry_count', ''),
+                                ('ubernear.retry_at', ''),
+                                ]),
+                     ),
                     ]),
             upsert=True,
             safe=True,
@@ -123,6 +141,12 @@ class TestFacebookEvent(object):
                 ('ubernear.lookup_completed',
                  datetime(2011, 11, 16, 2, 50, 32),
                  ),
+                ('ubernear.modified',
+                 datetime(2011, 11, 16, 2, 50, 32),
+                 ),
+                ('ubernear.duration_seconds', 10800),
+                ('ubernear.tokens', []),
+                ('ubernear.stages', ['normalize', 'geocode', 'match']),
                 ])
         update.with_args(
             OrderedDict([
@@ -130,6 +154,11 @@ class TestFacebookEvent(object):
                     ]),
             OrderedDict([
                     ('$set', save),
+                    ('$unset', OrderedDict([
+                                ('ubernear.retry_count', ''),
+                                ('ubernear.retry_at', ''),
+                                ]),
+                     ),
                     ]),
             upsert=True,
             safe=True,
@@ -162,35 +191,28 @@ class TestFacebookEvent(object):
         end_query = OrderedDict([
                 ('$and', end_parts),
                 ])
-        false_query = OrderedDict([
-                ('ubernear.lookup_failed.reason', 'False response'),
-                ])
-        unsupported_query = OrderedDict([
-                ('ubernear.lookup_failed.reason', OrderedDict([
-                            ('$regex',
-                             'GraphMethodException error on get.*'
-                             ': Unsupported get request..',
-                             ),
-                            ('$options', 'i'),
-                            ]),
-                 )
-                ])
-        alias_query = OrderedDict([
-                ('ubernear.lookup_failed.reason', OrderedDict([
-                            ('$regex',
-                             'OAuthException error on get.*Some '
-                             'of the aliases you requested do not exist.*'
-                             ),
-                            ('$options', 'i'),
-                            ]),
-                 )
-                ])
-        or_query = OrderedDict([
-                ('$or',
-                 [false_query,
-                  unsupported_query,
-                  alias_query,
-                  ],
+        gone_query = OrderedDict([
+                ('$or', [
+                        OrderedDict([
+                                ('ubernear.lookup_failed.terminal', True),
+                                ('ubernear.lookup_failed.kind', 'gone'),
+                                ]),
+                        # Failures stored before kinds were
+                        OrderedDict([
+                                ('ubernear.lookup_failed.kind',
+                                 OrderedDict([
+                                            ('$exists', False),
+                                            ]),
+                                 ),
+                                ('ubernear.lookup_failed.reason',
+                                 OrderedDict([
+                                            ('$in',
+                                             facebook_event.gone_failures,
+                                             ),
+                                            ]),
+                                 ),
+                                ]),
+                        ],
                  ),
                 ])
         facebook_query = OrderedDict([
@@ -200,7 +222,7 @@ class TestFacebookEvent(object):
                  ),
                 ])
         failed_query = OrderedDict([
-                ('$and', [facebook_query, or_query]),
+                ('$and', [facebook_query, gone_query]),
                 ])
         find.with_args(
             OrderedDict([
@@ -250,6 +272,7 @@ class TestFacebookEvent(object):
                 ('facebook.updated_time',
                  datetime(2011, 10, 27, 22, 56, 42)
                  ),
+                ('ubernear.expired', datetime(2012, 3, 17, 7, 31, 45)),
                 ])
         update.with_args(
             OrderedDict([
@@ -271,6 +294,7 @@ class TestFacebookEvent(object):
                 ('facebook.updated_time',
                  datetime(2011, 10, 12, 19, 55, 58)
                  ),
+                ('ubernear.expired', datetime(2012, 3, 17, 7, 40, 2)),
                 ])
         update.with_args(
             OrderedDict([
@@ -298,11 +322,13 @@ class TestFacebookEvent(object):
             )
 
         fake_datetime = fudge.Fake('datetime')
-        fake_datetime.remember_order()
 
         utcnow = fake_datetime.expects('utcnow')
         utcnow.with_arg_count(0)
         utcnow.returns(datetime(2012, 3, 17, 7, 23, 19))
+        # Each event is stamped when it is moved
+        utcnow.next_call().returns(datetime(2012, 3, 17, 7, 31, 45))
+        utcnow.next_call().returns(datetime(2012, 3, 17, 7, 40, 2))
 
         facebook_event.expire(
             events_coll=events_coll,
@@ -337,35 +363,28 @@ class TestFacebookEvent(object):
         end_query = OrderedDict([
                 ('$and', end_parts),
                 ])
-        false_query = OrderedDict([
-                ('ubernear.lookup_failed.reason', 'False response'),
-                ])
-        unsupported_query = OrderedDict([
-                ('ubernear.lookup_failed.reason', OrderedDict([
-                            ('$regex',
-                             'GraphMethodException error on get.*'
-                             ': Unsupported get request..',
-                             ),
-                            ('$options', 'i'),
-                            ]),
-                 )
-                ])
-        alias_query = OrderedDict([
-                ('ubernear.lookup_failed.reason', OrderedDict([
-                            ('$regex',
-                             'OAuthException error on get.*Some '
-                             'of the aliases you requested do not exist.*'
-                             ),
-                            ('$options', 'i'),
-                            ]),
-                 )
-                ])
-        or_query = OrderedDict([
-                ('$or',
-                 [false_query,
-                  unsupported_query,
-                  alias_query,
-                  ],
+        gone_query = OrderedDict([
+                ('$or', [
+                        OrderedDict([
+                                ('ubernear.lookup_failed.terminal', True),
+                                ('ubernear.lookup_failed.kind', 'gone'),
+                                ]),
+                        # Failures stored before kinds were
+                        OrderedDict([
+                                ('ubernear.lookup_failed.kind',
+                                 OrderedDict([
+                                            ('$exists', False),
+                                            ]),
+                                 ),
+                                ('ubernear.lookup_failed.reason',
+                                 OrderedDict([
+                                            ('$in',
+                                             facebook_event.gone_failures,
+                                             ),
+                                            ]),
+                                 ),
+                                ]),
+                        ],
                  ),
                 ])
         facebook_query = OrderedDict([
@@ -375,7 +394,7 @@ class TestFacebookEvent(object):
                  ),
                 ])
         failed_query = OrderedDict([
-                ('$and', [facebook_query, or_query]),
+                ('$and', [facebook_query, gone_query]),
                 ])
         find.with_args(
             OrderedDict([
@@ -433,6 +452,7 @@ class TestFacebookEvent(object):
                 ('facebook.updated_time',
                  datetime(2011, 10, 27, 22, 56, 42)
                  ),
+                ('ubernear.expired', datetime(2012, 3, 17, 7, 23, 19)),
                 ])
         add_each = OrderedDict([
                 ('ubernear.place_ids', OrderedDict([
@@ -463,6 +483,7 @@ class TestFacebookEvent(object):
                 ('facebook.updated_time',
                  datetime(2011, 10, 12, 19, 55, 58)
                  ),
+                ('ubernear.expired', datetime(2012, 3, 17, 7, 23, 19)),
                 ])
         add_each = OrderedDict([
                 ('ubernear.place_ids', OrderedDict([
@@ -499,7 +520,6 @@ class TestFacebookEvent(object):
             )
 
         fake_datetime = fudge.Fake('datetime')
-        fake_datetime.remember_order()
 
         utcnow = fake_datetime.expects('utcnow')
         utcnow.with_arg_count(0)
@@ -541,6 +561,139 @@ class TestFacebookEvent(object):
             graph=self._fake_graph,
             now=datetime(2011, 11, 16, 2, 50, 32),
             _log=self._fake_log,
+            _datetime=_fake_datetime(datetime(2011, 11, 16, 2, 50, 32)),
+            )
+
+    @fudge.with_fakes
+    def test_save_events_tokens(self):
+        fake_graph = fudge.Fake('graph')
+        batch = fake_graph.expects('batch')
+        batch.returns(iter([
+                OrderedDict([
+                        ('id', '267558763278075'),
+                        ('name', u'Jazz Night: Live!'),
+                        ('description', u'Live jazz, all night.'),
+                        ('start_time', '2012-02-26T08:00:00+0000'),
+                        ('end_time', '2012-02-26T11:00:00+0000'),
+                        ]),
+                ]))
+
+        events_coll = fudge.Fake('events_coll')
+        update = events_coll.expects('update')
+        save = OrderedDict([
+                ('facebook.id', '267558763278075'),
+                ('facebook.name', u'Jazz Night: Live!'),
+                ('facebook.description', u'Live jazz, all night.'),
+                ('facebook.start_time', datetime(2012, 2, 26, 8, 0, 0)),
+                ('facebook.end_time', datetime(2012, 2, 26, 11, 0, 0)),
+                ('ubernear.source', 'facebook'),
+                ('ubernear.lookup_completed',
+                 datetime(2011, 11, 16, 2, 50, 32),
+                 ),
+                ('ubernear.modified',
+                 datetime(2011, 11, 16, 2, 50, 32),
+                 ),
+                ('ubernear.duration_seconds', 10800),
+                ('ubernear.tokens', [u'jazz', u'night', u'live', u'all']),
+                ('ubernear.stages', ['normalize', 'geocode', 'match']),
+                ])
+        update.with_args(
+            OrderedDict([
+                    ('_id', '267558763278075'),
+                    ]),
+            OrderedDict([
+                    ('$set', save),
+                    ('$unset', OrderedDict([
+                                ('ubernear.retry_count', ''),
+                                ('ubernear.retry_at', ''),
+                                ]),
+                     ),
+                    ]),
+            upsert=True,
+            safe=True,
+            )
+
+        fake_log = fudge.Fake('log')
+        fake_log.provides('debug')
+
+        events = [
+            OrderedDict([
+                    ('_id', '267558763278075'),
+                    ]),
+            ]
+        facebook_event._save_events(
+            events=events,
+            events_coll=events_coll,
+            graph=fake_graph,
+            now=datetime(2011, 11, 16, 2, 50, 32),
+            _log=fake_log,
+            _datetime=_fake_datetime(datetime(2011, 11, 16, 2, 50, 32)),
+            )
+
+    @fudge.with_fakes
+    def test_fetch_batches_concurrent(self):
+        last_called = threading.Event()
+        threads = []
+
+        class Graph(object):
+            # Like facepy, the request is only sent once the
+            # responses are read
+            def batch(self, requests):
+                threads.append(threading.current_thread())
+                event_id = requests[0]['relative_url'].split('?')[0]
+                if event_id == 'foo':
+                    # Only returns if the other batches are in
+                    # flight at the same time
+                    last_called.wait(5)
+                if event_id == 'fee':
+                    last_called.set()
+                yield event_id
+
+        batches = [
+            [OrderedDict([('_id', 'foo')])],
+            [OrderedDict([('_id', 'sna')])],
+            [OrderedDict([('_id', 'fee')])],
+            ]
+        fetched = facebook_event._fetch_batches(
+            batches=batches,
+            graph=Graph(),
+            concurrency=3,
+            )
+
+        eq(
+            list(fetched),
+            [([OrderedDict([('_id', 'foo')])], ['foo']),
+             ([OrderedDict([('_id', 'sna')])], ['sna']),
+             ([OrderedDict([('_id', 'fee')])], ['fee']),
+             ],
+            )
+        eq(last_called.is_set(), True)
+        eq(threading.current_thread() in threads, False)
+
+    @fudge.with_fakes
+    def test_fetch_batches_throttle(self):
+        fake_graph = fudge.Fake('graph')
+        batch = fake_graph.expects('batch')
+        batch.times_called(2)
+        batch.calls(lambda requests: iter(['foo response']))
+
+        throttle = fudge.Fake('throttle').expects_call()
+        throttle.times_called(2)
+
+        batches = [
+            [OrderedDict([('_id', 'foo')])],
+            [],
+            [OrderedDict([('_id', 'sna')])],
+            ]
+        fetched = facebook_event._fetch_batches(
+            batches=batches,
+            graph=fake_graph,
+            throttle=throttle,
+            )
+
+        eq(
+            [responses for (events, responses) in fetched],
+            [['foo response'], [], ['foo response']],
             )
 
     @fudge.with_fakes
@@ -570,9 +723,9 @@ class TestFacebookEvent(object):
                     ]),
             ]
         batch.with_args(request)
-        batch.returns([
+        batch.returns(iter([
                 FacepyError('foo error'),
-                ])
+                ]))
 
         events_coll = fudge.Fake('events_coll')
         events_coll.remember_order()
@@ -583,6 +736,8 @@ class TestFacebookEvent(object):
                  datetime(2011, 11, 16, 2, 50, 32)
                  ),
                 ('ubernear.lookup_failed.reason', 'foo error'),
+                ('ubernear.lookup_failed.kind', 'error'),
+                ('ubernear.lookup_failed.terminal', True),
                 ])
         update.with_args(
             OrderedDict([
@@ -590,6 +745,10 @@ class TestFacebookEvent(object):
                     ]),
             OrderedDict([
                     ('$set', save),
+                    ('$pull', OrderedDict([
+                                ('ubernear.stages', 'lookup'),
+                                ]),
+                     ),
                     ]),
             upsert=True,
             safe=True,
@@ -608,6 +767,7 @@ class TestFacebookEvent(object):
             graph=fake_graph,
             now=datetime(2011, 11, 16, 2, 50, 32),
             _log=fake_log,
+            _datetime=_fake_datetime(datetime(2011, 11, 16, 2, 50, 32)),
             )
 
     @fudge.with_fakes
@@ -623,7 +783,7 @@ class TestFacebookEvent(object):
                     ]),
             ]
         batch.with_args(request)
-        batch.returns([False])
+        batch.returns(iter([False]))
 
         events_coll = fudge.Fake('events_coll')
         events_coll.remember_order()
@@ -634,6 +794,8 @@ class TestFacebookEvent(object):
                  datetime(2011, 11, 16, 2, 50, 32)
                  ),
                 ('ubernear.lookup_failed.reason', 'False response'),
+                ('ubernear.lookup_failed.kind', 'gone'),
+                ('ubernear.lookup_failed.terminal', True),
                 ])
         update.with_args(
             OrderedDict([
@@ -641,6 +803,10 @@ class TestFacebookEvent(object):
                     ]),
             OrderedDict([
                     ('$set', save),
+                    ('$pull', OrderedDict([
+                                ('ubernear.stages', 'lookup'),
+                                ]),
+                     ),
                     ]),
             upsert=True,
             safe=True,
@@ -659,6 +825,7 @@ class TestFacebookEvent(object):
             graph=fake_graph,
             now=datetime(2011, 11, 16, 2, 50, 32),
             _log=fake_log,
+            _datetime=_fake_datetime(datetime(2011, 11, 16, 2, 50, 32)),
             )
 
     @fudge.with_fakes
@@ -674,7 +841,7 @@ class TestFacebookEvent(object):
                     ]),
             ]
         batch.with_args(request)
-        batch.returns([None])
+        batch.returns(iter([None]))
 
         events_coll = fudge.Fake('events_coll')
         events_coll.remember_order()
@@ -685,6 +852,58 @@ class TestFacebookEvent(object):
                  datetime(2011, 11, 16, 2, 50, 32)
                  ),
                 ('ubernear.lookup_failed.reason', 'Null response'),
+                ('ubernear.lookup_failed.kind', 'transient'),
+                ('ubernear.lookup_failed.terminal', False),
+                ('ubernear.retry_count', 1),
+                ('ubernear.retry_at', datetime(2011, 11, 16, 3, 0, 32)),
+                ])
+        update.with_args(
+            OrderedDict([
+                    ('_id', '226680217397995'),
+                    ]),
+            OrderedDict([
+                    ('$set', save),
+                    ]),
+            upsert=True,
+            safe=True,
+            )
+
+        fake_log = fudge.Fake('log')
+
+        fake_random = fudge.Fake('random')
+        uniform = fake_random.expects('uniform')
+        uniform.with_args(0.5, 1)
+        uniform.returns(1)
+
+        events = [
+            OrderedDict([
+                    ('_id', '226680217397995'),
+                    ]),
+            ]
+        facebook_event._save_events(
+            events=events,
+            events_coll=events_coll,
+            graph=fake_graph,
+            now=datetime(2011, 11, 16, 2, 50, 32),
+            _log=fake_log,
+            _random=fake_random,
+            _datetime=_fake_datetime(datetime(2011, 11, 16, 2, 50, 32)),
+            )
+
+    @fudge.with_fakes
+    def test_save_events_null_retries_exhausted(self):
+        fake_graph = fudge.Fake('graph')
+        fake_graph.provides('batch').returns(iter([None]))
+
+        events_coll = fudge.Fake('events_coll')
+        update = events_coll.expects('update')
+        save = OrderedDict([
+                ('ubernear.lookup_failed.when',
+                 datetime(2011, 11, 16, 2, 50, 32)
+                 ),
+                ('ubernear.lookup_failed.reason', 'Null response'),
+                ('ubernear.lookup_failed.kind', 'transient'),
+                ('ubernear.lookup_failed.terminal', True),
                 ])
         update.with_args(
             OrderedDict([
@@ -692,6 +911,10 @@ class TestFacebookEvent(object):
                     ]),
             OrderedDict([
                     ('$set', save),
+                    ('$pull', OrderedDict([
+                                ('ubernear.stages', 'lookup'),
+                                ]),
+                     ),
                     ]),
             upsert=True,
             safe=True,
@@ -702,6 +925,10 @@ class TestFacebookEvent(object):
         events = [
             OrderedDict([
                     ('_id', '226680217397995'),
+                    ('ubernear', OrderedDict([
+                                ('retry_count', 10),
+                                ]),
+                     ),
                     ]),
             ]
         facebook_event._save_events(
@@ -710,7 +937,37 @@ class TestFacebookEvent(object):
             graph=fake_graph,
             now=datetime(2011, 11, 16, 2, 50, 32),
             _log=fake_log,
+            _datetime=_fake_datetime(datetime(2011, 11, 16, 2, 50, 32)),
+            )
+
+    @fudge.with_fakes
+    def test_retry_delay_simple(self):
+        fake_random = fudge.Fake('random')
+        fake_random.provides('uniform').returns(0.5)
+
+        eq(
+            facebook_event._retry_delay(3, _random=fake_random),
+            timedelta(minutes=40),
+            )
+        # Capped at a day
+        eq(
+            facebook_event._retry_delay(9, _random=fake_random),
+            timedelta(hours=12),
             )
+
+    @fudge.with_fakes
+    def test_failure_kind_simple(self):
+        eq(facebook_event._failure_kind('Null response'), 'transient')
+        eq(facebook_event._failure_kind('False response'), 'gone')
+        eq(
+            facebook_event._failure_kind(
+                'GraphMethodException error on get 226680217397995: '
+                'Unsupported get request..'
+                ),
+            'gone',
+            )
+        eq(facebook_event._failure_kind('Response id is different'), 'error')
+
     @fudge.with_fakes
     def test_save_events_different_id(self):
         fake_graph = fudge.Fake('graph')
@@ -724,14 +981,14 @@ class TestFacebookEvent(object):
                     ]),
             ]
         batch.with_args(request)
-        batch.returns([
+        batch.returns(iter([
                 OrderedDict([
                         ('title', 'event title 226680217397995'),
                         ('id', 'foo id'),
                         ('start_time', '2012-02-26T08:00:00+00:00'),
                         ('end_time', '2012-02-26T11:00:00+00:00'),
                         ]),
-                ])
+                ]))
 
         fake_log = fudge.Fake('log')
         fake_log.remember_order()
@@ -753,6 +1010,8 @@ class TestFacebookEvent(object):
                 ('ubernear.lookup_failed.reason',
                  'Response id is different',
                  ),
+                ('ubernear.lookup_failed.kind', 'error'),
+                ('ubernear.lookup_failed.terminal', True),
                 ])
         update.with_args(
             OrderedDict([
@@ -760,6 +1019,10 @@ class TestFacebookEvent(object):
                     ]),
             OrderedDict([
                     ('$set', save),
+                    ('$pull', OrderedDict([
+                                ('ubernear.stages', 'lookup'),
+                                ]),
+                     ),
                     ]),
             upsert=True,
             safe=True,
@@ -776,6 +1039,7 @@ class TestFacebookEvent(object):
             graph=fake_graph,
             now=datetime(2011, 11, 16, 2, 50, 32),
             _log=fake_log,
+            _datetime=_fake_datetime(datetime(2011, 11, 16, 2, 50, 32)),
             )
 
     @fudge.with_fakes
@@ -795,7 +1059,7 @@ class TestFacebookEvent(object):
                     ]),
             ]
         batch.with_args(request)
-        batch.returns([
+        batch.returns(iter([
                 OrderedDict([
                         ('title', 'event title 226680217397995'),
                         ('id', '226680217397995'),
@@ -813,7 +1077,7 @@ class TestFacebookEvent(object):
                         ('start_time', '2012-02-26T08:00:00+00:00'),
                         ('end_time', '2012-02-26T11:00:00+00:00'),
                         ]),
-                ])
+                ]))
 
         fake_log = fudge.Fake('log')
         fake_log.remember_order()
@@ -845,6 +1109,12 @@ class TestFacebookEvent(object):
                 ('ubernear.lookup_completed',
                  datetime(2011, 11, 16, 2, 50, 32),
                  ),
+                ('ubernear.modified',
+                 datetime(2011, 11, 16, 2, 50, 32),
+                 ),
+                ('ubernear.duration_seconds', 10800),
+                ('ubernear.tokens', []),
+                ('ubernear.stages', ['normalize', 'geocode', 'match']),
                 ])
         update.with_args(
             OrderedDict([
@@ -852,6 +1122,11 @@ class TestFacebookEvent(object):
                     ]),
             OrderedDict([
                     ('$set', save),
+                    ('$unset', OrderedDict([
+                                ('ubernear.retry_count', ''),
+                                ('ubernear.retry_at', ''),
+                                ]),
+                     ),
                     ]),
             upsert=True,
             safe=True,
@@ -873,6 +1148,12 @@ class TestFacebookEvent(object):
                 ('ubernear.lookup_completed',
                  datetime(2011, 11, 16, 2, 50, 32),
                  ),
+                ('ubernear.modified',
+                 datetime(2011, 11, 16, 2, 50, 32),
+                 ),
+                ('ubernear.duration_seconds', 10800),
+                ('ubernear.tokens', []),
+                ('ubernear.stages', ['normalize', 'match']),
                 ])
         update.with_args(
             OrderedDict([
@@ -880,6 +1161,11 @@ class TestFacebookEvent(object):
                     ]),
             OrderedDict([
                     ('$set', save),
+                    ('$unset', OrderedDict([
+                                ('ubernear.retry_count', ''),
+                                ('ubernear.retry_at', ''),
+                                ]),
+                     ),
                     ]),
             upsert=True,
             safe=True,
@@ -899,6 +1185,7 @@ class TestFacebookEvent(object):
             graph=fake_graph,
             now=datetime(2011, 11, 16, 2, 50, 32),
             _log=fake_log,
+            _datetime=_fake_datetime(datetime(2011, 11, 16, 2, 50, 32)),
             )
 
     @fudge.with_fakes
@@ -918,7 +1205,7 @@ class TestFacebookEvent(object):
                     ]),
             ]
         batch.with_args(request)
-        batch.returns([
+        batch.returns(iter([
                 OrderedDict([
                         ('title', 'event title 226680217397995'),
                         ('id', 'foo id'),
@@ -931,7 +1218,7 @@ class TestFacebookEvent(object):
                         ('start_time', '2012-01-15T21:23+00:00'),
                         ('end_time', '2012-01-16T05:22+00:00'),
                         ]),
-                ])
+                ]))
 
         fake_log = fudge.Fake('log')
         fake_log.remember_order()
@@ -958,6 +1245,8 @@ class TestFacebookEvent(object):
                 ('ubernear.lookup_failed.reason',
                  'Response id is different',
                  ),
+                ('ubernear.lookup_failed.kind', 'error'),
+                ('ubernear.lookup_failed.terminal', True),
                 ])
         update.with_args(
             OrderedDict([
@@ -965,6 +1254,10 @@ class TestFacebookEvent(object):
                     ]),
             OrderedDict([
                     ('$set', save),
+                    ('$pull', OrderedDict([
+                                ('ubernear.stages', 'lookup'),
+                                ]),
+                     ),
                     ]),
             upsert=True,
             safe=True,
@@ -984,6 +1277,12 @@ class TestFacebookEvent(object):
                 ('ubernear.lookup_completed',
                  datetime(2011, 11, 16, 2, 50, 32),
                  ),
+                ('ubernear.modified',
+                 datetime(2011, 11, 16, 2, 50, 32),
+                 ),
+                ('ubernear.duration_seconds', 28740),
+                ('ubernear.tokens', []),
+                ('ubernear.stages', ['normalize', 'geocode', 'match']),
                 ])
         update.with_args(
             OrderedDict([
@@ -991,6 +1290,11 @@ class TestFacebookEvent(object):
                     ]),
             OrderedDict([
                     ('$set', save),
+                    ('$unset', OrderedDict([
+                                ('ubernear.retry_count', ''),
+                                ('ubernear.retry_at', ''),
+                                ]),
+                     ),
                     ]),
             upsert=True,
             safe=True,
@@ -1010,6 +1314,7 @@ class TestFacebookEvent(object):
             graph=fake_graph,
             now=datetime(2011, 11, 16, 2, 50, 32),
             _log=fake_log,
+            _datetime=_fake_datetime(datetime(2011, 11, 16, 2, 50, 32)),
             )
 
     @fudge.with_fakes
@@ -1025,13 +1330,13 @@ class TestFacebookEvent(object):
                     ]),
             ]
         batch.with_args(request)
-        batch.returns([
+        batch.returns(iter([
                 OrderedDict([
                         ('title', 'event title 226680217397995'),
                         ('id', '226680217397995'),
                         ('end_time', '2012-02-26T11:00:00+00:00'),
                         ]),
-                ])
+                ]))
 
         events_coll = fudge.Fake('events_coll')
         events_coll.remember_order()
@@ -1044,6 +1349,8 @@ class TestFacebookEvent(object):
                 ('ubernear.lookup_failed.reason',
                  'Missing start_time or end_time',
                  ),
+                ('ubernear.lookup_failed.kind', 'error'),
+                ('ubernear.lookup_failed.terminal', True),
                 ])
         update.with_args(
             OrderedDict([
@@ -1051,6 +1358,10 @@ class TestFacebookEvent(object):
                     ]),
             OrderedDict([
                     ('$set', save),
+                    ('$pull', OrderedDict([
+                                ('ubernear.stages', 'lookup'),
+                                ]),
+                     ),
                     ]),
             upsert=True,
             safe=True,
@@ -1069,6 +1380,7 @@ class TestFacebookEvent(object):
             graph=fake_graph,
             now=datetime(2011, 11, 16, 2, 50, 32),
             _log=fake_log,
+            _datetime=_fake_datetime(datetime(2011, 11, 16, 2, 50, 32)),
             )
 
     @fudge.with_fakes
@@ -1084,13 +1396,13 @@ class TestFacebookEvent(object):
                     ]),
             ]
         batch.with_args(request)
-        batch.returns([
+        batch.returns(iter([
                 OrderedDict([
                         ('title', 'event title 226680217397995'),
                         ('id', '226680217397995'),
                         ('start_time', '2012-02-26T11:00:00+00:00'),
                         ]),
-                ])
+                ]))
 
         events_coll = fudge.Fake('events_coll')
         events_coll.remember_order()
@@ -1103,6 +1415,8 @@ class TestFacebookEvent(object):
                 ('ubernear.lookup_failed.reason',
                  'Missing start_time or end_time',
                  ),
+                ('ubernear.lookup_failed.kind', 'error'),
+                ('ubernear.lookup_failed.terminal', True),
                 ])
         update.with_args(
             OrderedDict([
@@ -1110,6 +1424,10 @@ class TestFacebookEvent(object):
                     ]),
             OrderedDict([
                     ('$set', save),
+                    ('$pull', OrderedDict([
+                                ('ubernear.stages', 'lookup'),
+                                ]),
+                     ),
                     ]),
             upsert=True,
             safe=True,
@@ -1128,6 +1446,7 @@ class TestFacebookEvent(object):
             graph=fake_graph,
             now=datetime(2011, 11, 16, 2, 50, 32),
             _log=fake_log,
+            _datetime=_fake_datetime(datetime(2011, 11, 16, 2, 50, 32)),
             )
 
     @fudge.with_fakes
@@ -1136,56 +1455,16 @@ class TestFacebookEvent(object):
         events_coll.remember_order()
 
         find = events_coll.expects('find')
-        null_query = OrderedDict([
-                ('ubernear.lookup_failed.reason',
-                 'Null response',
-                 ),
-                ])
-        validating_query = OrderedDict([
-                ('ubernear.lookup_failed.reason', OrderedDict([
-                            ('$regex',
-                             'OAuthException error on get.*: '
-                             'Error validating application..'
-                             )
-                            ]),
-                 )
-                ])
-        retry_query = OrderedDict([
-                ('ubernear.lookup_failed.reason', OrderedDict([
-                            ('$regex',
-                             'OAuthException error on get.*: '
-                             'An unexpected error has occurred. '
-                             'Please retry your request later..'
-                             )
-                            ]),
-                 )
-                ])
-        or_query = OrderedDict([
-                ('$or',
-                 [null_query,
-                  validating_query,
-                  retry_query,
-                  ],
-                 ),
-                ])
-        match_query = OrderedDict([
-                ('ubernear.lookup_completed',
-                 OrderedDict([
-                            ('$exists', False),
-                            ]),
-                 ),
-                ])
-        and_query = OrderedDict([
-                ('$and', [match_query, or_query]),
-                ])
         query = OrderedDict([
-                ('$or',
-                 [match_query, and_query],
+                ('ubernear.stages', 'lookup'),
+                ('ubernear.retry_at', OrderedDict([
+                            ('$lte', datetime(2011, 11, 16, 2, 50, 32)),
+                            ]),
                  ),
                 ])
         find.with_args(
             query,
-            sort=[('ubernear.fetched', 1)],
+            sort=[('ubernear.retry_at', 1)],
             )
 
         ubernear_1 = OrderedDict([
@@ -1221,7 +1500,6 @@ class TestFacebookEvent(object):
             )
 
         fake_datetime = fudge.Fake('datetime')
-        fake_datetime.remember_order()
 
         utcnow = fake_datetime.expects('utcnow')
         utcnow.with_arg_count(0)
@@ -1283,7 +1561,7 @@ class TestFacebookEvent(object):
                         ])
                 batch_response.append(response)
 
-            batch.returns(batch_response)
+            batch.returns(iter(batch_response))
 
         batch_fakes(fake_graph, 1, 50+1)
         batch_fakes(fake_graph, 51, 100+1)
@@ -1293,56 +1571,16 @@ class TestFacebookEvent(object):
         events_coll.remember_order()
 
         find = events_coll.expects('find')
-        null_query = OrderedDict([
-                ('ubernear.lookup_failed.reason',
-                 'Null response',
-                 ),
-                ])
-        validating_query = OrderedDict([
-                ('ubernear.lookup_failed.reason', OrderedDict([
-                            ('$regex',
-                             'OAuthException error on get.*: '
-                             'Error validating application..'
-                             )
-                            ]),
-                 )
-                ])
-        retry_query = OrderedDict([
-                ('ubernear.lookup_failed.reason', OrderedDict([
-                            ('$regex',
-                             'OAuthException error on get.*: '
-                             'An unexpected error has occurred. '
-                             'Please retry your request later..'
-                             )
-                            ]),
-                 )
-                ])
-        or_query = OrderedDict([
-                ('$or',
-                 [null_query,
-                  validating_query,
-                  retry_query,
-                  ],
-                 ),
-                ])
-        match_query = OrderedDict([
-                ('ubernear.lookup_completed',
-                 OrderedDict([
-                            ('$exists', False),
-                            ]),
-                 ),
-                ])
-        and_query = OrderedDict([
-                ('$and', [match_query, or_query]),
-                ])
         query = OrderedDict([
-                ('$or',
-                 [match_query, and_query],
+                ('ubernear.stages', 'lookup'),
+                ('ubernear.retry_at', OrderedDict([
+                            ('$lte', datetime(2011, 10, 16, 2, 50, 32)),
+                            ]),
                  ),
                 ])
         find.with_args(
             query,
-            sort=[('ubernear.fetched', 1)],
+            sort=[('ubernear.retry_at', 1)],
             )
 
         events = []
@@ -1406,6 +1644,12 @@ class TestFacebookEvent(object):
                     ('ubernear.lookup_completed',
                      datetime(2011, 10, 16, 2, 50, 32),
                      ),
+                    ('ubernear.modified',
+                     datetime(2011, 10, 16, 2, 50, 32),
+                     ),
+                    ('ubernear.duration_seconds', 10800),
+                    ('ubernear.tokens', []),
+                    ('ubernear.stages', ['normalize', 'geocode', 'match']),
                     ])
             update.with_args(
                 OrderedDict([
@@ -1413,6 +1657,11 @@ class TestFacebookEvent(object):
                         ]),
                 OrderedDict([
                         ('$set', save),
+                        ('$unset', OrderedDict([
+                                    ('ubernear.retry_count', ''),
+                                    ('ubernear.retry_at', ''),
+                                    ]),
+                         ),
                         ]),
                 upsert=True,
                 safe=True,
@@ -1421,7 +1670,6 @@ class TestFacebookEvent(object):
         [update_fakes(events_coll,i) for i in xrange(1,105+1)]
 
         fake_datetime = fudge.Fake('datetime')
-        fake_datetime.remember_order()
 
         utcnow = fake_datetime.expects('utcnow')
         utcnow.with_arg_count(0)
@@ -1442,63 +1690,22 @@ class TestFacebookEvent(object):
         events_coll.remember_order()
 
         find = events_coll.expects('find')
-        null_query = OrderedDict([
-                ('ubernear.lookup_failed.reason',
-                 'Null response',
-                 ),
-                ])
-        validating_query = OrderedDict([
-                ('ubernear.lookup_failed.reason', OrderedDict([
-                            ('$regex',
-                             'OAuthException error on get.*: '
-                             'Error validating application..'
-                             )
-                            ]),
-                 )
-                ])
-        retry_query = OrderedDict([
-                ('ubernear.lookup_failed.reason', OrderedDict([
-                            ('$regex',
-                             'OAuthException error on get.*: '
-                             'An unexpected error has occurred. '
-                             'Please retry your request later..'
-                             )
-                            ]),
-                 )
-                ])
-        or_query = OrderedDict([
-                ('$or',
-                 [null_query,
-                  validating_query,
-                  retry_query,
-                  ],
-                 ),
-                ])
-        match_query = OrderedDict([
-                ('ubernear.lookup_completed',
-                 OrderedDict([
-                            ('$exists', False),
-                            ]),
-                 ),
-                ])
-        and_query = OrderedDict([
-                ('$and', [match_query, or_query]),
-                ])
         query = OrderedDict([
-                ('$or',
-                 [match_query, and_query],
+                ('ubernear.stages', 'lookup'),
+                ('ubernear.retry_at', OrderedDict([
+                            ('$lte', datetime(2011, 10, 16, 2, 50, 32)),
+                            ]),
                  ),
                 ])
         find.with_args(
             query,
-            sort=[('ubernear.fetched', 1)],
+            sort=[('ubernear.retry_at', 1)],
             )
 
         fake_cursor = FakeCursor([])
         find.returns(fake_cursor)
 
         fake_datetime = fudge.Fake('datetime')
-        fake_datetime.remember_order()
 
         utcnow = fake_datetime.expects('utcnow')
         utcnow.with_arg_count(0)
@@ -1558,7 +1765,6 @@ class TestFacebookEvent(object):
             )
 
         fake_datetime = fudge.Fake('datetime')
-        fake_datetime.remember_order()
 
         utcnow = fake_datetime.expects('utcnow')
         utcnow.with_arg_count(0)
@@ -0,0 +1,74 @@
+import fudge
+
+from nose.tools import eq_ as eq
+from datetime import datetime
+
+from ubernear import indices
+
+class TestIndices(object):
+    def setUp(self):
+        fudge.clear_expectations()
+
+    @fudge.with_fakes
+    def test_ensure_indices_simple(self):
+        owners_coll = fudge.Fake('owners_coll')
+        ensure_index = owners_coll.expects('ensure_index')
+        ensure_index.with_args(
+            [('ubernear.last_lookup', 1)],
+            background=True,
+            )
+
+        fake_log = fudge.Fake('log')
+        fake_log.provides('debug')
+
+        # Collections that are not configured are skipped
+        coll = dict([
+                ('owners-collection', owners_coll),
+                ])
+        indices.ensure_indices(
+            coll,
+            _log=fake_log,
+            )
+
+    @fudge.with_fakes
+    def test_check_api_indices_simple(self):
+        explains = [
+            {'cursor': 'BtreeCursor facebook.start_time_1'},
+            {'cursor': 'BtreeCursor facebook.start_time_1'},
+            {'cursor': 'BasicCursor'},
+            {'cursor': 'BtreeCursor facebook.start_time_1__id_1'},
+            {'queryPlanner': {'winningPlan': {'stage': 'FETCH'}}},
+            {'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}},
+            {'cursor': 'GeoBrowse-box'},
+            {'clauses': [], 'cursor': 'QueryOptimizerCursor'},
+            {'cursor': 'BtreeCursor ubernear.tokens_1'},
+            {'cursor': 'BtreeCursor match.ubernear.quadkey_1 multi'},
+            {'cursor': 'BtreeCursor ubernear.duration_seconds_1'},
+            ]
+        def find(*args, **kwargs):
+            cursor = fudge.Fake('cursor')
+            cursor.provides('explain').returns(explains.pop(0))
+            return cursor
+
+        events_coll = fudge.Fake('events_coll')
+        events_coll.provides('find').calls(find)
+
+        fake_log = fudge.Fake('log')
+        warn = fake_log.expects('warn')
+        warn.with_args('The all stream query does not use an index')
+        warn.next_call().with_args(
+            'The single coordinate until query does not use an index',
+            )
+
+        fake_datetime = fudge.Fake('datetime')
+        fake_datetime.provides('now').returns(
+            datetime(2012, 1, 23, 5, 26, 56),
+            )
+
+        res = indices.check_api_indices(
+            events_coll,
+            _log=fake_log,
+            _datetime=fake_datetime,
+            )
+
+        eq(res, ['all stream', 'single coordinate until'])
@@ -0,0 +1,90 @@
+import fudge
+
+from nose.tools import eq_ as eq
+from collections import OrderedDict
+
+from ubernear import metrics
+
+class TestMetrics(object):
+    def setUp(self):
+        fudge.clear_expectations()
+        metrics.end_request()
+
+    def tearDown(self):
+        metrics.end_request()
+
+    @fudge.with_fakes
+    def test_request_metrics_nested_phases(self):
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(100.0)
+        for now in [100.5, 101.0, 103.0, 103.5, 104.0]:
+            fake_time.next_call().returns(now)
+
+        request_metrics = metrics.start_request(_time=fake_time)
+        with metrics.timing('group'):
+            with metrics.timing('mongo'):
+                pass
+        metrics.add_count('documents', 3)
+
+        eq(metrics.current(), request_metrics)
+        eq(
+            request_metrics.timings,
+            OrderedDict([
+                    ('group', 1.0),
+                    ('mongo', 2.0),
+                    ]),
+            )
+        eq(
+            request_metrics.fields(total=4.0),
+            ['group_ms=1000.000',
+             'mongo_ms=2000.000',
+             'other_ms=1000.000',
+             'total_ms=4000.000',
+             'documents=3',
+             ],
+            )
+
+    @fudge.with_fakes
+    def test_timed_iter_simple(self):
+        request_metrics = metrics.start_request()
+        items = metrics.timed_iter(
+            ['foo', 'bar'],
+            phase='mongo',
+            count='documents',
+            )
+
+        eq(list(items), ['foo', 'bar'])
+        eq(request_metrics.counts, OrderedDict([('documents', 2)]))
+        eq(request_metrics.timings.keys(), ['mongo'])
+
+    @fudge.with_fakes
+    def test_timed_outside_request(self):
+        @metrics.timed('encode')
+        def encode(value):
+            return value
+
+        eq(encode('foo'), 'foo')
+        eq(list(metrics.timed_iter(['foo'], phase='mongo')), ['foo'])
+        eq(metrics.current(), None)
+
+    @fudge.with_fakes
+    def test_histogram_text(self):
+        histogram = metrics.Histogram(
+            name='foo_seconds',
+            description='Foo time.',
+            label='phase',
+            buckets=[0.1, 1],
+            )
+        histogram.observe('mongo', 0.05)
+        histogram.observe('mongo', 0.5)
+
+        eq(
+            histogram.text(),
+            '# HELP foo_seconds Foo time.\n'
+            '# TYPE foo_seconds histogram\n'
+            'foo_seconds_bucket{phase="mongo",le="0.1"} 1\n'
+            'foo_seconds_bucket{phase="mongo",le="1.0"} 2\n'
+            'foo_seconds_bucket{phase="mongo",le="+Inf"} 2\n'
+            'foo_seconds_sum{phase="mongo"} 0.55\n'
+            'foo_seconds_count{phase="mongo"} 2\n'
+            )
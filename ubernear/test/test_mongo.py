@@ -1,7 +1,9 @@
 import fudge
+import pymongo
 
 from nose.tools import eq_ as eq
 from collections import OrderedDict
+from datetime import datetime
 
 from ubernear.util import mongo
 
@@ -204,6 +206,28 @@ def test_save_no_replace_add_each():
         add_each=add_each,
         )
 
+def test_save_no_replace_unset():
+    collection = fudge.Fake('collection')
+    update = collection.expects('update')
+    update.with_args(
+        OrderedDict([
+                ('_id', 'foo_id'),
+                ]),
+        OrderedDict([
+                ('$set', OrderedDict([('foo', 'bar')])),
+                ('$unset', OrderedDict([('sna', ''), ('fee', '')])),
+                ]),
+        upsert=True,
+        safe=True,
+        )
+
+    mongo.save_no_replace(
+        collection,
+        'foo_id',
+        save=OrderedDict([('foo', 'bar')]),
+        unset=['sna', 'fee'],
+        )
+
 def test_save_no_replace_noop():
     collection = fudge.Fake('collection')
     mongo.save_no_replace(
@@ -216,15 +240,18 @@ def test_create_indices_simple():
     collection.remember_order()
 
     ensure_index = collection.expects('ensure_index')
-    ensure_index.with_args([
-            ('foo', 'bar'),
-            ])
+    ensure_index.with_args(
+        [('foo', 'bar')],
+        background=False,
+        )
 
     ensure_index = collection.next_call('ensure_index')
-    ensure_index.with_args([
-            ('sna', 'foo'),
-            ('fee', 'fi'),
-            ])
+    ensure_index.with_args(
+        [('sna', 'foo'),
+         ('fee', 'fi'),
+         ],
+        background=False,
+        )
 
     indices = [
         OrderedDict([
@@ -332,3 +359,638 @@ def test_dot_keys_none():
             ('a.b.g', 'sna'),
             ])
     eq(save, expected)
+
+def test_get_generation_simple():
+    collection = fudge.Fake('collection')
+    find_one = collection.expects('find_one')
+    find_one.with_args(
+        OrderedDict([
+                ('_id', 'foo'),
+                ]),
+        )
+    find_one.returns(
+        OrderedDict([
+                ('_id', 'foo'),
+                ('generation', 7),
+                ])
+        )
+
+    generation = mongo.get_generation(
+        collection,
+        name='foo',
+        )
+
+    eq(generation, 7)
+
+def test_get_generation_missing():
+    collection = fudge.Fake('collection')
+    find_one = collection.expects('find_one')
+    find_one.returns(None)
+
+    generation = mongo.get_generation(
+        collection,
+        name='foo',
+        )
+
+    eq(generation, 0)
+
+def test_bump_generation_simple():
+    collection = fudge.Fake('collection')
+    collection.remember_order()
+
+    now = datetime(2012, 5, 22, 3, 35, 8)
+    update = collection.expects('update')
+    update.with_args(
+        OrderedDict([
+                ('_id', 'foo'),
+                ]),
+        OrderedDict([
+                ('$inc', OrderedDict([
+                            ('generation', 1),
+                            ]),
+                 ),
+                ('$set', OrderedDict([
+                            ('modified', now),
+                            ]),
+                 ),
+                ]),
+        upsert=True,
+        safe=True,
+        )
+
+    mongo.bump_generation(
+        collection,
+        name='foo',
+        now=now,
+        )
+
+def test_get_generation_info_simple():
+    collection = fudge.Fake('collection')
+    find_one = collection.expects('find_one')
+    find_one.with_args(
+        OrderedDict([
+                ('_id', 'foo'),
+                ]),
+        )
+    find_one.returns(
+        OrderedDict([
+                ('_id', 'foo'),
+                ('generation', 7),
+                ('modified', datetime(2012, 5, 22, 3, 35, 8)),
+                ])
+        )
+
+    info = mongo.get_generation_info(
+        collection,
+        name='foo',
+        )
+
+    eq(info, (7, datetime(2012, 5, 22, 3, 35, 8)))
+
+def test_get_generation_info_missing():
+    collection = fudge.Fake('collection')
+    find_one = collection.expects('find_one')
+    find_one.returns(None)
+
+    info = mongo.get_generation_info(
+        collection,
+        name='foo',
+        )
+
+    eq(info, (0, None))
+
+class FakeBulk(object):
+    """
+    Records the updates of an unordered bulk operation.
+    """
+    def __init__(self, executed, error=None):
+        self._executed = executed
+        self._error = error
+        self._updates = []
+        self._spec = None
+        self._upsert = False
+
+    def find(self, spec):
+        self._spec = spec
+        self._upsert = False
+        return self
+
+    def upsert(self):
+        self._upsert = True
+        return self
+
+    def update_one(self, document):
+        self._updates.append((self._spec, document, self._upsert))
+
+    def execute(self, write_concern):
+        eq(write_concern, OrderedDict([('w', 1)]))
+        self._executed.append(self._updates)
+        if self._error is not None:
+            raise self._error
+
+class FakeBulkCollection(object):
+    def __init__(self, error=None):
+        self.executed = []
+        self._error = error
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulk(self.executed, error=self._error)
+
+def _bulk_update(_id, save):
+    return (
+        OrderedDict([
+                ('_id', _id),
+                ]),
+        OrderedDict([
+                ('$set', save),
+                ]),
+        True,
+        )
+
+def test_bulk_writer_simple():
+    collection = FakeBulkCollection()
+
+    with mongo.BulkWriter(collection, size=2) as writer:
+        mongo.save_no_replace(
+            writer,
+            'foo_id',
+            save=OrderedDict([('foo', 'bar')]),
+            )
+        eq(collection.executed, [])
+        mongo.save_no_replace(
+            writer,
+            'sna_id',
+            save=OrderedDict([('sna', 'foo')]),
+            )
+        eq(len(collection.executed), 1)
+        mongo.save_no_replace(
+            writer,
+            'fee_id',
+            save=OrderedDict([('fee', 'fi')]),
+            )
+
+    eq(
+        collection.executed,
+        [[_bulk_update('foo_id', OrderedDict([('foo', 'bar')])),
+          _bulk_update('sna_id', OrderedDict([('sna', 'foo')])),
+          ],
+         [_bulk_update('fee_id', OrderedDict([('fee', 'fi')])),
+          ],
+         ],
+        )
+    eq(writer.failures, [])
+
+def test_bulk_writer_same_id():
+    collection = FakeBulkCollection()
+    writer = mongo.BulkWriter(collection, size=10)
+    mongo.save_no_replace(
+        writer,
+        'foo_id',
+        save=OrderedDict([('foo', 'bar')]),
+        )
+    # Unordered updates of the same document could be reordered
+    mongo.save_no_replace(
+        writer,
+        'foo_id',
+        save=OrderedDict([('foo', 'sna')]),
+        )
+
+    eq(
+        collection.executed,
+        [[_bulk_update('foo_id', OrderedDict([('foo', 'bar')]))]],
+        )
+    eq(len(writer), 1)
+
+def test_bulk_writer_interval():
+    fake_time = fudge.Fake('time', callable=True)
+    fake_time.returns(100.0)
+    fake_time.next_call().returns(100.5)
+    fake_time.next_call().returns(101.0)
+
+    collection = FakeBulkCollection()
+    writer = mongo.BulkWriter(
+        collection,
+        size=10,
+        interval=1,
+        _time=fake_time,
+        )
+    for _id in ['foo_id', 'sna_id', 'fee_id']:
+        mongo.save_no_replace(
+            writer,
+            _id,
+            save=OrderedDict([('foo', 'bar')]),
+            )
+
+    eq(len(collection.executed), 1)
+    eq(len(collection.executed[0]), 3)
+    eq(len(writer), 0)
+
+def test_bulk_writer_errors():
+    error = pymongo.errors.BulkWriteError(
+        OrderedDict([
+                ('writeErrors', [
+                        OrderedDict([
+                                ('index', 1),
+                                ('code', 11000),
+                                ('errmsg', 'foo error'),
+                                ]),
+                        ],
+                 ),
+                ])
+        )
+    collection = FakeBulkCollection(error=error)
+
+    fake_log = fudge.Fake('log')
+    error_log = fake_log.provides('error')
+    error_log.with_args('Could not save sna_id: foo error')
+
+    with mongo.BulkWriter(collection, _log=fake_log) as writer:
+        for _id in ['foo_id', 'sna_id']:
+            mongo.save_no_replace(
+                writer,
+                _id,
+                save=OrderedDict([('foo', 'bar')]),
+                )
+
+    eq(writer.failures, [('sna_id', 'foo error')])
+
+def test_bulk_writer_write_concern_errors():
+    error = pymongo.errors.BulkWriteError(
+        OrderedDict([
+                ('writeErrors', [
+                        OrderedDict([
+                                ('index', 1),
+                                ('code', 11000),
+                                ('errmsg', 'foo error'),
+                                ]),
+                        ],
+                 ),
+                ('writeConcernErrors', [
+                        OrderedDict([
+                                ('code', 64),
+                                ('errmsg',
+                                 'waiting for replication timed out',
+                                 ),
+                                ]),
+                        ],
+                 ),
+                ])
+        )
+    collection = FakeBulkCollection(error=error)
+
+    fake_log = fudge.Fake('log')
+    fake_log.remember_order()
+    error_log = fake_log.expects('error')
+    error_log.with_args('Could not save sna_id: foo error')
+    error_log = fake_log.next_call('error')
+    error_log.with_args(
+        'Could not save 2 documents: waiting for replication timed out',
+        )
+
+    with mongo.BulkWriter(collection, _log=fake_log) as writer:
+        for _id in ['foo_id', 'sna_id', 'fee_id']:
+            mongo.save_no_replace(
+                writer,
+                _id,
+                save=OrderedDict([('foo', 'bar')]),
+                )
+
+    eq(
+        writer.failures,
+        [('sna_id', 'foo error'),
+         ('foo_id', 'waiting for replication timed out'),
+         ('fee_id', 'waiting for replication timed out'),
+         ],
+        )
+
+def test_bulk_writer_connection_error():
+    error = pymongo.errors.AutoReconnect('connection closed')
+    collection = FakeBulkCollection(error=error)
+
+    fake_log = fudge.Fake('log')
+    error_log = fake_log.expects('error')
+    error_log.with_args('Could not save 2 documents: connection closed')
+
+    with mongo.BulkWriter(collection, _log=fake_log) as writer:
+        for _id in ['foo_id', 'sna_id']:
+            mongo.save_no_replace(
+                writer,
+                _id,
+                save=OrderedDict([('foo', 'bar')]),
+                )
+
+    # Failed updates are not written again
+    eq(len(writer), 0)
+    eq(
+        writer.failures,
+        [('foo_id', 'connection closed'),
+         ('sna_id', 'connection closed'),
+         ],
+        )
+
+def test_bulk_writer_stamps():
+    fake_datetime = fudge.Fake('datetime')
+    fake_datetime.provides('utcnow').returns(datetime(2012, 5, 22, 3, 41, 30))
+
+    collection = FakeBulkCollection()
+    with mongo.BulkWriter(
+        collection,
+        stamps=['ubernear.modified'],
+        _datetime=fake_datetime,
+        ) as writer:
+        mongo.save_no_replace(
+            writer,
+            'foo_id',
+            save=OrderedDict([
+                    ('foo', 'bar'),
+                    ('ubernear.modified', datetime(2012, 5, 22, 3, 35, 8)),
+                    ]),
+            )
+        mongo.save_no_replace(
+            writer,
+            'sna_id',
+            save=OrderedDict([('sna', 'foo')]),
+            )
+
+    # Readers first see the updates when the buffer is written
+    eq(
+        collection.executed,
+        [[_bulk_update(
+                    'foo_id',
+                    OrderedDict([
+                            ('foo', 'bar'),
+                            ('ubernear.modified',
+                             datetime(2012, 5, 22, 3, 41, 30),
+                             ),
+                            ]),
+                    ),
+          _bulk_update('sna_id', OrderedDict([('sna', 'foo')])),
+          ],
+         ],
+        )
+
+def test_bulk_writes_without_size():
+    collection = FakeBulkCollection()
+
+    with mongo.bulk_writes(collection) as writes_coll:
+        eq(writes_coll, collection)
+
+    with mongo.bulk_writes(collection, size=2) as writes_coll:
+        eq(isinstance(writes_coll, mongo.BulkWriter), True)
+
+class FakeJobsCollection(object):
+    """
+    Records the updates of checkpoints.
+    """
+    def __init__(self, doc=None):
+        self.doc = doc
+        self.updates = []
+
+    def find_one(self, spec):
+        eq(spec, OrderedDict([('_id', 'foo_job')]))
+        return self.doc
+
+    def update(self, spec, document, upsert=False, safe=False):
+        eq(safe, True)
+        self.updates.append((spec, document, upsert))
+
+class FakeUUID(object):
+    hex = 'foo_run'
+
+class FakeCheckpoint(object):
+    def __init__(self, last=None):
+        self.last = last
+        self.saved = []
+        self.finished = False
+
+    def start(self):
+        return self.last
+
+    def save(self, last):
+        self.last = last
+        self.saved.append(last)
+
+    def finish(self):
+        self.finished = True
+
+class FakeChunksCollection(object):
+    """
+    Finds documents with the _id greater than the query's $gt, if
+    any, raising errors first.
+    """
+    def __init__(self, ids, errors=None):
+        if errors is None:
+            errors = []
+        self._ids = ids
+        self._errors = errors
+        self.queries = []
+
+    def find(self, spec, sort, limit):
+        eq(sort, [('_id', 1)])
+        self.queries.append(spec)
+        if self._errors:
+            raise self._errors.pop(0)
+        last = None
+        for part in spec.get('$and', []):
+            if '_id' in part:
+                last = part['_id']['$gt']
+        ids = [_id for _id in self._ids if last is None or _id > last]
+        return iter([OrderedDict([('_id', _id)]) for _id in ids[:limit]])
+
+def _checkpoint_datetime():
+    fake_datetime = fudge.Fake('datetime')
+    fake_datetime.provides('utcnow').returns(
+        datetime(2012, 2, 26, 3, 27, 15),
+        )
+    return fake_datetime
+
+def test_checkpoint_start_new():
+    now = datetime(2012, 2, 26, 3, 27, 15)
+    jobs_coll = FakeJobsCollection(
+        doc=OrderedDict([
+                ('_id', 'foo_job'),
+                ('run_id', 'sna_run'),
+                ('last', 'sna_id'),
+                ('finished', now),
+                ]),
+        )
+    checkpoint = mongo.Checkpoint(
+        jobs_coll,
+        job='foo_job',
+        _datetime=_checkpoint_datetime(),
+        _uuid=FakeUUID,
+        )
+
+    eq(checkpoint.start(), None)
+    checkpoint.save('foo_id')
+    checkpoint.finish()
+
+    query = OrderedDict([
+            ('_id', 'foo_job'),
+            ('run_id', 'foo_run'),
+            ])
+    eq(
+        jobs_coll.updates,
+        [(OrderedDict([('_id', 'foo_job')]),
+          OrderedDict([
+                    ('_id', 'foo_job'),
+                    ('run_id', 'foo_run'),
+                    ('started', now),
+                    ('updated', now),
+                    ]),
+          True,
+          ),
+         (query,
+          OrderedDict([
+                    ('$set', OrderedDict([
+                                ('last', 'foo_id'),
+                                ('updated', now),
+                                ]),
+                     ),
+                    ]),
+          False,
+          ),
+         (query,
+          OrderedDict([
+                    ('$set', OrderedDict([
+                                ('finished', now),
+                                ('updated', now),
+                                ]),
+                     ),
+                    ]),
+          False,
+          ),
+         ],
+        )
+
+def test_checkpoint_resume():
+    jobs_coll = FakeJobsCollection(
+        doc=OrderedDict([
+                ('_id', 'foo_job'),
+                ('run_id', 'sna_run'),
+                ('last', 'sna_id'),
+                ]),
+        )
+    fake_log = fudge.Fake('log')
+    fake_log.provides('info').with_args(
+        'Resuming foo_job run sna_run after sna_id',
+        )
+    checkpoint = mongo.Checkpoint(
+        jobs_coll,
+        job='foo_job',
+        _log=fake_log,
+        _datetime=_checkpoint_datetime(),
+        _uuid=FakeUUID,
+        )
+
+    eq(checkpoint.start(), 'sna_id')
+    eq(checkpoint.run_id, 'sna_run')
+    eq(jobs_coll.updates, [])
+
+def test_checkpointed_chunks_simple():
+    collection = FakeChunksCollection(['a', 'b', 'c', 'd', 'e'])
+    checkpoint = FakeCheckpoint(last='a')
+    spec = OrderedDict([('foo', 'bar')])
+
+    chunks = mongo.checkpointed_chunks(
+        collection,
+        spec=spec,
+        checkpoint=checkpoint,
+        size=2,
+        )
+    chunk = chunks.next()
+    eq(chunk, [OrderedDict([('_id', 'b')]), OrderedDict([('_id', 'c')])])
+    # Saved once the chunk is processed
+    eq(checkpoint.saved, [])
+    rest = list(chunks)
+
+    eq(
+        rest,
+        [[OrderedDict([('_id', 'd')]), OrderedDict([('_id', 'e')])]],
+        )
+    eq(checkpoint.saved, ['c', 'e'])
+    eq(checkpoint.finished, True)
+    eq(
+        collection.queries[0],
+        OrderedDict([
+                ('$and', [
+                        spec,
+                        OrderedDict([
+                                ('_id', OrderedDict([
+                                            ('$gt', 'a'),
+                                            ]),
+                                 ),
+                                ]),
+                        ],
+                 ),
+                ]),
+        )
+    # The last chunk was full so one more is read
+    eq(len(collection.queries), 3)
+
+def test_checkpointed_chunks_failed_writes():
+    collection = FakeChunksCollection(['a', 'b', 'c', 'd', 'e'])
+    checkpoint = FakeCheckpoint()
+    failures = []
+    fake_log = fudge.Fake('log')
+    fake_log.provides('warning').with_args(
+        'Not finishing the run since some writes failed, the next '
+        'one resumes after a',
+        )
+
+    chunks = mongo.checkpointed_chunks(
+        collection,
+        spec=None,
+        checkpoint=checkpoint,
+        size=2,
+        failures=failures,
+        _log=fake_log,
+        )
+    chunks.next()
+    failures.append(('b', 'foo error'))
+    rest = list(chunks)
+
+    # The other chunks are still processed
+    eq(
+        rest,
+        [
+            [OrderedDict([('_id', 'c')]), OrderedDict([('_id', 'd')])],
+            [OrderedDict([('_id', 'e')])],
+            ],
+        )
+    eq(checkpoint.saved, ['a'])
+    eq(checkpoint.finished, False)
+
+def test_checkpointed_chunks_lost_cursor():
+    collection = FakeChunksCollection(
+        ['a', 'b'],
+        errors=[pymongo.errors.OperationFailure('cursor not found')],
+        )
+    checkpoint = FakeCheckpoint()
+
+    chunks = mongo.checkpointed_chunks(
+        collection,
+        spec=None,
+        checkpoint=checkpoint,
+        size=10,
+        )
+
+    eq(
+        list(chunks),
+        [[OrderedDict([('_id', 'a')]), OrderedDict([('_id', 'b')])]],
+        )
+    eq(collection.queries, [OrderedDict(), OrderedDict()])
+    eq(checkpoint.saved, ['b'])
+    eq(checkpoint.finished, True)
+
+def test_resumable_chunks_without_jobs():
+    cursor = iter(['foo'])
+
+    chunks = mongo.resumable_chunks(
+        cursor,
+        FakeChunksCollection([]),
+        spec=None,
+        job='foo_job',
+        )
+
+    eq(chunks, [cursor])
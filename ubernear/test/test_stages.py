@@ -0,0 +1,150 @@
+import fudge
+
+from nose.tools import eq_ as eq
+from collections import OrderedDict
+from datetime import datetime
+
+from ubernear import stages
+
+class TestStages(object):
+    def setUp(self):
+        fudge.clear_expectations()
+
+    @fudge.with_fakes
+    def test_next_stages_simple(self):
+        event = OrderedDict([
+                ('_id', 'foo'),
+                ('ubernear', OrderedDict([
+                            ('fetched', datetime(2012, 5, 22, 3, 35, 8)),
+                            ]),
+                 ),
+                ])
+        facebook = OrderedDict([
+                ('venue', OrderedDict([
+                            ('latitude', 34.101593),
+                            ]),
+                 ),
+                ])
+
+        eq(
+            stages.next_stages(event, facebook),
+            ['normalize', 'geocode', 'match'],
+            )
+
+    @fudge.with_fakes
+    def test_next_stages_done(self):
+        event = OrderedDict([
+                ('_id', 'foo'),
+                ('ubernear', OrderedDict([
+                            ('normalization_failed', OrderedDict([
+                                        ('reason', 'No venue'),
+                                        ]),
+                             ),
+                            ('match_failed', 'No place match'),
+                            ]),
+                 ),
+                ])
+        facebook = OrderedDict([
+                ('venue', OrderedDict([
+                            ('latitude', 34.101593),
+                            ('longitude', -118.331231),
+                            ]),
+                 ),
+                ])
+
+        eq(stages.next_stages(event, facebook), ['match'])
+
+    @fudge.with_fakes
+    def test_ready_query_simple(self):
+        eq(
+            stages.ready_query(stages.match),
+            OrderedDict([
+                    ('ubernear.stages', OrderedDict([
+                                ('$nin', ['normalize', 'geocode']),
+                                ]),
+                     ),
+                    ]),
+            )
+
+    @fudge.with_fakes
+    def test_queue_stages_simple(self):
+        events_coll = fudge.Fake('events_coll')
+        events_coll.remember_order()
+
+        find = events_coll.expects('find')
+        find.with_args(
+            OrderedDict([
+                    ('ubernear.stages', OrderedDict([
+                                ('$exists', False),
+                                ]),
+                     ),
+                    ]),
+            )
+        events = [
+            OrderedDict([
+                    ('_id', 'foo'),
+                    ('facebook', OrderedDict()),
+                    ('ubernear', OrderedDict()),
+                    ]),
+            OrderedDict([
+                    ('_id', 'bar'),
+                    ('facebook', OrderedDict()),
+                    ('ubernear', OrderedDict([
+                                ('lookup_completed',
+                                 datetime(2012, 5, 22, 3, 35, 8),
+                                 ),
+                                ('match_completed',
+                                 datetime(2012, 5, 22, 3, 35, 8),
+                                 ),
+                                ]),
+                     ),
+                    ]),
+            ]
+        find.returns(events)
+
+        update = events_coll.expects('update')
+        update.with_args(
+            OrderedDict([
+                    ('_id', 'foo'),
+                    ]),
+            OrderedDict([
+                    ('$set', OrderedDict([
+                                ('ubernear.stages', ['lookup']),
+                                ('ubernear.retry_at',
+                                 datetime(2012, 5, 23, 1, 12, 9),
+                                 ),
+                                ]),
+                     ),
+                    ]),
+            upsert=True,
+            safe=True,
+            )
+        update = events_coll.next_call('update')
+        update.with_args(
+            OrderedDict([
+                    ('_id', 'bar'),
+                    ]),
+            OrderedDict([
+                    ('$set', OrderedDict([
+                                ('ubernear.stages', ['normalize', 'geocode']),
+                                ]),
+                     ),
+                    ]),
+            upsert=True,
+            safe=True,
+            )
+
+        fake_log = fudge.Fake('log')
+        info = fake_log.expects('info')
+        info.with_args('Queued stages for 2 events')
+
+        fake_datetime = fudge.Fake('datetime')
+        fake_datetime.provides('utcnow').returns(
+            datetime(2012, 5, 23, 1, 12, 9),
+            )
+
+        stages.queue_stages(
+            events_coll,
+            _log=fake_log,
+            _datetime=fake_datetime,
+            )
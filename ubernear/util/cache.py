@@ -0,0 +1,54 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe mapping. The least recently used
+    item is evicted when the cache is full and items older
+    than ttl seconds are treated as missing.
+    """
+    def __init__(
+        self,
+        size,
+        ttl=None,
+        _time=None,
+        ):
+        if _time is None:
+            _time = time.time
+
+        self._size = size
+        self._ttl = ttl
+        self._time = _time
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                (stored, value) = self._items.pop(key)
+            except KeyError:
+                return default
+
+            if self._ttl is not None and self._time() - stored >= self._ttl:
+                return default
+
+            # Re-insert to mark as the most recently used
+            self._items[key] = (stored, value)
+
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (self._time(), value)
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
@@ -64,3 +64,20 @@ def collections(
     collections['database'] = database
 
     return collections
+
+def bulk_config(path):
+    """
+    Return the size and interval of the optional bulk section of
+    the database configuration in path. Each is None when it is
+    not set.
+    """
+    config = config_parser(path)
+
+    size = None
+    if config.has_option('bulk', 'size'):
+        size = config.getint('bulk', 'size')
+    interval = None
+    if config.has_option('bulk', 'interval'):
+        interval = config.getfloat('bulk', 'interval')
+
+    return size, interval
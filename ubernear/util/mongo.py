@@ -1,5 +1,15 @@
+import time
+import uuid
+import logging
+import threading
+import contextlib
+import pymongo
+
+from datetime import datetime
 from collections import OrderedDict
 
+log = logging.getLogger(__name__)
+
 class MongoError(Exception):
     """There was a problem with mongo"""
     def __init__(self, msg):
@@ -34,12 +44,12 @@ def _dot_keys_recurse(save):
     else:
         yield None
 
-def save_no_replace(
-    collection,
-    _id,
+def _changes(
     save=None,
     add=None,
     add_each=None,
+    remove=None,
+    unset=None,
     ):
     changes = OrderedDict()
     if save is not None:
@@ -54,7 +64,38 @@ def save_no_replace(
             changes['$addToSet'][k] = OrderedDict([
                     ('$each', v)
                     ])
+    if remove is not None:
+        changes['$pull'] = remove
+    if unset is not None:
+        changes['$unset'] = OrderedDict([
+                (field, '')
+                for field in unset
+                ])
+
+    return changes
 
+def save_no_replace(
+    collection,
+    _id,
+    save=None,
+    add=None,
+    add_each=None,
+    remove=None,
+    unset=None,
+    ):
+    """
+    Update the fields in save, add to the sets in add and add_each,
+    remove from the arrays in remove and remove the fields in unset
+    of the document with _id, creating it if needed. collection can
+    also be a BulkWriter.
+    """
+    changes = _changes(
+        save=save,
+        add=add,
+        add_each=add_each,
+        remove=remove,
+        unset=unset,
+        )
     if changes:
         collection.update(
             OrderedDict([
@@ -65,9 +106,494 @@ def save_no_replace(
             safe=True,
             )
 
+class BulkWriter(object):
+    """
+    Stands in for collection where only update is called, e.g., in
+    save_no_replace. Updates are buffered and written as a single
+    unordered bulk operation once size of them are buffered or,
+    when interval is given, when an update is buffered interval
+    seconds or more after the first one. The interval is only
+    checked then so, between updates, buffered updates wait for
+    the next one, flush or leaving the writer's with block, which
+    also write them.
+
+    Unordered updates can be applied in any order so an update of
+    a document that is already buffered writes the buffer first.
+    Updates which fail are logged and kept in failures as
+    (_id, error) pairs. When the whole bulk operation fails, or
+    its write concern is not satisfied, every update in it is
+    kept in failures.
+
+    The fields in stamps that updates set are set to the UTC time
+    the buffer is written instead since that is when readers first
+    see the update. When failures is given, failures are appended
+    to it instead of a new list.
+    """
+    def __init__(
+        self,
+        collection,
+        size=1000,
+        interval=None,
+        stamps=None,
+        failures=None,
+        _log=None,
+        _time=None,
+        _datetime=None,
+        ):
+        if stamps is None:
+            stamps = []
+        if failures is None:
+            failures = []
+        if _log is None:
+            _log = log
+        if _time is None:
+            _time = time.time
+        if _datetime is None:
+            _datetime = datetime
+
+        self._collection = collection
+        self._size = size
+        self._interval = interval
+        self._stamps = stamps
+        self._log = _log
+        self._time = _time
+        self._datetime = _datetime
+        self._updates = []
+        self._ids = set()
+        self._started = None
+        self._lock = threading.Lock()
+        self.failures = failures
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def __len__(self):
+        return len(self._updates)
+
+    def update(
+        self,
+        spec,
+        document,
+        upsert=False,
+        safe=True,
+        ):
+        """
+        Buffer an update to the document matching spec, which must
+        have its _id. Bulk operations are always acknowledged so
+        safe is ignored.
+        """
+        now = self._time()
+        with self._lock:
+            _id = spec['_id']
+            if _id in self._ids:
+                self._flush()
+            if not self._updates:
+                self._started = now
+            self._updates.append((spec, document, upsert))
+            self._ids.add(_id)
+
+            if (
+                len(self._updates) >= self._size
+                or
+                (
+                    self._interval is not None
+                    and
+                    now - self._started >= self._interval
+                    )
+                ):
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._updates:
+            return
+
+        updates = self._updates
+        self._updates = []
+        self._ids = set()
+
+        now = self._datetime.utcnow()
+        bulk = self._collection.initialize_unordered_bulk_op()
+        for spec, document, upsert in updates:
+            changes = document.get('$set', {})
+            for field in self._stamps:
+                if field in changes:
+                    changes[field] = now
+            find = bulk.find(spec)
+            if upsert:
+                find = find.upsert()
+            find.update_one(document)
+        try:
+            bulk.execute(
+                OrderedDict([
+                        ('w', 1),
+                        ])
+                )
+        except pymongo.errors.BulkWriteError, e:
+            failed = set()
+            for error in e.details['writeErrors']:
+                failed.add(error['index'])
+                (spec, document, upsert) = updates[error['index']]
+                self._log.error(
+                    'Could not save {_id}: {error}'.format(
+                        _id=spec['_id'],
+                        error=error['errmsg'],
+                        )
+                    )
+                self.failures.append((spec['_id'], error['errmsg']))
+            # The other updates were applied but the write concern
+            # was not satisfied so they might not last
+            for error in e.details.get('writeConcernErrors', []):
+                self._fail_all(
+                    [update
+                     for (index, update) in enumerate(updates)
+                     if index not in failed
+                     ],
+                    error['errmsg'],
+                    )
+        except pymongo.errors.PyMongoError, e:
+            # Any of the updates might not have been applied, e.g.,
+            # when the connection was lost
+            self._fail_all(updates, str(e))
+
+    def _fail_all(self, updates, error):
+        self._log.error(
+            'Could not save {count} document{s}: {error}'.format(
+                count=len(updates),
+                s='' if len(updates) == 1 else 's',
+                error=error,
+                )
+            )
+        for spec, document, upsert in updates:
+            self.failures.append((spec['_id'], error))
+
+@contextlib.contextmanager
+def bulk_writes(
+    collection,
+    size=None,
+    interval=None,
+    stamps=None,
+    failures=None,
+    ):
+    """
+    Yield a BulkWriter for collection or, when size is None,
+    collection itself so that updates are written immediately.
+    The writer keeps its failures in failures when given.
+    """
+    if size is None:
+        yield collection
+        return
+
+    with BulkWriter(
+        collection,
+        size=size,
+        interval=interval,
+        stamps=stamps,
+        failures=failures,
+        ) as writer:
+        yield writer
+
+class Checkpoint(object):
+    """
+    The progress of job, a long-running pass over a collection,
+    stored in jobs_coll as the _id of the last document it
+    processed and the id of the run that processed it. A run that
+    did not finish is resumed by the next one.
+    """
+    def __init__(
+        self,
+        jobs_coll,
+        job,
+        _log=None,
+        _datetime=None,
+        _uuid=None,
+        ):
+        if _log is None:
+            _log = log
+        if _datetime is None:
+            _datetime = datetime
+        if _uuid is None:
+            _uuid = uuid.uuid4
+
+        self._jobs_coll = jobs_coll
+        self._job = job
+        self._log = _log
+        self._datetime = _datetime
+        self._uuid = _uuid
+        self.run_id = None
+        self.last = None
+
+    def start(self):
+        """
+        Resume the unfinished run of job, if any, or start a new
+        one. Return the _id of the last document processed.
+        """
+        doc = self._jobs_coll.find_one(
+            OrderedDict([
+                    ('_id', self._job),
+                    ])
+            )
+        if doc is not None and doc.get('finished') is None:
+            self.run_id = doc['run_id']
+            self.last = doc.get('last')
+            self._log.info(
+                'Resuming {job} run {run_id} after {last}'.format(
+                    job=self._job,
+                    run_id=self.run_id,
+                    last=self.last,
+                    )
+                )
+            return self.last
+
+        now = self._datetime.utcnow()
+        self.run_id = self._uuid().hex
+        self.last = None
+        self._jobs_coll.update(
+            OrderedDict([
+                    ('_id', self._job),
+                    ]),
+            OrderedDict([
+                    ('_id', self._job),
+                    ('run_id', self.run_id),
+                    ('started', now),
+                    ('updated', now),
+                    ]),
+            upsert=True,
+            safe=True,
+            )
+
+        return self.last
+
+    def _update(self, save):
+        # Only the run that owns the checkpoint moves it
+        self._jobs_coll.update(
+            OrderedDict([
+                    ('_id', self._job),
+                    ('run_id', self.run_id),
+                    ]),
+            OrderedDict([
+                    ('$set', save),
+                    ]),
+            safe=True,
+            )
+
+    def save(self, last):
+        self.last = last
+        self._update(
+            OrderedDict([
+                    ('last', last),
+                    ('updated', self._datetime.utcnow()),
+                    ])
+            )
+
+    def finish(self):
+        now = self._datetime.utcnow()
+        self._update(
+            OrderedDict([
+                    ('finished', now),
+                    ('updated', now),
+                    ])
+            )
+
+def _find_chunk(
+    collection,
+    spec,
+    last,
+    size,
+    retries,
+    ):
+    parts = []
+    if spec is not None:
+        parts.append(spec)
+    if last is not None:
+        parts.append(
+            OrderedDict([
+                    ('_id', OrderedDict([
+                                ('$gt', last),
+                                ]),
+                     ),
+                    ])
+            )
+    query = OrderedDict()
+    if parts:
+        query['$and'] = parts
+
+    for i in xrange(retries):
+        try:
+            return list(
+                collection.find(
+                    query,
+                    sort=[('_id', pymongo.ASCENDING)],
+                    limit=size,
+                    )
+                )
+        except (
+            pymongo.errors.AutoReconnect,
+            pymongo.errors.OperationFailure,
+            ):
+            # The cursor was lost, read the chunk again
+            if i == retries - 1:
+                raise
+
+def checkpointed_chunks(
+    collection,
+    spec,
+    checkpoint,
+    size=1000,
+    retries=3,
+    failures=None,
+    _log=None,
+    ):
+    """
+    Yield the documents in collection matching spec, or every
+    document when spec is None, in _id order as lists of at most
+    size documents, starting after checkpoint's last _id. Each
+    chunk is read in full so no cursor is left open while it is
+    processed. The checkpoint is saved when the next chunk is asked
+    for so each chunk must be processed, and its writes done,
+    before then.
+
+    failures is the list of (_id, error) pairs the chunks' writes
+    failed with, e.g., BulkWriter's. The checkpoint is not moved
+    past the first document whose write failed, and the run is not
+    finished, so that the next run resumes from there.
+    """
+    if failures is None:
+        failures = []
+    if _log is None:
+        _log = log
+
+    last = checkpoint.start()
+    failed = False
+    while True:
+        chunk = _find_chunk(
+            collection,
+            spec=spec,
+            last=last,
+            size=size,
+            retries=retries,
+            )
+        if not chunk:
+            break
+        yield chunk
+        last = chunk[-1]['_id']
+        if not failed:
+            failed_ids = set([_id for (_id, error) in failures])
+            written = None
+            for doc in chunk:
+                if doc['_id'] in failed_ids:
+                    failed = True
+                    break
+                written = doc['_id']
+            if written is not None:
+                checkpoint.save(written)
+        if len(chunk) < size:
+            break
+
+    if failed:
+        _log.warning(
+            'Not finishing the run since some writes failed, the next '
+            'one resumes after {last}'.format(
+                last=checkpoint.last,
+                )
+            )
+        return
+
+    checkpoint.finish()
+
+def resumable_chunks(
+    cursor,
+    collection,
+    spec,
+    job,
+    jobs_coll=None,
+    size=1000,
+    failures=None,
+    ):
+    """
+    Return the documents of cursor as chunks to process with a
+    fresh bulk_writes block each. When jobs_coll is None cursor is
+    the only chunk. Otherwise the documents of collection matching
+    spec are read as checkpointed_chunks does, with job's
+    checkpoint in jobs_coll, and cursor is not read. The
+    bulk_writes blocks must keep their failures in failures.
+    """
+    if jobs_coll is None:
+        return [cursor]
+
+    return checkpointed_chunks(
+        collection,
+        spec=spec,
+        checkpoint=Checkpoint(jobs_coll, job=job),
+        size=size,
+        failures=failures,
+        )
+
 def create_indices(
     collection,
     indices,
+    background=False,
     ):
     for index in indices:
-        collection.ensure_index(index.items())
+        collection.ensure_index(
+            index.items(),
+            background=background,
+            )
+
+def get_generation(
+    collection,
+    name,
+    ):
+    (generation, modified) = get_generation_info(
+        collection,
+        name=name,
+        )
+
+    return generation
+
+def get_generation_info(
+    collection,
+    name,
+    ):
+    """
+    Return the generation and the UTC time it was last bumped
+    or None if it was never bumped.
+    """
+    doc = collection.find_one(
+        OrderedDict([
+                ('_id', name),
+                ])
+        )
+    if doc is None:
+        return 0, None
+
+    return doc['generation'], doc.get('modified')
+
+def bump_generation(
+    collection,
+    name,
+    now,
+    ):
+    collection.update(
+        OrderedDict([
+                ('_id', name),
+                ]),
+        OrderedDict([
+                ('$inc', OrderedDict([
+                            ('generation', 1),
+                            ]),
+                 ),
+                ('$set', OrderedDict([
+                            ('modified', now),
+                            ]),
+                 ),
+                ]),
+        upsert=True,
+        safe=True,
+        )
@@ -0,0 +1,171 @@
+import time
+import threading
+import pymongo
+
+from collections import OrderedDict
+
+def _refill(
+    tokens,
+    updated,
+    now,
+    rate,
+    burst,
+    ):
+    elapsed = max(now - updated, 0)
+
+    return min(tokens + elapsed * rate, burst)
+
+def _wait(tokens, rate):
+    # Seconds until the bucket has a whole token
+    return (1 - tokens) / float(rate)
+
+class TokenBuckets(object):
+    """
+    Thread-safe token buckets, one per key, held in memory. A
+    bucket holds at most burst tokens, starts full and gains rate
+    tokens per second. The buckets of the least recently used keys
+    are dropped once there are more than size of them.
+    """
+    def __init__(
+        self,
+        size=1024,
+        _time=None,
+        ):
+        if _time is None:
+            _time = time.time
+
+        self._size = size
+        self._time = _time
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(
+        self,
+        key,
+        rate,
+        burst,
+        ):
+        """
+        Take a token from key's bucket. Return 0 when there was
+        one or the seconds until there is one otherwise.
+        """
+        now = self._time()
+        with self._lock:
+            (tokens, updated) = self._buckets.pop(key, (burst, now))
+            tokens = _refill(
+                tokens=tokens,
+                updated=updated,
+                now=now,
+                rate=rate,
+                burst=burst,
+                )
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = _wait(tokens, rate)
+            # Re-insert to mark as the most recently used
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self._size:
+                self._buckets.popitem(last=False)
+
+        return wait
+
+def wait_for_token(
+    buckets,
+    key,
+    rate,
+    burst,
+    _sleep=None,
+    ):
+    """
+    Sleep until a token can be taken from key's bucket and take it.
+    """
+    if _sleep is None:
+        _sleep = time.sleep
+
+    while True:
+        wait = buckets.take(
+            key=key,
+            rate=rate,
+            burst=burst,
+            )
+        if wait == 0:
+            return
+        _sleep(wait)
+
+class MongoTokenBuckets(object):
+    """
+    Token buckets, like TokenBuckets, stored in a collection so
+    that every process using the collection shares them. Each
+    bucket is a document with the key as _id and is only replaced
+    if no other process changed it since it was read.
+    """
+    def __init__(
+        self,
+        collection,
+        retries=3,
+        _time=None,
+        ):
+        if _time is None:
+            _time = time.time
+
+        self._collection = collection
+        self._retries = retries
+        self._time = _time
+
+    def take(
+        self,
+        key,
+        rate,
+        burst,
+        ):
+        for i in xrange(self._retries):
+            now = self._time()
+            # The API reads from secondaries by default and they
+            # could return a stale bucket
+            bucket = self._collection.find_one(
+                key,
+                read_preference=pymongo.ReadPreference.PRIMARY,
+                )
+            updated = None
+            tokens = burst
+            if bucket is not None:
+                updated = bucket['updated']
+                tokens = _refill(
+                    tokens=bucket['tokens'],
+                    updated=updated,
+                    now=now,
+                    rate=rate,
+                    burst=burst,
+                    )
+            if tokens < 1:
+                return _wait(tokens, rate)
+
+            try:
+                saved = self._collection.find_and_modify(
+                    query=OrderedDict([
+                            ('_id', key),
+                            ('updated', updated),
+                            ]),
+                    update=OrderedDict([
+                            ('$set', OrderedDict([
+                                        ('tokens', tokens - 1),
+                                        ('updated', now),
+                                        ]),
+                             ),
+                            ]),
+                    upsert=True,
+                    new=True,
+                    )
+            except pymongo.errors.DuplicateKeyError:
+                # Another process created or changed the bucket
+                continue
+            if saved is not None:
+                return 0
+
+        # Too many requests with this key at the same time
+        return _wait(0, rate)
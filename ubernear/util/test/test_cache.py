@@ -0,0 +1,50 @@
+import fudge
+
+from nose.tools import eq_ as eq
+
+from ubernear.util.cache import LRUCache
+
+@fudge.with_fakes
+def test_lru_cache_simple():
+    cache = LRUCache(size=2)
+    cache.set('foo', 'bar')
+
+    eq(cache.get('foo'), 'bar')
+    eq(cache.get('sna'), None)
+    eq(cache.get('sna', 'fee'), 'fee')
+
+@fudge.with_fakes
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(size=2)
+    cache.set('foo', 'bar')
+    cache.set('sna', 'fu')
+    # foo becomes the most recently used
+    cache.get('foo')
+    cache.set('fee', 'fi')
+
+    eq(len(cache), 2)
+    eq(cache.get('foo'), 'bar')
+    eq(cache.get('sna'), None)
+    eq(cache.get('fee'), 'fi')
+
+@fudge.with_fakes
+def test_lru_cache_ttl():
+    fake_time = fudge.Fake('time', callable=True)
+    fake_time.returns(100.0)
+    fake_time.next_call().returns(129.0)
+    fake_time.next_call().returns(130.0)
+
+    cache = LRUCache(size=2, ttl=30, _time=fake_time)
+    cache.set('foo', 'bar')
+
+    eq(cache.get('foo'), 'bar')
+    eq(cache.get('foo'), None)
+    eq(len(cache), 0)
+
+@fudge.with_fakes
+def test_lru_cache_clear():
+    cache = LRUCache(size=2)
+    cache.set('foo', 'bar')
+    cache.clear()
+
+    eq(cache.get('foo'), None)
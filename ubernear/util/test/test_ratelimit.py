@@ -0,0 +1,188 @@
+import fudge
+import pymongo
+
+from nose.tools import eq_ as eq
+from collections import OrderedDict
+
+from ubernear.util.ratelimit import (
+    TokenBuckets,
+    MongoTokenBuckets,
+    wait_for_token,
+    )
+
+class TestRateLimit(object):
+    def setUp(self):
+        fudge.clear_expectations()
+
+    @fudge.with_fakes
+    def test_token_buckets_simple(self):
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(100.0)
+        fake_time.next_call().returns(100.0)
+        fake_time.next_call().returns(100.0)
+        fake_time.next_call().returns(100.5)
+
+        buckets = TokenBuckets(_time=fake_time)
+
+        eq(buckets.take('foo', rate=2, burst=2), 0)
+        eq(buckets.take('foo', rate=2, burst=2), 0)
+        eq(buckets.take('foo', rate=2, burst=2), 0.5)
+        # One token was refilled
+        eq(buckets.take('foo', rate=2, burst=2), 0)
+
+    @fudge.with_fakes
+    def test_token_buckets_burst(self):
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(100.0)
+        fake_time.next_call().returns(200.0)
+        fake_time.next_call().returns(200.0)
+
+        buckets = TokenBuckets(_time=fake_time)
+
+        eq(buckets.take('foo', rate=1, burst=1), 0)
+        # Tokens do not accumulate past burst
+        eq(buckets.take('foo', rate=1, burst=1), 0)
+        eq(buckets.take('foo', rate=1, burst=1), 1.0)
+
+    @fudge.with_fakes
+    def test_token_buckets_evicts_least_recently_used(self):
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(100.0)
+
+        buckets = TokenBuckets(size=2, _time=fake_time)
+        buckets.take('foo', rate=1, burst=1)
+        buckets.take('sna', rate=1, burst=1)
+        buckets.take('fee', rate=1, burst=1)
+
+        eq(len(buckets), 2)
+        # foo starts with a full bucket again
+        eq(buckets.take('foo', rate=1, burst=1), 0)
+        eq(buckets.take('fee', rate=1, burst=1), 1.0)
+
+    @fudge.with_fakes
+    def test_wait_for_token(self):
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(100.0)
+        fake_time.next_call().returns(100.0)
+        fake_time.next_call().returns(100.25)
+
+        fake_sleep = fudge.Fake('sleep').expects_call()
+        fake_sleep.with_args(0.25)
+
+        buckets = TokenBuckets(_time=fake_time)
+        wait_for_token(buckets, 'foo', rate=4, burst=1, _sleep=fake_sleep)
+        wait_for_token(buckets, 'foo', rate=4, burst=1, _sleep=fake_sleep)
+
+    @fudge.with_fakes
+    def test_mongo_token_buckets_simple(self):
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(101.0)
+
+        collection = fudge.Fake('collection')
+        collection.remember_order()
+
+        find_one = collection.expects('find_one')
+        find_one.with_args(
+            'foo',
+            read_preference=pymongo.ReadPreference.PRIMARY,
+            )
+        bucket = OrderedDict([
+                ('_id', 'foo'),
+                ('tokens', 0.5),
+                ('updated', 100.0),
+                ])
+        find_one.returns(bucket)
+
+        find_and_modify = collection.expects('find_and_modify')
+        find_and_modify.with_args(
+            query=OrderedDict([
+                    ('_id', 'foo'),
+                    ('updated', 100.0),
+                    ]),
+            update=OrderedDict([
+                    ('$set', OrderedDict([
+                                ('tokens', 0.5),
+                                ('updated', 101.0),
+                                ]),
+                     ),
+                    ]),
+            upsert=True,
+            new=True,
+            )
+        find_and_modify.returns(bucket)
+
+        buckets = MongoTokenBuckets(collection=collection, _time=fake_time)
+
+        eq(buckets.take('foo', rate=1, burst=2), 0)
+
+    @fudge.with_fakes
+    def test_mongo_token_buckets_empty(self):
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(100.5)
+
+        collection = fudge.Fake('collection')
+
+        find_one = collection.expects('find_one')
+        find_one.with_args(
+            'foo',
+            read_preference=pymongo.ReadPreference.PRIMARY,
+            )
+        find_one.returns(
+            OrderedDict([
+                    ('_id', 'foo'),
+                    ('tokens', 0.0),
+                    ('updated', 100.0),
+                    ])
+            )
+
+        buckets = MongoTokenBuckets(collection=collection, _time=fake_time)
+
+        eq(buckets.take('foo', rate=1, burst=2), 0.5)
+
+    @fudge.with_fakes
+    def test_mongo_token_buckets_changed(self):
+        fake_time = fudge.Fake('time', callable=True)
+        fake_time.returns(100.0)
+
+        collection = fudge.Fake('collection')
+
+        find_one = collection.expects('find_one')
+        find_one.with_args(
+            'foo',
+            read_preference=pymongo.ReadPreference.PRIMARY,
+            )
+        find_one.returns(None)
+        find_one.next_call()
+        find_one.with_args(
+            'foo',
+            read_preference=pymongo.ReadPreference.PRIMARY,
+            )
+        find_one.returns(
+            OrderedDict([
+                    ('_id', 'foo'),
+                    ('tokens', 0.0),
+                    ('updated', 100.0),
+                    ])
+            )
+
+        find_and_modify = collection.expects('find_and_modify')
+        find_and_modify.with_args(
+            query=OrderedDict([
+                    ('_id', 'foo'),
+                    ('updated', None),
+                    ]),
+            update=OrderedDict([
+                    ('$set', OrderedDict([
+                                ('tokens', 1),
+                                ('updated', 100.0),
+                                ]),
+                     ),
+                    ]),
+            upsert=True,
+            new=True,
+            )
+        find_and_modify.raises(pymongo.errors.DuplicateKeyError('foo error'))
+
+        buckets = MongoTokenBuckets(collection=collection, _time=fake_time)
+
+        eq(buckets.take('foo', rate=1, burst=2), 1.0)